@@ -28,6 +28,18 @@ general['copy-theme-extras'] = BooleanOption(
     default = True,
 )
 
+general['template-cache'] = BooleanOption(
+    """ Keep compiled templates between runs """,
+    options = '--enable-template-cache !--disable-template-cache',
+    default = False,
+)
+
+general['specialize-templates'] = BooleanOption(
+    """ Render templates that are a single element without the template interpreter """,
+    options = '--specialize-templates !--no-specialize-templates',
+    default = True,
+)
+
 general['kpsewhich'] = StringOption(
     """ Program which locates LaTeX files and packages """,
     options = '--kpsewhich',
@@ -178,6 +190,20 @@ files['split-level'] = IntegerOption(
     category = 'files',
 )
 
+files['split-workers'] = IntegerOption(
+    """ Number of processes to render the files below the top-level file with (0 means one per CPU) """,
+    options = '--split-workers',
+    default = 1,
+    category = 'files',
+)
+
+files['stream-output'] = BooleanOption(
+    """ Write rendered files as they are rendered instead of building them in memory (split-workers is not used) """,
+    options = '--stream-output !--no-stream-output',
+    default = False,
+    category = 'files',
+)
+
 def setFilename(data):
     """ If there is only one filename specified, turn off splitting """
     data = data.strip()
@@ -306,6 +332,53 @@ images['resolution'] = IntegerOption(
     category = 'images',
 )
 
+images['store'] = StringOption(
+    """ Directory of images that is shared between builds """,
+    options = '--image-store',
+    category = 'images',
+)
+
+images['shards'] = IntegerOption(
+    """ Number of LaTeX documents to split the images into and compile at the same time (0 means one per CPU) """,
+    options = '--image-shards',
+    default = 1,
+    category = 'images',
+)
+
+images['workers'] = IntegerOption(
+    """ Number of processes to crop images with (0 means one per CPU) """,
+    options = '--image-workers',
+    default = 0,
+    category = 'images',
+)
+
+#
+# MathML
+#
+
+mathml = c.add_section('mathml')
+c.add_category('mathml', 'MathML Options')
+
+mathml['cache'] = StringOption(
+    """ Directory for caching LaTeX to MathML translations between runs """,
+    options = '--mathml-cache',
+    category = 'mathml',
+)
+
+mathml['cache-size'] = IntegerOption(
+    """ Maximum size of the MathML cache directory in kilobytes """,
+    options = '--mathml-cache-size',
+    default = 10240,
+    category = 'mathml',
+)
+
+mathml['workers'] = IntegerOption(
+    """ Number of Tralics processes to translate math with (0 means one per CPU) """,
+    options = '--mathml-workers',
+    default = 0,
+    category = 'mathml',
+)
+
 #
 # Document
 #
@@ -18,6 +18,37 @@ stacklog = getLogger('context.stack')
 macrolog = getLogger('context.macros')
 
 
+# Order in which the category code strings are searched; if a character
+# is listed in more than one category, the first one wins
+CODE_PRIORITY = [Token.CC_LETTER, Token.CC_SPACE, Token.CC_EOL,
+                 Token.CC_BGROUP, Token.CC_EGROUP, Token.CC_ESCAPE,
+                 Token.CC_SUPER, Token.CC_SUB, Token.CC_MATHSHIFT,
+                 Token.CC_ALIGNMENT, Token.CC_COMMENT, Token.CC_ACTIVE,
+                 Token.CC_PARAMETER, Token.CC_IGNORED, Token.CC_INVALID]
+
+_codeTables = {}
+
+def codeTable(categories):
+    """
+    Return a dictionary mapping characters to their category codes
+
+    Characters that aren't in the dictionary are CC_OTHER.  Tables are
+    shared between all category lists with the same contents.
+
+    Required Arguments:
+    categories -- list of 16 strings, one for each category code
+
+    """
+    key = tuple(categories)
+    table = _codeTables.get(key)
+    if table is None:
+        table = _codeTables[key] = {}
+        for code in reversed(CODE_PRIORITY):
+            for char in categories[code]:
+                table[char] = code
+    return table
+
+
 class ContextItem(dict):
     """ 
     Localized macro/category code stack element
@@ -27,6 +58,7 @@ class ContextItem(dict):
     def __init__(self, data={}):
         dict.__init__(self, data)
         self.categories = None
+        self.codes = None
         self.obj = None
         self.parent = None
         self.owner = None
@@ -530,6 +562,7 @@ class Context(object):
         if not self.contexts:
             context = ContextItem()
             context.categories = DEFAULT_CATEGORIES[:]
+            context.codes = codeTable(context.categories)
             self.contexts.append(context)
 
         else:
@@ -557,6 +590,7 @@ class Context(object):
         self.keys = top.keys
         self.has_key = top.has_key
         self.categories = top.categories
+        self.codes = top.codes
 
         # Setter methods always use the global namespace
         self.update = top.update
@@ -584,6 +618,7 @@ class Context(object):
         """
         newcontext = ContextItem()
         newcontext.categories = self.categories
+        newcontext.codes = self.codes
         newcontext.obj = obj
 
         if obj is not None:
@@ -711,38 +746,7 @@ class Context(object):
         Returns: integer category code of the given character
 
         """
-        c = self.categories
-        if char in c[Token.CC_LETTER]:
-            return Token.CC_LETTER
-        if char in c[Token.CC_SPACE]:
-            return Token.CC_SPACE
-        if char in c[Token.CC_EOL]:
-            return Token.CC_EOL
-        if char in c[Token.CC_BGROUP]:
-            return Token.CC_BGROUP
-        if char in c[Token.CC_EGROUP]:
-            return Token.CC_EGROUP 
-        if char in c[Token.CC_ESCAPE]:
-            return Token.CC_ESCAPE 
-        if char in c[Token.CC_SUPER]:
-            return Token.CC_SUPER
-        if char in c[Token.CC_SUB]:
-            return Token.CC_SUB 
-        if char in c[Token.CC_MATHSHIFT]:
-            return Token.CC_MATHSHIFT
-        if char in c[Token.CC_ALIGNMENT]:
-            return Token.CC_ALIGNMENT 
-        if char in c[Token.CC_COMMENT]:
-            return Token.CC_COMMENT
-        if char in c[Token.CC_ACTIVE]:
-            return Token.CC_ACTIVE
-        if char in c[Token.CC_PARAMETER]:
-            return Token.CC_PARAMETER
-        if char in c[Token.CC_IGNORED]:
-            return Token.CC_IGNORED 
-        if char in c[Token.CC_INVALID]:
-            return Token.CC_INVALID
-        return Token.CC_OTHER
+        return self.codes.get(char, Token.CC_OTHER)
 
     def catcode(self, char, code):
         """
@@ -753,12 +757,15 @@ class Context(object):
         code -- the category code number to set `char` to
 
         """
+        if self.whichCode(char) == code:
+            return
         c = self.contexts[-1].categories = self.categories = self.categories[:]
         for i in range(0,16):
             c[i] = c[i].replace(char, '')
         # Don't insert if it's code 12.
         if code != 12:
             c[code] += char
+        self.contexts[-1].codes = self.codes = codeTable(c)
 
     def setVerbatimCatcodes(self):
         """
@@ -768,6 +775,7 @@ class Context(object):
 
         """
         self.contexts[-1].categories = self.categories = VERBATIM_CATEGORIES[:]
+        self.contexts[-1].codes = self.codes = codeTable(self.categories)
 
     def newcounter(self, name, resetby=None, initial=0, format=None):
         """ 
@@ -1,6 +1,6 @@
 #!/usr/bin/env python
 
-import os, time, tempfile, shutil, re, string, pickle, codecs
+import os, time, tempfile, shutil, re, string, pickle, codecs, shelve
 try: from hashlib import md5
 except ImportError: from md5 import new as md5
 from plasTeX.Logging import getLogger
@@ -9,6 +9,7 @@ from plasTeX.Filenames import Filenames
 from plasTeX.dictutils import ordereddict
 import subprocess
 import shlex
+import multiprocessing
 
 log = getLogger()
 depthlog = getLogger('render.images.depth')
@@ -21,6 +22,144 @@ try:
 except ImportError:
     PILImage = PILImageChops = None
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+def backgroundColor(corners):
+    """
+    Pick the background color of an image from the colors of its corners
+
+    Required Arguments:
+    corners -- list of the top left, top right, bottom left, and 
+        bottom right pixel values
+
+    Returns: the color shared by the most corners
+
+    """
+    topleft, topright, bottomleft, bottomright = corners
+    matches = []
+    matches.append(len([x for x in corners if x == topleft]))
+    matches.append(len([x for x in corners if x == topright]))
+    matches.append(len([x for x in corners if x == bottomleft]))
+    matches.append(len([x for x in corners if x == bottomright]))
+
+    bgcolor = None
+    try: bgcolor = corners[matches.index(1)]
+    except ValueError: pass
+    try: bgcolor = corners[matches.index(2)]
+    except ValueError: pass
+    try: bgcolor = corners[matches.index(3)]
+    except ValueError: pass
+    try: bgcolor = corners[matches.index(4)]
+    except ValueError: pass
+    return bgcolor
+
+def isColor(value):
+    """ Is `value' an RGB tuple that numpy can compare pixels with? """
+    return isinstance(value, tuple) and len(value) == 3 and \
+           not [x for x in value if type(x) is not int or not 0 <= x <= 255]
+
+def packColor(color):
+    """ Pack an RGB tuple into the integer that packPixels uses for it """
+    return numpy.frombuffer(str(bytearray(color + (0,))), numpy.uint32)[0]
+
+def unpackColor(value):
+    """ Unpack an integer created by packColor into an RGB tuple """
+    return tuple(bytearray(numpy.array([value], numpy.uint32).tostring())[:3])
+
+def packPixels(im):
+    """
+    Convert an RGB image to an array with one integer per pixel
+
+    Comparing whole pixels is much faster than comparing each band.
+
+    Required Arguments:
+    im -- RGB image
+
+    Returns: numpy array of integers, indexed by row and column
+
+    """
+    tobytes = getattr(im, 'tobytes', None) or im.tostring
+    pixels = numpy.frombuffer(tobytes('raw', 'RGBX'), numpy.uint32)
+    return pixels.reshape(im.size[1], im.size[0]) & packColor((255,255,255))
+
+def arrayBBox(mask):
+    """
+    Return the bounding box of the True values of a 2-D array
+
+    Required Arguments:
+    mask -- numpy array of booleans, indexed by row and column
+
+    Returns: (left, top, right, bottom) like PIL's getbbox, or None
+        if there are no True values
+
+    """
+    rows = numpy.flatnonzero(mask.any(1))
+    if not len(rows):
+        return None
+    columns = numpy.flatnonzero(mask.any(0))
+    return (int(columns[0]), int(rows[0]), 
+            int(columns[-1]) + 1, int(rows[-1]) + 1)
+
+def arrayCropBox(pixels, bgcolor=None):
+    """
+    Find the box that autoCrop would crop an image down to
+
+    Required Arguments:
+    pixels -- array of the image's pixels created by packPixels
+
+    Optional Arguments:
+    bgcolor -- tuple containing the background color, or None to 
+        determine it from the corners of the image
+
+    Returns: tuple containing the bounding box of the image,
+        the bounding box of the non-background content (None if there
+        isn't any), and the background color
+
+    """
+    height, width = pixels.shape
+    origbbox = arrayBBox(pixels != 0)
+    if origbbox is None:
+        origbbox = (0,0,width,height)
+
+    if bgcolor is None:
+        left, top, right, bottom = origbbox
+        corners = [unpackColor(pixels[y,x]) for x, y in 
+                   [(left,top), (right-1,top), (left,bottom-1), 
+                    (right-1,bottom-1)]]
+        bgcolor = backgroundColor(corners)
+
+    bbox = arrayBBox(pixels != packColor(bgcolor))
+    return origbbox, bbox, bgcolor
+
+def firstFalse(row, start=0):
+    """ Index of the first False in `row' at or after `start' """
+    index = numpy.flatnonzero(~row[start:])
+    if len(index):
+        return start + int(index[0])
+    return len(row)
+
+def firstTrue(row, start=0):
+    """ Index of the first True in `row' at or after `start' """
+    index = numpy.flatnonzero(row[start:])
+    if len(index):
+        return start + int(index[0])
+    return len(row)
+
+def lastTrue(row):
+    """ Index of the last True in `row' after the first element, or 0 """
+    index = numpy.flatnonzero(row[1:])
+    if len(index):
+        return int(index[-1]) + 1
+    return 0
+
 def autoCrop(im, bgcolor=None, margin=0):
     """
     Automatically crop image down to non-background portion
@@ -41,39 +180,31 @@ def autoCrop(im, bgcolor=None, margin=0):
     if im.mode != "RGB":
         im = im.convert("RGB")
 
-    origbbox = im.getbbox()
-    if origbbox is None:
-        origbbox = (0,0,im.size[0],im.size[1])
+    if numpy is not None and im.size[0] and im.size[1] and \
+       (bgcolor is None or isColor(bgcolor)):
+        origbbox, bbox, bgcolor = arrayCropBox(packPixels(im), bgcolor)
+
+    else:
+        origbbox = im.getbbox()
+        if origbbox is None:
+            origbbox = (0,0,im.size[0],im.size[1])
+
+        # Figure out the background color from the corners, if needed
+        if bgcolor is None:
+            topleft = im.getpixel((origbbox[0],origbbox[1]))
+            topright = im.getpixel((origbbox[2]-1,origbbox[1]))
+            bottomleft = im.getpixel((origbbox[0],origbbox[3]-1))
+            bottomright = im.getpixel((origbbox[2]-1,origbbox[3]-1))
+            bgcolor = backgroundColor([topleft, topright, 
+                                       bottomleft, bottomright])
+
+        # Create image with only the background color
+        bg = PILImage.new("RGB", im.size, bgcolor)
+
+        # Get bounding box of non-background content
+        diff = PILImageChops.difference(im, bg)
+        bbox = diff.getbbox()
 
-    # Figure out the background color from the corners, if needed
-    if bgcolor is None:
-        topleft = im.getpixel((origbbox[0],origbbox[1]))
-        topright = im.getpixel((origbbox[2]-1,origbbox[1]))
-        bottomleft = im.getpixel((origbbox[0],origbbox[3]-1))
-        bottomright = im.getpixel((origbbox[2]-1,origbbox[3]-1))
-        corners = [topleft, topright, bottomleft, bottomright]
-
-        matches = []
-        matches.append(len([x for x in corners if x == topleft]))
-        matches.append(len([x for x in corners if x == topright]))
-        matches.append(len([x for x in corners if x == bottomleft]))
-        matches.append(len([x for x in corners if x == bottomright]))
-
-        try: bgcolor = corners[matches.index(1)]
-        except ValueError: pass
-        try: bgcolor = corners[matches.index(2)]
-        except ValueError: pass
-        try: bgcolor = corners[matches.index(3)]
-        except ValueError: pass
-        try: bgcolor = corners[matches.index(4)]
-        except ValueError: pass
-
-    # Create image with only the background color
-    bg = PILImage.new("RGB", im.size, bgcolor)
-
-    # Get bounding box of non-background content
-    diff = PILImageChops.difference(im, bg)
-    bbox = diff.getbbox()
     if bbox:
         if margin:
             bbox = list(bbox)
@@ -86,6 +217,278 @@ def autoCrop(im, bgcolor=None, margin=0):
     return PILImage.new("RGB", (1,1), bgcolor), (0,0,0,0), bgcolor
     return None, None, bgcolor # no contents
 
+def copyImage(src, dest):
+    """ 
+    Copy an image file, keeping its timestamps if possible
+
+    An existing file at `dest' is removed rather than written over,
+    because it may be a hard link into an image store (see linkImage).
+
+    """
+    if os.path.exists(dest) and not os.path.samefile(src, dest):
+        os.remove(dest)
+    try:
+        shutil.copy2(src, dest)
+    except OSError:
+        shutil.copy(src, dest)
+
+# Images being converted by Imager.convert, as (source, Image) pairs.
+# Worker processes are forked after this is set, so they get their own
+# copy of the images without having to pickle them.
+_convertJobs = []
+
+def convertImage(index):
+    """
+    Copy and crop one image of _convertJobs in a worker process
+
+    Required Arguments:
+    index -- index of the image in _convertJobs
+
+    Returns: tuple containing the index, a dictionary of the
+        attributes set by the crop, and an error message or None
+
+    """
+    src, dest = _convertJobs[index]
+    try:
+        copyImage(src, dest.path)
+        dest.crop()
+    except Exception, msg:
+        import traceback
+        traceback.print_exc()
+        return index, None, str(msg)
+    return index, cropAttributes(dest), None
+
+def cropAttributes(image):
+    """
+    Return the attributes of an image that cropping sets, so they 
+    can be sent back from a worker process
+
+    """
+    attrs = {'_cropped': image._cropped}
+    for name in ['width', 'height', 'depth']:
+        value = getattr(image, name)
+        if isinstance(value, DimensionPlaceholder):
+            continue
+        if value is not None:
+            value = float(value)
+        attrs[name] = value
+    return attrs
+
+def cpu_count():
+    """ Return the number of CPUs, or 1 if it can't be determined """
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+def runCommand(cmd, cwd=None):
+    """
+    Run a command, sending its output to the imager log
+
+    The output is read until the command closes it, which blocks 
+    instead of polling, and then the command is waited for.
+
+    Required Arguments:
+    cmd -- command line to run
+
+    Keyword Arguments:
+    cwd -- directory to run the command in
+
+    Returns: the command's return code
+
+    """
+    p = subprocess.Popen(shlex.split(cmd), cwd=cwd,
+                         stdout=subprocess.PIPE,
+                         stderr=subprocess.STDOUT,
+                        )
+    for line in iter(p.stdout.readline, ''):
+        imagelog.info(str(line.strip()))
+    p.stdout.close()
+    return p.wait()
+
+def generateImages(imager, connection):
+    """
+    Compile and convert the images of an imager in a child process,
+    and send the result of Imager.generate back through a pipe
+
+    The child has its own working directory, so the converters that
+    change it don't get in the way of the other imagers.
+
+    """
+    try:
+        result = imager.generate()
+    except Exception:
+        import traceback
+        traceback.print_exc()
+        result = None, [], {}
+    connection.send(result)
+    connection.close()
+
+def closeImagers(imagers):
+    """
+    Generate the images of several imagers
+
+    The LaTeX runs and image converters of the imagers that compile a 
+    single document run at the same time, each in a child process, 
+    when more than one worker is configured.  The images are then 
+    moved and cropped one imager at a time, in order, because the 
+    crops of a vector imager depend on the bitmap images.
+
+    Required Arguments:
+    imagers -- list of imagers, in the order their images are finished
+
+    """
+    pending = [x for x in imagers if x.finishSource()]
+
+    workers = 1
+    for imager in pending:
+        workers = imager.config['images']['workers'] or cpu_count()
+        break
+    single = [x for x in pending if not x.shardCount()]
+    concurrent = workers > 1 and len(single) > 1 and hasattr(os, 'fork')
+
+    # Start the LaTeX runs and converters of the imagers together
+    children = {}
+    if concurrent:
+        for imager in single:
+            receiver, sender = multiprocessing.Pipe(False)
+            child = multiprocessing.Process(target=generateImages, 
+                                            args=(imager, sender))
+            child.start()
+            sender.close()
+            children[imager] = (child, receiver)
+
+    for imager in pending:
+        name = type(imager).__name__
+        shards = imager.shardCount()
+        if shards:
+            start = time.time()
+            imager.compileShards(shards)
+            log.info('%s: %d shards compiled, converted and cropped in %.2fs', name, shards, time.time() - start)
+            imager.finishImages()
+            continue
+
+        if imager in children:
+            child, receiver = children.pop(imager)
+            try:
+                result = receiver.recv()
+            except EOFError:
+                result = None, [], {}
+            receiver.close()
+            child.join()
+        else:
+            result = imager.generate()
+
+        tempdir, images, timings = result
+        start = time.time()
+        if tempdir is not None:
+            if len(images) != len(imager.images):
+                log.warning('The number of images generated (%d) and the number of images requested (%d) is not the same.' % (len(images), len(imager.images)))
+            imager.moveImages(tempdir, images)
+        timings['crop'] = time.time() - start
+        log.info('%s: LaTeX %.2fs, converter %.2fs, crop %.2fs', name,
+                 timings.get('latex', 0), timings.get('converter', 0), 
+                 timings['crop'])
+        imager.finishImages()
+
+# Static images being converted by Imager.convertStaticImages, as
+# (source, destination) pairs
+_staticJobs = []
+
+def convertStaticImage(index):
+    """
+    Convert one image of _staticJobs, possibly in a worker process
+
+    The image is written to a temporary file next to the destination
+    and renamed into place, so an interrupted conversion doesn't leave 
+    a broken file in the cache.
+
+    Required Arguments:
+    index -- index of the image in _staticJobs
+
+    Returns: tuple containing the index and an error message or None
+
+    """
+    src, dest = _staticJobs[index]
+    try:
+        directory, ext = os.path.dirname(dest), os.path.splitext(dest)[-1]
+        fd, temp = tempfile.mkstemp(suffix=ext, dir=directory)
+        os.close(fd)
+        try:
+            PILImage.open(src).save(temp)
+            os.rename(temp, dest)
+        finally:
+            if os.path.exists(temp):
+                os.remove(temp)
+    except Exception, msg:
+        return index, str(msg) or msg.__class__.__name__
+    return index, None
+
+# Image document split into shards by Imager.compileShards, as a
+# tuple of the imager and the list of (start, end) ranges of images
+_shardJobs = None
+
+def compileShard(index):
+    """
+    Compile and convert one shard of _shardJobs in a worker process
+
+    Required Arguments:
+    index -- index of the shard's range
+
+    Returns: tuple containing a dictionary of image filenames to the
+        attributes set by their crops, and the list of filenames of 
+        images that could not be generated
+
+    """
+    imager, ranges = _shardJobs
+    start, end = ranges[index]
+
+    # Shards already run in parallel, and share the directory 
+    # where images.tex would be saved
+    imager.config['images']['workers'] = 1
+    imager.config['images']['save-file'] = False
+
+    imager.source.seek(0)
+    return imager.compileRange(imager.images.items(), imager.source.read(),
+                               start, end)
+
+def replaceFile(src, dest):
+    """ Rename a file over another one """
+    if os.name == 'nt' and os.path.exists(dest):
+        os.remove(dest)
+    os.rename(src, dest)
+
+def linkImage(src, dest):
+    """ Hard link an image file into place, or copy it if that fails """
+    if os.path.exists(dest):
+        os.remove(dest)
+    try:
+        os.link(src, dest)
+    except (OSError, AttributeError):
+        copyImage(src, dest)
+
+def fileStat(path):
+    """ Return the size and modification time of a file, or None """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_size, st.st_mtime
+
+def fileChecksum(path):
+    """ Return the MD5 digest of a file's contents """
+    return md5(open(path,'rb').read()).digest()
+
+def cacheDigest(*parts):
+    """ Return a hex digest of the given strings for use as a cache key """
+    digest = md5()
+    for part in parts:
+        if isinstance(part, unicode):
+            part = part.encode('utf-8')
+        digest.update(part)
+        digest.update('\0')
+    return digest.hexdigest()
+
 class Box(object):
     pass
 
@@ -180,6 +583,7 @@ class Image(object):
         self._cropped = False
         self.bitmap = self
         self.checksum = None
+        self.stat = None
 
     def height():
         def fget(self):
@@ -275,14 +679,20 @@ class Image(object):
         if padbaseline and self.depth > padbaseline:
             log.warning('depth of image %s (%d) is greater than the baseline padding (%s).  This may cause the image to be misaligned with surrounding text.', self.filename, self.depth, padbaseline)
 
+        # The file may be a hard link into an image store (see
+        # linkImage), so the cropped image replaces it instead of
+        # being written into it
+        directory, name = os.path.split(self.path)
+        temp = os.path.join(directory, '.' + name)
         if self.config['transparent']:
             im = im.convert("P")
             lut = im.resize((256,1))
             lut.putdata(range(256))
             index = list(lut.convert("RGB").getdata()).index((255,255,255))
-            im.save(self.path, transparency=index)
+            im.save(temp, transparency=index)
         else:
-            im.save(self.path)
+            im.save(temp)
+        replaceFile(temp, self.path)
 
         self._cropped = True
 
@@ -292,6 +702,12 @@ class Image(object):
     def __repr__(self):
         return self.filename
 
+    def __getstate__(self):
+        # The configuration is set again by the imager that loads the image
+        state = self.__dict__.copy()
+        state.pop('config', None)
+        return state
+
     def _autoCrop(self, im, bgcolor=None, margin=0):
         return autoCrop(im, bgcolor, margin)
 
@@ -323,6 +739,12 @@ class Image(object):
         if im.mode != "RGB":
             im = im.convert("RGB")
 
+        if numpy is not None and \
+           type(self)._autoCrop.im_func is Image._autoCrop.im_func:
+            result = self._stripBaselineArray(im, padbaseline)
+            if result is not None:
+                return result
+
         depth = 0
 
         # Crop the image so that the regitration mark is on the left edge
@@ -412,8 +834,213 @@ class Image(object):
             im = newim
 
         return im, depth
+
+    def _stripBaselineArray(self, im, padbaseline=0):
+        """
+        Find the baseline register mark and crop it out using numpy
+
+        This does what _stripBaseline does, but it scans the image for 
+        the registration mark with array operations instead of reading 
+        one pixel at a time.  The image is only converted to an array 
+        once; the crops are worked out on the array and applied to 
+        the image at the end.
+
+        Required Arguments:
+        im -- RGB image to be cropped
+
+        Keyword Arguments:
+        padbaseline -- amount to pad the bottom of all cropped images
+
+        Returns:
+        (cropped image, distance from baseline to bottom of image), or
+        None for images that _stripBaseline has to handle (blank
+        images, images too small to have a registration mark, etc.)
+
+        """
+        pixels = packPixels(im)
+
+        # Crop the image so that the regitration mark is on the left edge
+        origbbox, box, background = arrayCropBox(pixels)
+        if box is None:
+            return None
+        left, top = box[:2]
+        pixels = pixels[box[1]:box[3], box[0]:box[2]]
+        content = pixels != packColor(background)
+        height, width = content.shape
+        if height < 2 or width < 2:
+            return None
+        
+        # Determine if registration mark is at top or left
+        marktop = False
+        # Found mark at top
+        if content[0,0]:
+            marktop = True
+            # Parse past the registration mark, then look for 
+            # additional content after it
+            i = firstFalse(content[1], 1)
+            if i < width and firstTrue(content[1], i) < width:
+                marktop = False
+
+        # Registration mark at the top
+        blank = False
+        nonzero = arrayBBox(pixels != 0)
+        if marktop:
+            pos = lastTrue(content[:,0])
+            depth = pos - height + 1
+
+            # Get the height of the registration mark so it can be cropped out
+            rheight = firstFalse(content[:,0])
+
+            # If the depth is the entire height, just make depth = 0
+            if -depth == (height-rheight):
+                depth = 0
+
+            # Handle empty images
+            if nonzero is None or rheight == (height-1):
+                blank = True
+            else:
+                bbox = list(nonzero)
+                bbox[1] = rheight
+
+        # Registration mark on left side
+        if blank or not(marktop) or nonzero[1] == 0:
+            pos = lastTrue(content[:,0])
+            depth = pos - height + 1
+
+            # Get the width of the registration mark so it can be cropped out
+            rwidth = firstFalse(content[pos])
+
+            # Handle empty images
+            if nonzero is None or rwidth == (width-1):
+                return PILImage.new("RGB", (1,1), background), 0
+
+            bbox = list(nonzero)
+            bbox[0] = rwidth
+
+        if not (0 <= bbox[0] < bbox[2] <= width and 
+                0 <= bbox[1] < bbox[3] <= height):
+            return None
+
+        # Crop out register mark, and autoCrop result    
+        pixels = pixels[bbox[1]:bbox[3], bbox[0]:bbox[2]]
+        origbbox, cropbox, background = arrayCropBox(pixels, background)
+        if cropbox is None:
+            return None
+        cropped = tuple([abs(x-y) for x,y in zip(origbbox,cropbox)])
+        left += bbox[0]
+        top += bbox[1]
+        im = im.crop((left+cropbox[0], top+cropbox[1], 
+                      left+cropbox[2], top+cropbox[3]))
+
+        # If the content was entirely above the baseline, 
+        # we need to keep that whitespace
+        depth += cropped[3]
+        depthlog.debug('Depth of image %s is %s', self.filename, depth)
+
+        # Pad all images with the given amount.  This allows you to 
+        # set one margin-bottom for all images.
+        if padbaseline:
+            width, height = im.size
+            newim = PILImage.new("RGB", (width,height+(padbaseline+depth)), background)
+            newim.paste(im, im.getbbox())
+            im = newim
+
+        return im, depth
     
 
+class ImageStore(object):
+    """
+    Directory of generated images that can be shared between builds
+
+    Images are stored under their cache key (see Imager.cacheKey),
+    so any build that asks for the same image with the same preamble
+    and imager can reuse it.  Each entry is an image file and a 
+    ".meta" file with the attributes set when the image was cropped.
+    Both are written to temporary files and renamed into place, 
+    and the ".meta" file is renamed last, so an entry is never seen 
+    half written.  Writers of an entry also hold a lock on it, so
+    concurrent builds don't store the same image twice.
+
+    """
+
+    def __init__(self, directory):
+        self.directory = os.path.abspath(os.path.expanduser(directory))
+
+    def entry(self, key):
+        """ Return the path of an entry, without an extension """
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, key, extension):
+        """
+        Look up an image
+
+        Required Arguments:
+        key -- the cache key of the image
+        extension -- the file extension of the image
+
+        Returns: tuple containing the path of the stored image file
+            and the dictionary of attributes, or None if the image 
+            isn't in the store
+
+        """
+        entry = self.entry(key)
+        try:
+            attrs = pickle.load(open(entry + '.meta', 'rb'))
+        except (IOError, EOFError, pickle.UnpicklingError):
+            return None
+        if not os.path.isfile(entry + extension):
+            return None
+        return entry + extension, attrs
+
+    def put(self, key, path, attrs):
+        """
+        Add an image to the store
+
+        Required Arguments:
+        key -- the cache key of the image
+        path -- the image file
+        attrs -- dictionary of the attributes set by cropping the image
+
+        """
+        entry = self.entry(key)
+        directory = os.path.dirname(entry)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                if not os.path.isdir(directory):
+                    raise
+
+        lock = open(entry + '.lock', 'a')
+        try:
+            if fcntl is not None:
+                fcntl.lockf(lock, fcntl.LOCK_EX)
+            if os.path.isfile(entry + '.meta'):
+                return
+            extension = os.path.splitext(path)[-1]
+            fd, temp = tempfile.mkstemp(dir=directory)
+            os.close(fd)
+            shutil.copyfile(path, temp)
+            self.rename(temp, entry + extension)
+            fd, temp = tempfile.mkstemp(dir=directory)
+            pickle.dump(attrs, os.fdopen(fd, 'wb'), 2)
+            self.rename(temp, entry + '.meta')
+        finally:
+            if fcntl is not None:
+                fcntl.lockf(lock, fcntl.LOCK_UN)
+            lock.close()
+
+    def rename(self, src, dest):
+        """ Rename a finished file into place """
+        os.chmod(src, 0644)
+        try:
+            os.rename(src, dest)
+        except OSError:
+            # Windows won't replace an existing file
+            os.remove(src)
+            if not os.path.isfile(dest):
+                raise
+
 class Imager(object):
     """ Generic Imager """
 
@@ -432,6 +1059,19 @@ class Imager(object):
     imageAttrs = ''
     imageUnits = ''
 
+    # Offset of the first image in the source, and offsets of the end
+    # of each image's code, used to split the document into shards
+    _bodyStart = None
+    _imageEnds = None
+
+    # Options in the images section that don't change the images, 
+    # so changing them doesn't invalidate the image cache
+    cacheIgnoredOptions = ['base-url', 'cache', 'filenames', 'save-file', 
+                           'shards', 'store', 'workers']
+
+    # Images requested while recording with recordImages, or None
+    requests = None
+
     def __init__(self, document, imageTypes=None):
         self.config = document.config
         self.ownerDocument = document
@@ -442,21 +1082,7 @@ class Imager(object):
             self.imageTypes = imageTypes[:]
 
         # Dictionary that makes sure each image is only generated once.
-        # The key is the LaTeX source and the value is the image instance.
-        self._cache = {}
-        usednames = {}
-        self._filecache = os.path.abspath(os.path.join('.cache', 
-                                          self.__class__.__name__+'.images'))
-        if self.config['images']['cache'] and os.path.isfile(self._filecache):
-            try: 
-                self._cache = pickle.load(open(self._filecache, 'r'))
-                for key, value in self._cache.items():
-                    if not os.path.isfile(value.filename):
-                        del self._cache[key]
-                        continue
-                    usednames[value.filename] = None
-            except ImportError:
-                os.remove(self._filecache)
+        usednames = self.loadCache()
 
         # List of images in the order that they appear in the LaTeX file
         self.images = ordereddict()
@@ -464,6 +1090,13 @@ class Imager(object):
         # Images that are simply copied from the source directory
         self.staticimages = ordereddict()
 
+        # The same images by their filenames in the output, or the 
+        # images LaTeX generates in their place
+        self.staticfiles = {}
+
+        # Copies and conversions of those images, done by close()
+        self.staticJobs = []
+
         # Filename generator
         self.newFilename = Filenames(self.config['images'].get('filenames', raw=True), 
                            vars={'jobname':document.userdata.get('jobname','')},
@@ -474,10 +1107,125 @@ class Imager(object):
         self.source.write('\\scrollmode\n')
         self.writePreamble(document)
         self.source.write('\\begin{document}\n')
+        self._bodyStart = self.source.tell()
+        self._imageEnds = []
 
         # Set up additional options
         self._configOptions = self.formatConfigOptions(self.config['images'])
 
+    def loadCache(self):
+        """
+        Load the index of the images generated by previous runs
+
+        The index is a shelf in the .cache directory.  The key of each 
+        image is computed by cacheKey() and the value is the image 
+        instance, which also holds the size, modification time, and 
+        checksum of the image file.
+
+        Returns: dictionary whose keys are the filenames used by the
+            cached images
+
+        """
+        self._cache = {}
+        self._cacheChanges = {}
+        self._cacheSalt = None
+        self._newKeys = []
+        self._store = None
+        if self.config['images']['store']:
+            self._store = ImageStore(self.config['images']['store'])
+        usednames = {}
+        self._filecache = os.path.abspath(os.path.join('.cache', 
+                                          self.__class__.__name__+'.index'))
+        if not self.config['images']['cache']:
+            return usednames
+
+        try:
+            index = shelve.open(self._filecache, 'r', protocol=2)
+        except Exception:
+            return usednames
+
+        try:
+            for key in index.keys():
+                try:
+                    value = index[key]
+                except Exception:
+                    self._cacheChanges[key] = None
+                    continue
+                if not os.path.isfile(value.filename):
+                    self._cacheChanges[key] = None
+                    continue
+                value.config = self.config['images']
+                self._cache[key] = value
+                usednames[value.filename] = None
+        finally:
+            index.close()
+
+        return usednames
+
+    def saveCache(self):
+        """ Write the entries of the image index that have changed """
+        if not self._cacheChanges:
+            return
+        if not os.path.isdir(os.path.dirname(self._filecache)):
+            os.makedirs(os.path.dirname(self._filecache))
+        index = shelve.open(self._filecache, 'c', protocol=2)
+        try:
+            for key, value in self._cacheChanges.items():
+                if value is not None:
+                    index[key] = value
+                elif index.has_key(key):
+                    del index[key]
+        finally:
+            index.close()
+        self._cacheChanges = {}
+
+    def validateCache(self):
+        """
+        Make sure the image files of cached images haven't changed
+
+        Files are compared by size and modification time first.  Only
+        if those have changed is the file read to compare checksums.
+
+        """
+        for key, value in self._cache.items():
+            stat = fileStat(value.path)
+            if stat is None or stat == getattr(value, 'stat', None):
+                continue
+            checksum = fileChecksum(value.path)
+            if value.checksum and value.checksum != checksum:
+                log.warning('The image data for "%s" on the disk has changed.  You may want to clear the image cache.' % value.filename)
+                continue
+            value.checksum = checksum
+            value.stat = stat
+            self._cacheChanges[key] = value
+
+    def cacheKey(self, text, context=''):
+        """
+        Return the key of an image in the image cache
+
+        The key covers everything that goes into the image: the 
+        preamble of the image document, the context and source of the 
+        image, the imager, and the images configuration.
+
+        Required Arguments:
+        text -- the LaTeX source of the image
+
+        Keyword Arguments:
+        context -- LaTeX source executed before the image
+
+        """
+        if self._cacheSalt is None:
+            # Nothing but the preamble has been written yet
+            config = self.config['images']
+            options = [(name, config.get(name, raw=True)) 
+                       for name in sorted(config.data.keys())
+                       if name not in self.cacheIgnoredOptions]
+            self._cacheSalt = cacheDigest(self.source.getvalue(),
+                                          self.__class__.__module__,
+                                          self.__class__.__name__,
+                                          repr(options))
+        return cacheDigest(self._cacheSalt, context, text)
+
     def formatConfigOptions(self, config):
         """
         Format configuration options as command line options
@@ -550,38 +1298,291 @@ class Imager(object):
 
     def close(self):
         """ Invoke the rendering code """
+        closeImagers([self])
+
+    def finishSource(self):
+        """
+        Finish the document containing the images
+
+        Returns: True if there are images to generate, False if the
+            imager is done
+
+        """
+        # Static images that can't be converted are added to the document
+        self.convertStaticImages()
+
         # Finish the document
         self.source.write('\n\\end{document}\\endinput')
 
-        for value in self._cache.values():
-            if value.checksum and os.path.isfile(value.path):
-                 d = md5(open(value.path,'r').read()).digest()
-                 if value.checksum != d:
-                     log.warning('The image data for "%s" on the disk has changed.  You may want to clear the image cache.' % value.filename)
+        self.validateCache()
 
         # Bail out if there are no images
-        if not self.images:
-            return 
+        if not self.images or not self.enabled:
+            self.saveCache()
+            return False
+        return True
+
+    def shardCount(self):
+        """ Return the number of shards to compile, or 0 for one document """
+        shards = self.config['images']['shards'] or cpu_count()
+        shards = min(shards, len(self.images))
+        if shards > 1 and hasattr(os, 'fork') and \
+           self._imageEnds is not None and \
+           len(self._imageEnds) == len(self.images):
+            return shards
+        return 0
+
+    def generate(self):
+        """
+        Compile the document containing the images and convert it
 
-        if not self.enabled:
-            return
+        Returns: tuple containing the temporary directory holding the
+            image files (or None if no images were generated), the 
+            list of image files in order, and a dictionary of the 
+            seconds spent in the 'latex' and 'converter' stages
 
-        # Compile LaTeX source, then convert the output
+        """
+        timings = {}
+        start = time.time()
         self.source.seek(0)
         output = self.compileLatex(self.source.read())
+        timings['latex'] = time.time() - start
         if output is None:
             log.error('Compilation of the document containing the images failed.  No output file was found.')
+            return None, [], timings
+
+        if not self.command and self.executeConverter is Imager.executeConverter:
+            log.warning('No imager command is configured.  ' +
+                        'No images will be created.')
+            return None, [], timings
+
+        start = time.time()
+        tempdir, images = self.runConverter(output)
+        output.close()
+        timings['converter'] = time.time() - start
+        return tempdir, images, timings
+
+    def finishImages(self):
+        """ Add the new images to the index and the shared store """
+        for key in self._newKeys:
+            value = self._cache[key]
+            stat = fileStat(value.path)
+            if stat is not None:
+                value.checksum = fileChecksum(value.path)
+                value.stat = stat
+                self._cacheChanges[key] = value
+                if self._store is not None and value._cropped:
+                    try:
+                        self._store.put(key, value.path, 
+                                        cropAttributes(value))
+                    except (IOError, OSError), msg:
+                        log.warning('Could not add %s to the image store (%s)', value.filename, msg)
+
+        self.saveCache()
+
+    def convertStaticImages(self):
+        """
+        Copy and convert the static images requested by getImage
+
+        Images that only need to be copied are copied unless the copy 
+        is already up to date.  Converted images are kept in 
+        .cache/static, keyed by the source file, its size and 
+        modification time, the target file type, and the scale factor,
+        so an unchanged figure is only linked into place.  Missing
+        conversions are done in a pool of worker processes.  If an 
+        image can't be converted, it is generated by LaTeX instead.
+
+        """
+        jobs, self.staticJobs = self.staticJobs, []
+        if not jobs:
             return
 
-        self.convert(output)
+        cached = {}
+        conversions = []
+        for name, path, convert, source, img, size in jobs:
+            if not convert or name in cached:
+                continue
+            cached[name] = self.staticCachePath(name, path)
+            if not os.path.isfile(cached[name]):
+                conversions.append((name, cached[name]))
+
+        failed = {}
+        if conversions:
+            cachedir = os.path.dirname(conversions[0][1])
+            if not os.path.isdir(cachedir):
+                os.makedirs(cachedir)
+            for name, msg in self.runStaticConversions(conversions):
+                failed[name] = msg
+
+        for name, path, convert, source, img, size in jobs:
+            try:
+                if not convert:
+                    if fileStat(path) != fileStat(name):
+                        copyImage(name, path)
+                    continue
+                if name not in failed:
+                    if not os.path.exists(path) or \
+                       not os.path.samefile(cached[name], path):
+                        linkImage(cached[name], path)
+                    if size is not None:
+                        img.width, img.height = size
+                    continue
+                msg = failed[name]
+            except (IOError, OSError), msg:
+                pass
+
+            # Only images whose size hasn't been written out yet can 
+            # still be replaced by one that LaTeX generates
+            if size is None:
+                log.error('%s in image "%s".' % (msg, name))
+                continue
+            log.warning('%s in image "%s".  Reverting to LaTeX to generate the image.' % (msg, name))
+            # A cached image isn't added to self.images, so keep 
+            # whichever image comes back where setImageData looks
+            self.staticfiles[path] = self.newImage(source, 
+                                         filename=os.path.splitext(path)[0])
+
+    def runStaticConversions(self, conversions):
+        """
+        Convert static images, in a pool of processes if there are
+        several of them
 
-        for value in self._cache.values():
-            if value.checksum is None and os.path.isfile(value.path):
-                 value.checksum = md5(open(value.path,'r').read()).digest()
+        Arguments:
+        conversions -- list of (source, destination) pairs
 
-        if not os.path.isdir(os.path.dirname(self._filecache)):
-            os.makedirs(os.path.dirname(self._filecache))
-        pickle.dump(self._cache, open(self._filecache,'w'))
+        Returns: list of (source, error message) pairs for the images 
+            that could not be converted
+
+        """
+        global _staticJobs
+        _staticJobs = conversions
+        workers = self.config['images']['workers'] or cpu_count()
+        try:
+            if workers > 1 and len(conversions) > 1 and hasattr(os, 'fork'):
+                pool = multiprocessing.Pool(min(workers, len(conversions)))
+                try:
+                    results = pool.map(convertStaticImage, 
+                                       range(len(conversions)))
+                    pool.close()
+                except:
+                    pool.terminate()
+                    raise
+                finally:
+                    pool.join()
+            else:
+                results = [convertStaticImage(x) 
+                           for x in range(len(conversions))]
+        finally:
+            _staticJobs = []
+        return [(conversions[index][0], msg) for index, msg in results
+                if msg is not None]
+
+    def compileShards(self, shards):
+        """
+        Split the images into shards that are compiled concurrently
+
+        Each shard is a document with the same preamble and a 
+        consecutive run of images.  Shards are compiled and converted
+        in worker processes, each in its own temporary directory.
+        A shard that fails is split until the images that can't be 
+        generated are found, so they don't affect the other images.
+
+        Arguments:
+        shards -- number of shards
+
+        """
+        if not self.command and self.executeConverter is Imager.executeConverter:
+            log.warning('No imager command is configured.  ' +
+                        'No images will be created.')
+            return
+
+        if self.config['images']['save-file']:
+            self.source.seek(0)
+            codecs.open('images.tex', 'w', self.config['files']['input-encoding']).write(self.source.read())
+
+        size, extra = divmod(len(self.images), shards)
+        ranges = []
+        start = 0
+        for i in range(shards):
+            end = start + size + (i < extra)
+            ranges.append((start, end))
+            start = end
+
+        global _shardJobs
+        _shardJobs = (self, ranges)
+        pool = multiprocessing.Pool(shards)
+        try:
+            failed = []
+            for results, missing in pool.imap_unordered(compileShard, 
+                                                       range(shards)):
+                for filename, attrs in results.items():
+                    dest = self.images[filename]
+                    for name, value in attrs.items():
+                        setattr(dest, name, value)
+                failed.extend(missing)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+            _shardJobs = None
+
+        for filename in [x for x in self.images if x in failed]:
+            log.error('Image %s could not be generated.', filename)
+
+    def compileRange(self, images, source, start, end):
+        """
+        Compile and convert a range of the images
+
+        This is run in a worker process by compileShards, so it changes
+        the imager freely.  If the range can't be compiled, or doesn't
+        produce the right number of images, each half is tried on 
+        its own.
+
+        Arguments:
+        images -- list of all (filename, image) pairs
+        source -- LaTeX source of the document containing all images
+        start -- index of the first image
+        end -- index after the last image
+
+        Returns: tuple containing a dictionary of image filenames to the
+            attributes set by their crops, and the list of filenames of 
+            images that could not be generated
+
+        """
+        self.images = ordereddict()
+        for filename, image in images[start:end]:
+            self.images[filename] = image
+
+        begin = start and self._imageEnds[start-1] or self._bodyStart
+        self.source = StringIO()
+        self.source.write(source[:self._bodyStart])
+        self.source.write(source[begin:self._imageEnds[end-1]])
+        self.source.write('\n\\end{document}\\endinput')
+        self.source.seek(0)
+
+        results, failed = {}, []
+        output = self.compileLatex(self.source.read())
+        if output is not None:
+            tempdir, filenames = self.runConverter(output)
+            output.close()
+            if len(filenames) == len(self.images):
+                self.moveImages(tempdir, filenames)
+                for filename, dest in self.images.items():
+                    results[filename] = cropAttributes(dest)
+                return results, failed
+            shutil.rmtree(tempdir, True)
+
+        if end - start == 1:
+            return results, [images[start][0]]
+
+        middle = (start + end) / 2
+        for start, end in [(start, middle), (middle, end)]:
+            more, missing = self.compileRange(images, source, start, end)
+            results.update(more)
+            failed.extend(missing)
+        return results, failed
 
     def compileLatex(self, source):
         """
@@ -594,20 +1595,17 @@ class Imager(object):
         file object corresponding to the output from LaTeX
 
         """
-        cwd = os.getcwd()
-
         # Make a temporary directory to work in
         tempdir = tempfile.mkdtemp()
-        os.chdir(tempdir)
 
         filename = 'images.tex'
 
         # Write LaTeX source file
         if self.config['images']['save-file']:
             self.source.seek(0)
-            codecs.open(os.path.join(cwd,filename), 'w', self.config['files']['input-encoding']).write(self.source.read())
+            codecs.open(filename, 'w', self.config['files']['input-encoding']).write(self.source.read())
         self.source.seek(0)
-        codecs.open(filename, 'w', self.config['files']['input-encoding']).write(self.source.read())
+        codecs.open(os.path.join(tempdir,filename), 'w', self.config['files']['input-encoding']).write(self.source.read())
 
         # Run LaTeX
         os.environ['SHELL'] = '/bin/sh'
@@ -619,30 +1617,17 @@ class Imager(object):
         log.info('Running "%s".', cmd)
         log.info('If this hangs, you might be missing a .sty file.')
         log.info('Check %s/images.log.', tempdir)
-        p = subprocess.Popen(shlex.split(cmd),
-                     stdout=subprocess.PIPE,
-                     stderr=subprocess.STDOUT,
-                     )
-
-        while True:
-            line = p.stdout.readline()
-            done = p.poll()
-            if line:
-                imagelog.info(str(line.strip()))        
-            elif done is not None:
-                break
+        runCommand(cmd, cwd=tempdir)
 
         log.info('Done')
 
         output = None
         for ext in ['.dvi','.pdf','.ps']:
-            if os.path.isfile('images'+ext):
-                output = WorkingFile('images'+ext, 'rb', tempdir=tempdir)
+            path = os.path.join(tempdir, 'images'+ext)
+            if os.path.isfile(path):
+                output = WorkingFile(path, 'rb', tempdir=tempdir)
                 break
 
-        # Change back to original working directory
-        os.chdir(cwd)
-
         return output
 
     def executeConverter(self, output):
@@ -669,19 +1654,7 @@ class Imager(object):
                 options += '%s %s ' % (opt, value)
 
         cmd = r'%s %s%s' % (self.command, options, 'images.out')
-        p = subprocess.Popen(shlex.split(cmd),
-                             stdout=subprocess.PIPE,
-                             stderr=subprocess.STDOUT,
-                           )
-        done = None
-        while True:
-            line = p.stdout.readline()
-            done = p.poll()
-            if line:
-                imagelog.info(str(line.strip()))        
-            elif done is not None:
-                break
-        return done, None
+        return runCommand(cmd), None
 
     def convert(self, output):
         """
@@ -696,6 +1669,23 @@ class Imager(object):
                         'No images will be created.')
             return
 
+        tempdir, images = self.runConverter(output)
+        if len(images) != len(self.images):
+            log.warning('The number of images generated (%d) and the number of images requested (%d) is not the same.' % (len(images), len(self.images)))
+
+        self.moveImages(tempdir, images)
+
+    def runConverter(self, output):
+        """
+        Run the image converter in a temporary directory
+
+        Arguments:
+        output -- output file object
+
+        Returns: tuple containing the temporary directory and the 
+            list of image files generated in it, in order
+
+        """
         cwd = os.getcwd()
 
         # Make a temporary directory to work in
@@ -712,8 +1702,6 @@ class Imager(object):
         if images is None:
             images = [f for f in os.listdir('.') 
                             if re.match(r'^img\d+\.\w+$', f)]
-        if len(images) != len(self.images):
-            log.warning('The number of images generated (%d) and the number of images requested (%d) is not the same.' % (len(images), len(self.images)))
 
         # Sort by creation date
         #images.sort(lambda a,b: cmp(os.stat(a)[9], os.stat(b)[9]))
@@ -723,33 +1711,81 @@ class Imager(object):
 
         os.chdir(cwd)
 
+        return tempdir, images
+
+    def moveImages(self, tempdir, images):
+        """
+        Move the converted images to their final location and crop them
+
+        Arguments:
+        tempdir -- the temporary directory the images are in
+        images -- the list of image files, in the same order as 
+            self.images
+
+        """
         if PILImage is None:
             log.warning('PIL (Python Imaging Library) is not installed.  ' +
                         'Images will not be cropped.')
             
-        # Move images to their final location
-        for src, dest in zip(images, self.images.values()):
-            # Move the image
+        jobs = [(os.path.join(tempdir,src), dest) 
+                for src, dest in zip(images, self.images.values())]
+        for src, dest in jobs:
             directory = os.path.dirname(dest.path)
             if directory and not os.path.isdir(directory):
                 os.makedirs(directory)
-            try:
-                shutil.copy2(os.path.join(tempdir,src), dest.path)
-            except OSError:
-                shutil.copy(os.path.join(tempdir,src), dest.path)
 
-            # Crop the image
-            try: 
-                dest.crop()
-                status.dot()
-            except Exception, msg:
-                import traceback
-                traceback.print_exc()
-                log.warning('failed to crop %s (%s)', dest.path, msg)
+        # Move images to their final location and crop them
+        workers = self.config['images']['workers'] or cpu_count()
+        if workers > 1 and len(jobs) > 1 and hasattr(os, 'fork'):
+            self.convertParallel(jobs, workers)
+        else:
+            for src, dest in jobs:
+                try: 
+                    copyImage(src, dest.path)
+                    dest.crop()
+                    status.dot()
+                except Exception, msg:
+                    import traceback
+                    traceback.print_exc()
+                    log.warning('failed to crop %s (%s)', dest.path, msg)
         
         # Remove temporary directory
         shutil.rmtree(tempdir, True)
 
+    def convertParallel(self, jobs, workers):
+        """
+        Copy and crop images in a pool of worker processes
+
+        The results of the crops (width, height, and depth) are set 
+        on the images in this process.
+
+        Arguments:
+        jobs -- list of (source filename, Image) pairs
+        workers -- number of worker processes
+
+        """
+        global _convertJobs
+        _convertJobs = jobs
+        pool = multiprocessing.Pool(min(workers, len(jobs)))
+        try:
+            chunksize = max(1, min(16, len(jobs) / (workers * 4)))
+            for index, attrs, msg in pool.imap_unordered(convertImage, 
+                                        range(len(jobs)), chunksize):
+                dest = jobs[index][1]
+                if attrs is None:
+                    log.warning('failed to crop %s (%s)', dest.path, msg)
+                    continue
+                for name, value in attrs.items():
+                    setattr(dest, name, value)
+                status.dot()
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+            _convertJobs = []
+
     def writeImage(self, filename, code, context):
         """
         Write LaTeX source for the image
@@ -782,19 +1818,37 @@ class Imager(object):
         for dest, src in self.ownerDocument.charsubs:
             text = text.replace(src, dest)
 
-        key = text
+        key = self.cacheKey(text, context)
+        if filename:
+            filename = self.newFilename.addExtension(filename)
 
-        # See if this image has been cached
-        if self._cache.has_key(key):
+        # See if this image has been cached (under the filename it 
+        # is forced to, if there is one)
+        if self._cache.has_key(key) and \
+           (not filename or self._cache[key].filename == filename):
             return self._cache[key]
             
         # Generate a filename
+        args = (text, context, filename)
         if not filename:
             filename = self.newFilename()
 
-        # Add the image to the current document and cache
-        #log.debug('Creating %s from %s', filename, text)
-        self.writeImage(filename, text, context)
+        # Leave the image to the process that owns the document
+        if self.requests is not None:
+            self.requests.append((filename, 'newImage', args))
+
+        else:
+            # See if another build has generated this image
+            if self._store is not None:
+                img = self.imageFromStore(key, filename)
+                if img is not None:
+                    return img
+
+            # Add the image to the current document and cache
+            #log.debug('Creating %s from %s', filename, text)
+            self.writeImage(filename, text, context)
+            if self._imageEnds is not None:
+                self._imageEnds.append(self.source.tell())
 
         img = Image(filename, self.config['images'])
 
@@ -810,6 +1864,40 @@ class Imager(object):
                     setattr(img, name, value)
     
         self.images[filename] = self._cache[key] = img
+        self._newKeys.append(key)
+        return img
+
+    def imageFromStore(self, key, filename):
+        """
+        Link an image from the shared image store into place
+
+        Arguments:
+        key -- the cache key of the image
+        filename -- the filename to give the image
+
+        Returns: Image instance, or None if the image isn't in the store
+
+        """
+        stored = self._store.get(key, os.path.splitext(filename)[-1])
+        if stored is None:
+            return None
+        path, attrs = stored
+
+        img = Image(filename, self.config['images'])
+        try:
+            directory = os.path.dirname(img.path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            linkImage(path, img.path)
+        except (IOError, OSError), msg:
+            log.warning('Could not use %s from the image store (%s)', filename, msg)
+            return None
+
+        for name, value in attrs.items():
+            setattr(img, name, value)
+        img.checksum = fileChecksum(img.path)
+        img.stat = fileStat(img.path)
+        self._cache[key] = self._cacheChanges[key] = img
         return img
 
     def getImage(self, node):
@@ -832,7 +1920,21 @@ class Imager(object):
         name = getattr(node, 'imageoverride', None)
         if name is None:
             return self.newImage(node.source)
+        return self.staticImage(name, node.source)
+
+    def staticImage(self, name, source):
+        """
+        Copy or convert an existing image file into the images directory
 
+        Arguments:
+        name -- the filename of the existing image
+        source -- the LaTeX source to generate the image from if the
+            file can't be used
+
+        Returns:
+        Image instance
+
+        """
         if name in self.staticimages:
             return self.staticimages[name]
 
@@ -850,42 +1952,122 @@ class Imager(object):
             if newext == oldext or oldext in self.imageTypes:
                 path = os.path.splitext(path)[0] + os.path.splitext(name)[-1]
                 if PILImage is None:
-                    shutil.copyfile(name, path)
-                    tmpl = string.Template(self.imageAttrs)
-                    width = DimensionPlaceholder(tmpl.substitute({'filename':path, 'attr':'width'}))
-                    height = DimensionPlaceholder(tmpl.substitute({'filename':path, 'attr':'height'}))
-                    height.imageUnits = width.imageUnits = self.imageUnits
+                    convert = False
+                    open(name, 'rb').close()
+                    width, height = self.sizePlaceholders(path)
                 else:
-                    img = PILImage.open(name)
-                    width, height = img.size
+                    width, height = PILImage.open(name).size
                     scale = self.config['images']['scale-factor']
-                    if scale != 1:
+                    convert = scale != 1
+                    if convert:
                         width = int(width * scale)
                         height = int(height * scale)
-                        img.resize((width,height))
-                        img.save(path)
-                    else:
-                        shutil.copyfile(name, path)
                     
             # If PIL is available, convert the image to the appropriate type
             else:
-                img = PILImage.open(name)
-                width, height = img.size
+                width, height = PILImage.open(name).size
                 scale = self.config['images']['scale-factor']
                 if scale != 1:
                     width = int(width * scale)
                     height = int(height * scale)
-                    img.resize((width,height))
-                img.save(path)
+                convert = True
+
+            # The copy or conversion is done by close(), or by the
+            # process that owns the document.  If the conversion fails
+            # there, LaTeX generates the image under the same name, so 
+            # its size is left to be filled in.  Images whose name LaTeX
+            # can't use are converted now instead.
+            size = None
+            if convert:
+                if os.path.splitext(path)[-1] == self.newFilename.extension:
+                    size = width, height
+                    width, height = self.sizePlaceholders(path)
+                else:
+                    self.convertStaticImageNow(name, path)
             img = Image(path, self.ownerDocument.config['images'], width=width, height=height)
-            self.staticimages[name] = img
+            if self.requests is not None:
+                self.requests.append((path, 'staticImage', (name, source)))
+            else:
+                self.staticJobs.append((name, path, convert, source, img, size))
+            self.staticimages[name] = self.staticfiles[path] = img
             return img
 
         # If anything fails, just let the imager handle it...
         except Exception, msg:
             #log.warning('%s in image "%s".  Reverting to LaTeX to generate the image.' % (msg, name))
             pass
-        return self.newImage(node.source)
+        return self.newImage(source)
+
+    def sizePlaceholders(self, filename):
+        """ Return placeholders for the width and height of an image """
+        tmpl = string.Template(self.imageAttrs)
+        width = DimensionPlaceholder(tmpl.substitute({'filename':filename, 'attr':'width'}))
+        height = DimensionPlaceholder(tmpl.substitute({'filename':filename, 'attr':'height'}))
+        height.imageUnits = width.imageUnits = self.imageUnits
+        return width, height
+
+    def staticCachePath(self, name, path):
+        """ 
+        Return the file in .cache/static that holds the conversion of 
+        the static image `name' to the type of `path' 
+
+        """
+        ext = os.path.splitext(path)[-1]
+        scale = self.config['images']['scale-factor']
+        return os.path.join(os.path.abspath(os.path.join('.cache', 'static')),
+                            cacheDigest(os.path.abspath(name), 
+                                        repr(fileStat(name)), ext, 
+                                        repr(scale)) + ext)
+
+    def convertStaticImageNow(self, name, path):
+        """ 
+        Convert a static image into .cache/static unless it is there 
+        already, raising IOError if that fails
+
+        """
+        cached = self.staticCachePath(name, path)
+        if os.path.isfile(cached):
+            return
+        directory = os.path.dirname(cached)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        for name, msg in self.runStaticConversions([(name, cached)]):
+            raise IOError, msg
+
+    def recordImages(self, prefix):
+        """
+        Record the images requested from now on instead of generating them
+
+        This is used by the processes that render part of a document
+        (see plasTeX.Renderers.renderUnits).  New images get temporary
+        filenames that start with `prefix', and the requests for them
+        are collected in `requests' so that the process that owns the 
+        document can pass them to addImages.
+
+        Arguments:
+        prefix -- the start of the temporary filenames
+
+        """
+        self.requests = []
+        self.newFilename = Filenames(prefix + '$num', 
+                                     extension=self.newFilename.extension)
+
+    def addImages(self, requests):
+        """
+        Add the images recorded by recordImages in another process
+
+        Arguments:
+        requests -- the `requests' list of the other process's imager
+
+        Returns:
+        dictionary of the final filenames of the images, keyed by
+        their temporary filenames
+
+        """
+        filenames = {}
+        for filename, method, args in requests:
+            filenames[filename] = getattr(self, method)(*args).filename
+        return filenames
 
 
 class VectorImager(Imager):
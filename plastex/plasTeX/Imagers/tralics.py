@@ -40,21 +40,7 @@ class Tralics(plasTeX.Imagers.Imager):
             self.imageTypes = imageTypes[:]
 
         # Dictionary that makes sure each image is only generated once.
-        # The key is the LaTeX source and the value is the image instance.
-        self._cache = {}
-        usednames = {}
-        self._filecache = os.path.abspath(os.path.join('.cache', 
-                                          self.__class__.__name__+'.images'))
-        if self.config['images']['cache'] and os.path.isfile(self._filecache):
-            try: 
-                self._cache = pickle.load(open(self._filecache, 'r'))
-                for key, value in self._cache.items():
-                    if not os.path.isfile(value.filename):
-                        del self._cache[key]
-                        continue
-                    usednames[value.filename] = None
-            except ImportError:
-                os.remove(self._filecache)
+        usednames = self.loadCache()
 
         # List of images in the order that they appear in the LaTeX file
         self.images = ordereddict()
@@ -62,6 +48,12 @@ class Tralics(plasTeX.Imagers.Imager):
         # Images that are simply copied from the source directory
         self.staticimages = ordereddict()
 
+        # The same images by their filenames in the output
+        self.staticfiles = {}
+
+        # Copies and conversions of those images, done by close()
+        self.staticJobs = []
+
         # Filename generator
         self.newFilename = Filenames(self.config['images'].get('filenames', 
                                                                raw=True), 
@@ -0,0 +1,383 @@
+#!/usr/bin/env python
+
+"""
+Kpsewhich
+
+This module locates input files the way kpsewhich does, without
+running kpsewhich for every lookup.  The directories in $TEXINPUTS
+(and the ls-R databases of the TeX installation, for the default
+search path) are indexed the first time they are needed and the
+answers are remembered for the rest of the run.  Anything that this
+module can't answer with certainty is handed to the kpsewhich program.
+
+Example:
+    finder = FileFinder('kpsewhich')
+    path = finder.find('article.cls', srcDir='chapters')
+
+"""
+
+import os, sys, subprocess
+from plasTeX.Logging import getLogger
+
+log = getLogger('tex.kpsewhich')
+
+# Suffixes of kpathsea's "tex" format.  A name that ends in one of
+# these is searched for as is; anything else gets ".tex" added first.
+TEX_SUFFIXES = ['.tex', '.sty', '.cls', '.fd', '.aux', '.bbl', '.def',
+                '.clo', '.ldf']
+
+# Returned by the search methods when only kpsewhich can tell
+UNKNOWN = object()
+
+def expandBraces(element):
+    """
+    Expand kpathsea brace expressions in a path element
+
+    Required Arguments:
+    element -- path element, e.g. '/texmf/tex/{latex,generic,}//'
+
+    Returns:
+    list of path elements without braces
+
+    """
+    start = element.find('{')
+    if start < 0:
+        return [element]
+    depth = 0
+    alternatives = []
+    begin = start + 1
+    for i in range(start, len(element)):
+        c = element[i]
+        if c == '{':
+            depth += 1
+        elif c == '}':
+            depth -= 1
+            if not depth:
+                alternatives.append(element[begin:i])
+                break
+        elif c == ',' and depth == 1:
+            alternatives.append(element[begin:i])
+            begin = i + 1
+    else:
+        return [element]
+    head, tail = element[:start], element[i+1:]
+    expanded = []
+    for alternative in alternatives:
+        expanded.extend(expandBraces(head + alternative + tail))
+    return expanded
+
+def joinPath(directory, name):
+    """ Join a directory and a name the way kpathsea prints them """
+    if directory.endswith('/'):
+        return directory + name
+    return directory + '/' + name
+
+class FileFinder(object):
+    """ Cached replacement for running kpsewhich on every lookup """
+
+    def __init__(self, program='kpsewhich'):
+        self.program = program
+
+        # (name, srcDir, $TEXINPUTS) -> path or None
+        self.memo = {}
+
+        # directory -> set of file names, or None if it isn't one
+        self.listings = {}
+
+        # directory -> {file name: [paths]} for recursive path elements
+        self.trees = {}
+
+        # The default search path and the ls-R databases, or None
+        # if kpsewhich couldn't tell us
+        self._defaultPath = UNKNOWN
+        self._databases = UNKNOWN
+
+        self.lookups = 0
+        self.hits = 0
+        self.calls = 0
+
+    def find(self, name, srcDir=None):
+        """
+        Locate a file
+
+        Required Arguments:
+        name -- name of the file to find
+
+        Keyword Arguments:
+        srcDir -- directory of the file being processed, which is
+            searched first
+
+        Returns:
+        full path to the file, or None if there isn't one
+
+        """
+        self.lookups += 1
+        texinputs = os.environ.get('TEXINPUTS')
+        key = (name, srcDir, texinputs)
+        try:
+            path = self.memo[key]
+        except KeyError:
+            pass
+        else:
+            self.hits += 1
+            return path
+
+        if srcDir is not None:
+            texinputs = '%s%s%s%s' % (srcDir, os.path.pathsep,
+                                      texinputs or '', os.path.pathsep)
+
+        path = self.search(name, texinputs)
+        if path is UNKNOWN:
+            path = self.kpsewhich(name, texinputs)
+        self.memo[key] = path
+        return path
+
+    def candidates(self, name):
+        """
+        Return the names kpsewhich would try for `name', in order, or
+        None if its format isn't the one this class knows how to search
+
+        """
+        if name.startswith('./') or name.startswith('../'):
+            return None
+        ext = os.path.splitext(os.path.basename(name))[1]
+        if not ext:
+            return [name + '.tex', name]
+        if ext in TEX_SUFFIXES:
+            return [name]
+        return None
+
+    def search(self, name, texinputs):
+        """
+        Search for `name' in memory
+
+        Required Arguments:
+        name -- name of the file to find
+        texinputs -- value of $TEXINPUTS to use, or None
+
+        Returns:
+        full path to the file, None if it doesn't exist, or UNKNOWN
+        if kpsewhich has to be asked
+
+        """
+        names = self.candidates(name)
+        if names is None:
+            return UNKNOWN
+
+        if os.path.isabs(name):
+            for name in names:
+                if os.path.isfile(name):
+                    return name
+            return None
+
+        if texinputs is None:
+            elements = ['']
+        else:
+            elements = texinputs.split(os.path.pathsep)
+
+        for element in elements:
+            if element:
+                path = self.searchElement(element, names)
+            else:
+                path = self.searchDefault(names)
+            if path is not None:
+                return path
+        return None
+
+    def searchDefault(self, names):
+        """ Search the default path, which an empty element stands for """
+        if self._defaultPath is UNKNOWN:
+            self._defaultPath = self.showPath('tex')
+        if self._defaultPath is None:
+            return UNKNOWN
+        for element in self._defaultPath.split(os.path.pathsep):
+            if not element:
+                continue
+            path = self.searchElement(element, names)
+            if path is not None:
+                return path
+        return None
+
+    def searchElement(self, element, names):
+        """
+        Search one element of a search path
+
+        Required Arguments:
+        element -- path element
+        names -- list of file names to try
+
+        Returns:
+        full path to the file, None if it isn't there, or UNKNOWN if
+        kpsewhich has to be asked
+
+        """
+        for directory in expandBraces(element):
+            if directory.startswith('!!'):
+                path = self.searchDatabase(directory[2:], names)
+            elif '$' in directory or '//' in directory.rstrip('/'):
+                path = UNKNOWN
+            elif directory.endswith('//'):
+                if self.database(directory) is not None:
+                    path = self.searchDatabase(directory, names)
+                else:
+                    path = self.searchTree(directory, names)
+            else:
+                path = self.searchDirectory(directory, names)
+            if path is not None:
+                return path
+        return None
+
+    def searchDirectory(self, directory, names):
+        """ Search a single directory """
+        try:
+            listing = self.listings[directory]
+        except KeyError:
+            try:
+                listing = set(os.listdir(directory))
+            except OSError:
+                listing = None
+            self.listings[directory] = listing
+        if listing is None:
+            return None
+        for name in names:
+            if '/' in name:
+                path = joinPath(directory, name)
+                if os.path.isfile(path):
+                    return path
+            elif name in listing:
+                path = joinPath(directory, name)
+                if not os.path.isdir(path):
+                    return path
+        return None
+
+    def searchTree(self, directory, names):
+        """ Search a directory and its subdirectories (element `dir//') """
+        root = directory.rstrip('/') or '/'
+        try:
+            tree = self.trees[root]
+        except KeyError:
+            tree = self.trees[root] = {}
+            for dirpath, dirnames, filenames in os.walk(root):
+                dirnames.sort()
+                for filename in filenames:
+                    tree.setdefault(filename, []).append(
+                        joinPath(dirpath, filename))
+        return self.pick(tree, names)
+
+    def searchDatabase(self, directory, names):
+        """ Search an element that is covered by an ls-R database """
+        database = self.database(directory)
+        if database is None:
+            return UNKNOWN
+        recursive = directory.endswith('//')
+        root = directory.rstrip('/')
+        entries = {}
+        for name in names:
+            if '/' in name:
+                return UNKNOWN
+            for path in database.get(name, []):
+                parent = os.path.dirname(path)
+                if parent == root or \
+                   (recursive and parent.startswith(root + '/')):
+                    entries.setdefault(name, []).append(path)
+        path = self.pick(entries, names)
+        if path is not None and path is not UNKNOWN and \
+           not os.path.isfile(path):
+            return UNKNOWN
+        return path
+
+    def pick(self, entries, names):
+        """
+        Pick the match for the first name that has one.  kpsewhich's
+        choice between several matches in one element depends on the
+        order of directory entries, so leave those to kpsewhich.
+
+        """
+        for name in names:
+            if '/' in name:
+                return UNKNOWN
+            paths = entries.get(name)
+            if not paths:
+                continue
+            if len(paths) > 1:
+                return UNKNOWN
+            return paths[0]
+        return None
+
+    def database(self, directory):
+        """
+        Return the ls-R database that covers `directory' as a dictionary
+        of file name -> list of paths, or None if there isn't one
+
+        """
+        if self._databases is UNKNOWN:
+            self._databases = []
+            roots = self.showPath('ls-R') or ''
+            for root in roots.split(os.path.pathsep):
+                root = root.rstrip('/')
+                if root and not root.startswith('!!'):
+                    self._databases.append([root, None])
+        directory = directory.rstrip('/')
+        for item in self._databases:
+            root = item[0]
+            if directory == root or directory.startswith(root + '/'):
+                if item[1] is None:
+                    item[1] = self.readDatabase(root)
+                if item[1]:
+                    return item[1]
+        return None
+
+    def readDatabase(self, root):
+        """ Read the ls-R file in `root' """
+        database = {}
+        for filename in ['ls-R', 'ls-r']:
+            filename = os.path.join(root, filename)
+            if os.path.isfile(filename):
+                break
+        else:
+            return database
+        directory = root
+        for line in open(filename):
+            line = line.rstrip('\n')
+            if not line or line.startswith('%'):
+                continue
+            if line.endswith(':') and '/' in line:
+                line = line[:-1]
+                if line.startswith('./'):
+                    line = line[2:]
+                elif line == '.':
+                    line = ''
+                directory = line and os.path.join(root, line) or root
+                continue
+            database.setdefault(line, []).append(joinPath(directory, line))
+        return database
+
+    def showPath(self, format):
+        """ Ask kpsewhich for the default search path of a format """
+        env = os.environ.copy()
+        env.pop('TEXINPUTS', None)
+        try:
+            output = self.run(['-show-path=%s' % format], env=env)
+        except Exception:
+            return None
+        return output or None
+
+    def kpsewhich(self, name, texinputs):
+        """ Run kpsewhich to locate `name' """
+        env = None
+        if texinputs is not None:
+            env = os.environ.copy()
+            env['TEXINPUTS'] = texinputs
+        try:
+            return self.run([name], env=env) or None
+        except Exception:
+            return None
+
+    def run(self, args, env=None):
+        """ Run kpsewhich and return its output """
+        self.calls += 1
+        kwargs = {'stdout':subprocess.PIPE, 'env':env}
+        if sys.platform.lower().startswith('win'):
+            kwargs['shell'] = True
+        return subprocess.Popen([self.program] + args,
+                                **kwargs).communicate()[0].strip()
@@ -1,5 +1,6 @@
 #!/usr/bin/env python
-import re
+import re, string
+from plasTeX.Renderers import WholeFileNeeded
 from plasTeX.Renderers.PageTemplate import Renderer as _Renderer
 
 with_mathml = """[<!ENTITY % MATHML.prefixed "INCLUDE">
@@ -10,64 +11,428 @@ with_mathml = """[<!ENTITY % MATHML.prefixed "INCLUDE">
 %mathml;]
 """
 
-class DocBook(_Renderer):
-    """ Renderer for DocBook documents """
-    fileExtension = '.xml'
-    imageTypes = ['.png','.jpg','.jpeg','.gif']
-    vectorImageTypes = ['.svg']
+# Markup that fixupMarkup changes.  Most of it starts with "<", which
+# keeps the number of places the expression has to try small.
+FIXUPS = re.compile(r'<(?:((?:hr|br|img|link|meta|col)\b)'
+                    r'|(chapter|/chapter>)'
+                    r'|(programlisting>\n)'
+                    r'|(para>\s*<bookinfo>)|(/bookinfo>\s*</para>)'
+                    r'|(anchor[^>]*>)'
+                    r'|(para>)|(/para>)'
+                    r'|(partintro>)|(/partintro>)'
+                    r'|(xref))'
+                    r'|(xml:id)'
+                    r'|( <indexterm(?:> )?|indexterm> )'
+                    r'|(\n</programlisting>)')
 
-    def cleanup(self, document, files, postProcess=None):
-        res = _Renderer.cleanup(self, document, files, postProcess=postProcess)
-        return res
+(EMPTYTAG, CHAPTER, PROGRAMLISTING, BOOKINFO, ENDBOOKINFO, ANCHOR, PARA,
+ ENDPARA, PARTINTRO, ENDPARTINTRO, XREF, XMLID, INDEXTERM,
+ ENDPROGRAMLISTING) = range(1, 15)
 
-    def processFileContent(self, document, s):
-        s = _Renderer.processFileContent(self, document, s)
-        s = s.strip()
+# Characters matched by \s and \w in the expressions
+WHITESPACE = ' \t\n\r\f\v'
+WORDCHARS = string.ascii_letters + string.digits + '_'
+
+# Number of times empty paragraphs are removed, so that paragraphs
+# that only contain empty paragraphs are removed too
+EMPTY_PARA_PASSES = 3
+
+class Fallback(WholeFileNeeded):
+    """ Raised when fixupMarkup can't reproduce fixupMarkupSequentially """
+
+def fixupMarkupSequentially(s):
+    """
+    Fix up rendered DocBook markup with a series of regular expressions
+
+    This is the reference for fixupMarkup, which is used for markup
+    that it can't handle in one pass.
+
+    """
+    # Force XHTML syntax on empty tags
+    s = re.sub(r'(<(?:hr|br|img|link|meta|col)\b.*?)\s*/?\s*(>)',
+               r'\1 /\2',
+               s,
+               re.I|re.S)
+
+    # replace the document header: this is an awful workaround for
+    # a problem with simpleTAL where is mangles the mathml part of
+    # the header (but only on recent versions of Linux
+    s = re.sub(r'put_mathml_stuff_here', with_mathml, s, count=1)
+
+    # replace xml:id with id
+    s = re.sub(r'xml:id', r'id', s)
+
+    # replace the first chapter with a preface
+    s = re.sub(r'<chapter', r'<preface', s, count=1)
+    s = re.sub(r'</chapter>', r'</preface>', s, count=1)
+
+    # no space before an indexterm
+    s = re.sub(r' <indexterm', r'<indexterm', s)
+    s = re.sub(r'indexterm> ', r'indexterm>', s)
 
-        # Force XHTML syntax on empty tags
-        s = re.sub(r'(<(?:hr|br|img|link|meta|col)\b.*?)\s*/?\s*(>)',
-                   r'\1 /\2',
-                   s,
-                   re.I|re.S)
+    # remove newlines in programlistings
+    s = re.sub(r'\s*(<programlisting>)\n', r'\1', s)
+    s = re.sub(r'\n(</programlisting>)\s*', r'\1', s)
 
-        # replace the document header: this is an awful workaround for
-        # a problem with simpleTAL where is mangles the mathml part of
-        # the header (but only on recent versions of Linux
-        s = re.sub(r'put_mathml_stuff_here', with_mathml, s, count=1)
+    # remove para around bookinfo
+    s = re.sub(r'<para>\s*(<bookinfo>)', r'\1', s)
+    s = re.sub(r'(</bookinfo>)\s*</para>', r'\1', s)
 
-        # replace xml:id with id
-        s = re.sub(r'xml:id', r'id', s)
+    # remove pointless anchors
+    s = re.sub(r'\s*(<anchor[^>]*>)\s*', r'',s)
 
-        # replace the first chapter with a preface
-        s = re.sub(r'<chapter', r'<preface', s, count=1)
-        s = re.sub(r'</chapter>', r'</preface>', s, count=1)
+    # get rid of empty paragraphs
+    s = re.sub(r'\s*<para>\s*</para>\s*',  r'', s)
+    s = re.sub(r'\s*<para>\s*</para>\s*',  r'', s)
+    s = re.sub(r'\s*<para>\s*</para>\s*',  r'', s)
 
-        # no space before an indexterm
-        s = re.sub(r' <indexterm', r'<indexterm', s)
-        s = re.sub(r'indexterm> ', r'indexterm>', s)
+    # get rid of empty partintro
+    s = re.sub(r'\s*<partintro>\s*</partintro>\s*',  r'', s)
 
-        # remove newlines in programlistings
-        s = re.sub(r'\s*(<programlisting>)\n', r'\1', s)
-        s = re.sub(r'\n(</programlisting>)\s*', r'\1', s)
+    # get rid of redundant references
+    s = re.sub(r'\w*.<xref',  r'<xref', s)
 
-        # remove para around bookinfo
-        s = re.sub(r'<para>\s*(<bookinfo>)', r'\1', s)
-        s = re.sub(r'(</bookinfo>)\s*</para>', r'\1', s)
+    return s
 
-        # remove pointless anchors
-        s = re.sub(r'\s*(<anchor[^>]*>)\s*', r'',s)
+def fixupMarkup(s):
+    """
+    Fix up rendered DocBook markup
 
-        # get rid of empty paragraphs
-        s = re.sub(r'\s*<para>\s*</para>\s*',  r'', s)
-        s = re.sub(r'\s*<para>\s*</para>\s*',  r'', s)
-        s = re.sub(r'\s*<para>\s*</para>\s*',  r'', s)
+    This produces the same result as fixupMarkupSequentially, but
+    scans the markup once instead of once per regular expression.
+    Whitespace that the expressions remove after a match is skipped
+    as the scan goes on, and whitespace and words that they remove
+    before a match are taken off the end of the output.
 
-        # get rid of empty partintro
-        s = re.sub(r'\s*<partintro>\s*</partintro>\s*',  r'', s)
+    Required Arguments:
+    s -- the rendered markup
 
-        # get rid of redundant references
-        s = re.sub(r'\w*.<xref',  r'<xref', s)
+    Returns:
+    the fixed up markup
 
+    """
+    try:
+        return MarkupFixer().close(s)
+    except Fallback:
+        return fixupMarkupSequentially(s)
+
+class MarkupFixer(object):
+    """
+    Fix up rendered DocBook markup in one pass, see fixupMarkup
+
+    The markup can be fed in pieces.  Each piece is scanned up to the
+    last place where no expression can match across it, and the part
+    of the output that later matches can't change any more is 
+    returned.  Fallback is raised where fixupMarkup would fall back
+    to fixupMarkupSequentially.
+
+    """
+
+    def __init__(self):
+        # Markup that hasn't been scanned yet
+        self.rest = u''
+
+        # The header hasn't been replaced yet
+        self.header = True
+
+        # Output that can still change
+        self.out = []
+
+        # Number of pieces of output that aren't whitespace.  An element
+        # is empty if this is the same at its end tag as after its start
+        # tag.
+        self.content = 0
+
+        # Whitespace after a match of the expression for this group is
+        # skipped, or False
+        self.skip = False
+
+        # Open paragraphs and partintros: [len(out) before the start tag,
+        # content after it, partintros removed before it, deepest empty
+        # paragraph removed inside it]
+        self.paras = []
+        self.partintros = []
+        self.removedPartintros = 0
+
+        # len(out) after the last reference that had a word removed
+        self.references = 0
+
+        self.chapter = self.endchapter = True
+
+    def feed(self, s):
+        """ Add markup, and return the output that is ready """
+        s = self.replaceHeader(self.rest + s)
+        end = self.cut(s)
+        self.rest = s[end:]
+        if end:
+            self.scan(s[:end])
+        return self.flush(False)
+
+    def close(self, s=u''):
+        """ Add the last of the markup, and return the rest of the output """
+        s = self.replaceHeader(self.rest + s)
+        self.rest = u''
+        self.scan(s, True)
+        return self.flush(True)
+
+    def replaceHeader(self, s):
+        # The header comes first; the other expressions see what 
+        # replaces it
+        if self.header and 'put_mathml_stuff_here' in s:
+            s = s.replace('put_mathml_stuff_here', with_mathml, 1)
+            self.header = False
         return s
-    
+
+    def cut(self, s):
+        """ 
+        Return the position of the last "<" that no match of FIXUPS
+        can extend across, or 0
+
+        That is a "<" after a character that is neither whitespace nor
+        ">", and outside of other tags.
+
+        """
+        end = len(s)
+        while True:
+            end = s.rfind('<', 0, end)
+            if end <= 0:
+                return 0
+            if s[end - 1] not in WHITESPACE and s[end - 1] != '>':
+                start = s.rfind('<', 0, end)
+                if start < 0 or s.find('>', start, end) >= 0:
+                    return end
+
+    def flush(self, final):
+        """ Return the output that can't change any more """
+        out = self.out
+        if final:
+            keep = len(out)
+        else:
+            keep = self.boundary(len(out))
+            for stack in [self.paras, self.partintros]:
+                if stack:
+                    keep = min(keep, self.boundary(stack[0][0]))
+        if not keep:
+            return u''
+        result = u''.join(out[:keep])
+        del out[:keep]
+        for stack in [self.paras, self.partintros]:
+            for item in stack:
+                item[0] -= keep
+        self.references = max(self.references - keep, 0)
+        return result
+
+    def boundary(self, end):
+        """
+        Return the index of the first piece of output that can change 
+        if the output is cut back to `end'
+
+        Whitespace is taken off the end back to the last piece with 
+        content, and a reference takes the word in front of it, which
+        ends at a piece with a character that isn't part of a word.
+
+        """
+        out = self.out
+        last = end
+        while last > 0:
+            last -= 1
+            if out[last].strip(WHITESPACE):
+                break
+        else:
+            return 0
+        word = last
+        while word > self.references:
+            word -= 1
+            if out[word].strip(WORDCHARS):
+                break
+        return min(last, max(word, self.references))
+
+    def scan(self, s, final=False):
+        """ Scan markup that ends where no match can extend past it """
+        out = self.out
+        append = out.append
+        content, skip = self.content, self.skip
+        paras, partintros = self.paras, self.partintros
+        removedPartintros, references = self.removedPartintros, self.references
+        chapter, endchapter = self.chapter, self.endchapter
+        pos = 0
+
+        def rstrip():
+            """ Remove whitespace from the end of the output """
+            while out:
+                last = out[-1].rstrip(WHITESPACE)
+                if last:
+                    out[-1] = last
+                    return
+                out.pop()
+
+        for m in FIXUPS.finditer(s):
+            start = m.start()
+            if start > pos:
+                text = s[pos:start]
+                if skip:
+                    text = text.lstrip(WHITESPACE)
+                if text:
+                    skip = False
+                    append(text)
+                    if text.strip(WHITESPACE):
+                        content += 1
+            pos = m.end()
+            group, token = m.lastindex, m.group()
+
+            if group == EMPTYTAG:
+                # The empty tag expression only changes the first few tags
+                # and can change what the others match
+                raise Fallback
+
+            elif group == XMLID:
+                token = 'id'
+
+            elif group == CHAPTER:
+                if token == '<chapter':
+                    if chapter:
+                        token = '<preface'
+                        chapter = False
+                elif endchapter:
+                    token = '</preface>'
+                    endchapter = False
+
+            elif group == INDEXTERM:
+                token = token.strip(' ')
+
+            elif group == PROGRAMLISTING:
+                rstrip()
+                token = '<programlisting>'
+
+            elif group == ENDPROGRAMLISTING:
+                token = '</programlisting>'
+                # Unless its newline went with the whitespace after the
+                # previous one, the whitespace after it goes too
+                if skip != ENDPROGRAMLISTING:
+                    append(token)
+                    content += 1
+                    skip = group
+                    continue
+
+            elif group == BOOKINFO:
+                token = '<bookinfo>'
+
+            elif group == ENDBOOKINFO:
+                token = '</bookinfo>'
+
+            elif group == ANCHOR:
+                if '<' in token[1:]:
+                    raise Fallback
+                rstrip()
+                skip = group
+                continue
+
+            elif group == PARA:
+                paras.append([len(out), content + 1, removedPartintros, 0])
+
+            elif group == ENDPARA and paras:
+                before, after, removed, depth = paras.pop()
+                depth += 1
+                if content == after and removed == removedPartintros and \
+                   depth <= EMPTY_PARA_PASSES:
+                    del out[before:]
+                    content = after - 1
+                    if paras:
+                        paras[-1][3] = max(paras[-1][3], depth)
+                    rstrip()
+                    skip = group
+                    continue
+
+            elif group == PARTINTRO:
+                partintros.append([len(out), content + 1, removedPartintros])
+
+            elif group == ENDPARTINTRO and partintros:
+                before, after, removed = partintros.pop()
+                if content == after and removed == removedPartintros:
+                    del out[before:]
+                    content = after - 1
+                    removedPartintros += 1
+                    rstrip()
+                    skip = group
+                    continue
+
+            elif group == XREF:
+                # Remove the character before the reference and the word
+                # in front of that character
+                tail = ''
+                i = len(out)
+                while i > references:
+                    i -= 1
+                    tail = out[i] + tail
+                    if tail[:-1].rstrip(WORDCHARS):
+                        break
+                if tail and tail[-1] != '\n':
+                    del out[i:]
+                    word = tail[:-1].rstrip(WORDCHARS)
+                    if word:
+                        append(word)
+                    append(token)
+                    content += 1
+                    references = len(out)
+                    skip = False
+                    continue
+
+            append(token)
+            content += 1
+            skip = False
+
+        text = s[pos:]
+        if skip:
+            text = text.lstrip(WHITESPACE)
+        if final:
+            append(text)
+        elif text:
+            # Markup follows, so this is like the text between matches
+            skip = False
+            append(text)
+            if text.strip(WHITESPACE):
+                content += 1
+
+        self.content, self.skip = content, skip
+        self.removedPartintros, self.references = removedPartintros, references
+        self.chapter, self.endchapter = chapter, endchapter
+
+class DocBook(_Renderer):
+    """ Renderer for DocBook documents """
+    fileExtension = '.xml'
+    imageTypes = ['.png','.jpg','.jpeg','.gif']
+    vectorImageTypes = ['.svg']
+
+    def cleanup(self, document, files, postProcess=None):
+        res = _Renderer.cleanup(self, document, files, postProcess=postProcess)
+        return res
+
+    def processFileContent(self, document, s):
+        s = _Renderer.processFileContent(self, document, s)
+        return fixupMarkup(s.strip())
+
+    def processFileChunks(self, document, chunks):
+        chunks = _Renderer.processFileChunks(self, document, chunks)
+        fixer = MarkupFixer()
+        for s in stripChunks(chunks):
+            yield fixer.feed(s)
+        yield fixer.close()
+
+def stripChunks(chunks):
+    """ Remove whitespace from the ends of text that comes in pieces """
+    start = True
+    space = u''
+    for s in chunks:
+        if start:
+            s = s.lstrip()
+            if not s:
+                continue
+            start = False
+        body = s.rstrip()
+        if body:
+            yield space + body
+            space = s[len(body):]
+        else:
+            space += s
+
 Renderer = DocBook
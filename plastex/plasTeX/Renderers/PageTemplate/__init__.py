@@ -9,8 +9,9 @@ support for your own templating engines.
 
 """
 
-import sys, os, re, plasTeX, shutil, string
+import sys, os, re, plasTeX, shutil, string, shelve, time, cgi
 from plasTeX.Renderers import Renderer as BaseRenderer
+from plasTeX.Renderers.PageTemplate import simpletal
 from plasTeX.Renderers.PageTemplate.simpletal import simpleTAL, simpleTALES
 from plasTeX.Renderers.PageTemplate.simpletal.simpleTALES import Context as TALContext
 from plasTeX.Renderers.PageTemplate.simpletal.simpleTALUtils import FastStringOutput as StringIO
@@ -43,39 +44,300 @@ def pythontemplate(s, encoding='utf8'):
         return unicode(template, encoding) % tvars
     return renderpython
 
-# Support for ZPT HTML and XML templates
+# TAL contexts that aren't in use.  Templates render other nodes
+# while they are being expanded, so each expansion takes a context 
+# from here and puts it back when it's done.
+_talContexts = []
+
+def acquireContext(obj, template):
+    """
+    Return a TAL context with the globals set for rendering a node
+
+    The globals that are the same for the whole document are kept
+    in the context between uses, and only the ones that depend on the
+    node are set.  The globals and locals are set afresh each time,
+    so definitions made by one expansion don't leak into the next.
+
+    Required Arguments:
+    obj -- the node being rendered
+    template -- the compiled template
+
+    Returns: a context to pass to releaseContext when the expansion
+        is done
+
+    """
+    try:
+        context = _talContexts.pop()
+    except IndexError:
+        context = TALContext(allowPythonPath=1)
+        context.defaultGlobals = context.globals.copy()
+        context.documentGlobals = (None, None, None)
+    document, renderer = obj.ownerDocument, obj.renderer
+    if context.documentGlobals[0] is not document or \
+       context.documentGlobals[1] is not renderer:
+        base = context.defaultGlobals.copy()
+        base['config'] = document.config
+        base['context'] = document.context
+        base['templates'] = renderer
+        context.documentGlobals = (document, renderer, base)
+    context.globals = globals = context.documentGlobals[2].copy()
+    globals['here'] = obj
+    globals['self'] = obj
+    globals['container'] = obj.parentNode
+    globals['template'] = template
+    context.repeatMap = globals['repeat']
+    context.locals = {}
+    context.localStack = []
+    context.repeatStack = []
+    return context
+
+def releaseContext(context):
+    """ Make a context returned by acquireContext available again """
+    _talContexts.append(context)
+
+def clearContexts():
+    """ Drop the unused contexts, and the documents they refer to """
+    del _talContexts[:]
+
+# Support for ZPT HTML and XML templates.  The compiled templates can be
+# kept in the template cache, so they are turned into render functions
+# by htmlrenderer and xmlrenderer.  The templates write unicode, so 
+# their output is joined without encoding it.  The `stream' attribute
+# of a render function expands the template into a StreamOutput
+# instead (see Renderer.streamRendered).
 def htmltemplate(s, encoding='utf8'):
-    template = simpleTAL.compileHTMLTemplate(s)
+    return htmlrenderer(simpleTAL.compileHTMLTemplate(s), encoding)
+
+def htmlrenderer(template, encoding='utf8'):
     def renderhtml(obj):
-        context = TALContext(allowPythonPath=1)
-        context.addGlobal('here', obj)
-        context.addGlobal('self', obj)
-        context.addGlobal('container', obj.parentNode)
-        context.addGlobal('config', obj.ownerDocument.config)
-        context.addGlobal('context', obj.ownerDocument.context)
-        context.addGlobal('template', template)
-        context.addGlobal('templates', obj.renderer)
+        context = acquireContext(obj, template)
         output = StringIO()
-        template.expand(context, output, encoding)
-        return unicode(output.getvalue(), encoding)
+        template.expandInline(context, output)
+        releaseContext(context)
+        return unicode(output.getvalue())
+    def streamhtml(obj, output):
+        context = acquireContext(obj, template)
+        template.expandInline(context, output)
+        releaseContext(context)
+    renderhtml.stream = streamhtml
     return renderhtml
 
 def xmltemplate(s, encoding='utf8'):
-    template = simpleTAL.compileXMLTemplate(s)
+    return xmlrenderer(simpleTAL.compileXMLTemplate(s), encoding)
+
+def xmlrenderer(template, encoding='utf8'):
     def renderxml(obj):
-        context = TALContext(allowPythonPath=1)
-        context.addGlobal('here', obj)
-        context.addGlobal('self', obj)
-        context.addGlobal('container', obj.parentNode)
-        context.addGlobal('config', obj.ownerDocument.config)
-        context.addGlobal('context', obj.ownerDocument.context)
-        context.addGlobal('template', template)
-        context.addGlobal('templates', obj.renderer)
+        context = acquireContext(obj, template)
         output = StringIO()
-        template.expand(context, output, encoding, docType=None, suppressXMLDeclaration=1)
-        return unicode(output.getvalue(), encoding)
+        if template.doctype:
+            output.write(template.doctype)
+            output.write('\n')
+        template.expandInline(context, output)
+        releaseContext(context)
+        return unicode(output.getvalue())
+    def streamxml(obj, output):
+        context = acquireContext(obj, template)
+        if template.doctype:
+            output.write(template.doctype)
+            output.write('\n')
+        template.expandInline(context, output)
+        releaseContext(context)
+    renderxml.stream = streamxml
     return renderxml
 
+# Paths that a specialized template can use for the content of its element
+ELEMENT_PATH = re.compile(r'^self(/[\w\-]+)*$')
+
+def traverseNode(obj, names):
+    """
+    Follow a path from a node the way simpleTALES.Context.traversePath
+    does, calling callables along the way
+
+    Required Arguments:
+    obj -- the node, which is `self' in the path
+    names -- the rest of the path, as a list of names
+
+    Returns: the value at the end of the path
+
+    """
+    val = obj
+    try:
+        for name in names:
+            try:
+                if callable(val): 
+                    temp = val()
+                else: 
+                    temp = val
+            except TypeError:
+                temp = val
+            if hasattr(temp, name):
+                val = getattr(temp, name)
+            else:
+                try:
+                    try:
+                        val = temp[name]
+                    except TypeError:
+                        val = temp[int(name)]
+                except:
+                    raise simpleTALES.PATHNOTFOUNDEXCEPTION
+        if callable(val):
+            return val()
+        return val
+    except simpleTALES.ContextVariable, e:
+        return e.value()
+
+def elementRenderer(template):
+    """
+    Specialize a template that is a single element whose content and
+    attributes come from paths, like <tag tal:content="self"></tag>
+    or <tag tal:content="self/attributes/x"></tag>
+
+    The returned function builds the element by concatenating strings,
+    and its output is the same as the TAL interpreter's.  A template 
+    in the content is expanded in the node's context, as the 
+    interpreter does, so each path is only evaluated once.
+
+    Required Arguments:
+    template -- the compiled simpleTAL template
+
+    Returns: the specialized render function, or None if the template 
+        doesn't have that shape
+
+    """
+    if not isinstance(template, simpleTAL.Template) or template.macros or \
+       template.doctype or getattr(template, 'minimizeBooleanAtts', 0):
+        return None
+    commands = template.commandList
+    if len(commands) < 4 or \
+       commands[0][0] != simpleTAL.TAL_START_SCOPE or \
+       commands[1][0] != simpleTAL.TAL_CONTENT:
+        return None
+    scope, content, rest = commands[0], commands[1], commands[2:]
+    attributes = []
+    if rest[0][0] == simpleTAL.TAL_ATTRIBUTES:
+        attributes, rest = rest[0][1], rest[1:]
+    natural = u''
+    if len(rest) == 3 and rest[1][0] == simpleTAL.TAL_OUTPUT:
+        natural = rest.pop(1)[1]
+    if len(rest) != 2 or rest[0][0] != simpleTAL.TAL_STARTTAG or \
+       rest[1][0] != simpleTAL.TAL_ENDTAG_ENDSCOPE:
+        return None
+    start, end = rest
+
+    replace, contentType, expr, symbol = content[1]
+    if replace or template.symbolTable.get(symbol) != len(commands) - 1:
+        return None
+    paths = []
+    for expr in [expr] + [x[1] for x in attributes]:
+        expr = expr.strip()
+        if not ELEMENT_PATH.match(expr):
+            return None
+        paths.append(expr.split('/')[1:])
+    names = paths.pop(0)
+    attributes = [(x[0], y) for x, y in zip(attributes, paths)]
+
+    # The tags as the interpreter writes them
+    tag, singleton = start[1]
+    currentAttributes = scope[1][1]
+    tagAsText = simpleTAL.TemplateInterpreter().tagAsText
+    opentag = tagAsText((tag, currentAttributes))
+    emptytag = opentag
+    if singleton:
+        emptytag = tagAsText((tag, currentAttributes), 1)
+    closetag = emptyclose = u''
+    if not end[1][1]:
+        closetag = emptyclose = u'</' + end[1][0] + u'>'
+        if end[1][2]:
+            emptyclose = u''
+
+    def element(obj):
+        # The whole element, or its start tag and the object that 
+        # goes in it
+        try:
+            result = traverseNode(obj, names)
+        except simpleTALES.PathNotFoundException:
+            result = None
+        if result is not None and result == simpleTALES.DEFAULTVALUE:
+            text = natural
+            result = None
+        else:
+            text = u''
+
+        # Set the attributes
+        if attributes:
+            removed, atts = {}, []
+            for name, path in attributes:
+                try:
+                    value = traverseNode(obj, path)
+                except simpleTALES.PathNotFoundException:
+                    value = None
+                if value is None:
+                    removed[name] = 1
+                elif not value == simpleTALES.DEFAULTVALUE:
+                    removed[name] = 1
+                    if isinstance(value, str):
+                        value = unicode(value, 'ascii')
+                    elif not isinstance(value, unicode):
+                        value = unicode(value)
+                    atts.append((name, value))
+            atts += [x for x in currentAttributes if x[0] not in removed]
+            if result is None:
+                return unicode(tagAsText((tag, atts), singleton) + text + 
+                               emptyclose)
+            tagText = tagAsText((tag, atts))
+        elif result is None:
+            return unicode(emptytag + text + emptyclose)
+        else:
+            tagText = opentag
+
+        return tagText, result
+
+    def content(result):
+        if isinstance(result, str):
+            result = unicode(result, 'ascii')
+        elif not isinstance(result, unicode):
+            result = unicode(result)
+        if contentType:
+            return contentType(result)
+        return cgi.escape(result)
+
+    def expand(obj, result, output):
+        context = acquireContext(obj, template)
+        result.expandInline(context, output)
+        releaseContext(context)
+
+    def renderelement(obj):
+        value = element(obj)
+        if type(value) is not tuple:
+            return value
+        tagText, result = value
+        if contentType and isinstance(result, simpleTAL.Template):
+            output = StringIO()
+            output.write(tagText)
+            expand(obj, result, output)
+            output.write(closetag)
+            return unicode(output.getvalue())
+        return unicode(tagText + content(result) + closetag)
+
+    def streamelement(obj, output):
+        value = element(obj)
+        if type(value) is tuple:
+            tagText, result = value
+            output.write(tagText)
+            if contentType and isinstance(result, simpleTAL.Template):
+                expand(obj, result, output)
+            elif contentType is simpleTAL.structureContent and \
+               not isinstance(result, basestring):
+                output.writeContent(result)
+            else:
+                output.write(content(result))
+            output.write(closetag)
+        else:
+            output.write(value)
+
+    renderelement.stream = streamelement
+    return renderelement
+
 # Support for Cheetah templates
 try: 
 
@@ -227,13 +489,112 @@ def copytree(src, dest, symlink=None):
                 shutil.copy2(srcpath, destpath)
 
 class TemplateEngine(object):
-    def __init__(self, ext, function):
+    def __init__(self, ext, function, compiler=None, loader=None):
         if not isinstance(ext, (list,tuple)):
             ext = [ext]
         self.ext = ext
         self.function = function
+        self.compiler = compiler
+        self.loader = loader
     def compile(self, *args, **kwargs):
         return self.function(*args, **kwargs)
+    def compileProgram(self, s):
+        """ 
+        Compile a template into a program that can be pickled, or 
+        return None if the engine doesn't support that 
+
+        """
+        if self.compiler is None:
+            return None
+        return self.compiler(s)
+    def load(self, program):
+        """ Return the render function of a compiled program """
+        return self.loader(program)
+
+# Changing this invalidates the compiled templates in template caches
+TEMPLATE_CACHE_VERSION = (1, simpletal.__version__)
+
+class PendingTemplate(object):
+    """
+    Template that is compiled the first time it is used
+
+    The renderer holds one of these for each template it has read
+    until Renderer.find asks for the template, then it puts the 
+    compiled template in its place.  Calling it compiles the template
+    and renders the node with it, so it can also be used directly.
+
+    """
+
+    def __init__(self, renderer, name, engine, source, record=None, 
+                 cacheKey=None):
+        """
+        Arguments:
+        renderer -- the renderer the template belongs to
+        name -- the first name of the template, for error messages
+        engine -- the TemplateEngine that compiles it
+        source -- the content of the template
+
+        Keyword Arguments:
+        record -- the [template, options, program] list kept for the
+            template in the template cache, if it is cached
+        cacheKey -- key of the file's entry in the template cache
+
+        """
+        self.renderer = renderer
+        self.name = name
+        self.engine = engine
+        self.source = source
+        self.record = record
+        self.cacheKey = cacheKey
+        self.function = None
+        self.failed = False
+
+    def compile(self):
+        """ Return the compiled template, or None if it can't be compiled """
+        if self.function is None and not self.failed:
+            try:
+                program = self.engine.compileProgram(self.source)
+                if program is not None:
+                    self.function = self.renderer.loadProgram(self.engine,
+                                                              program)
+                else:
+                    self.function = self.engine.compile(self.source)
+            except Exception, msg:
+                log.error('Could not compile template "%s" (%s)' % (self.name, msg))
+                self.failed = True
+                return None
+            if self.record is not None and program is not None:
+                self.record[2] = program
+                self.renderer._templateCacheDirty.add(self.cacheKey)
+        return self.function
+
+    def __call__(self, obj):
+        function = self.compile()
+        if function is None:
+            raise ValueError, 'Could not compile template "%s"' % self.name
+        return function(obj)
+
+# Image sizes to be filled in by PageTemplate.processFileContent
+IMAGE_DATA = re.compile(r'&amp;(\S+)-(width|height|depth);(?:&amp;([a-z]+);)?')
+
+def splitAtWhitespace(chunks):
+    """
+    Join pieces of text into pieces that end with whitespace
+
+    The pieces are cut after the last whitespace character in them,
+    so that no run of non-whitespace characters is split across 
+    pieces.  The last piece is whatever is left at the end.
+
+    """
+    rest = u''
+    for s in chunks:
+        s = rest + s
+        end = max([s.rfind(x) for x in string.whitespace]) + 1
+        rest = s[end:]
+        if end:
+            yield s[:end]
+    if rest:
+        yield rest
 
 class PageTemplate(BaseRenderer):
     """ Renderer for page template based documents """
@@ -242,17 +603,31 @@ class PageTemplate(BaseRenderer):
     fileExtension = '.xml'
     encodingErrors = 'xmlcharrefreplace'
 
+    # Cache of compiled templates, open while loadTemplates runs
+    _templateCache = None
+    _templateCacheKey = None
+    _templateRecord = None
+    _templateCacheHits = 0
+    _templateFiles = 0
+
+    # Render simple templates without the template interpreter
+    specializeTemplates = True
+
     def __init__(self, *args, **kwargs):
         BaseRenderer.__init__(self, *args, **kwargs)
         self.engines = {}
+        html = {'compiler':simpleTAL.compileHTMLTemplate, 
+                'loader':htmlrenderer}
+        xml = {'compiler':simpleTAL.compileXMLTemplate, 
+               'loader':xmlrenderer}
         htmlexts = ['.html','.htm','.xhtml','.xhtm','.zpt','.pt']
-        self.registerEngine('pt', None, htmlexts, htmltemplate)
-        self.registerEngine('zpt', None, htmlexts, htmltemplate)
-        self.registerEngine('zpt', 'xml', '.xml', xmltemplate)
-        self.registerEngine('tal', None, htmlexts, htmltemplate)
-        self.registerEngine('tal', 'xml', '.xml', xmltemplate)
-        self.registerEngine('html', None, htmlexts, htmltemplate)
-        self.registerEngine('xml', 'xml', '.xml', xmltemplate)
+        self.registerEngine('pt', None, htmlexts, htmltemplate, **html)
+        self.registerEngine('zpt', None, htmlexts, htmltemplate, **html)
+        self.registerEngine('zpt', 'xml', '.xml', xmltemplate, **xml)
+        self.registerEngine('tal', None, htmlexts, htmltemplate, **html)
+        self.registerEngine('tal', 'xml', '.xml', xmltemplate, **xml)
+        self.registerEngine('html', None, htmlexts, htmltemplate, **html)
+        self.registerEngine('xml', 'xml', '.xml', xmltemplate, **xml)
         self.registerEngine('python', None, '.pyt', pythontemplate)
         self.registerEngine('string', None, '.st', stringtemplate)
         self.registerEngine('kid', None, '.kid', kidtemplate)
@@ -261,7 +636,8 @@ class PageTemplate(BaseRenderer):
         self.registerEngine('genshi', 'xml', '.genx', genshixmltemplate)
         self.registerEngine('genshi', 'text', '.gent', genshitexttemplate)
 
-    def registerEngine(self, name, type, ext, function):
+    def registerEngine(self, name, type, ext, function, compiler=None, 
+                       loader=None):
         """
         Register a new type of templating engine
 
@@ -272,11 +648,17 @@ class PageTemplate(BaseRenderer):
         ext -- the file extensions associated with that template type
         function -- the function used to compile templates of that type
 
+        Keyword Arguments:
+        compiler -- function that compiles a template into a program
+            that can be pickled, so it can be kept in the template cache
+        loader -- function that returns the same thing as `function'
+            given a program returned by `compiler'
+
         """
         if not type:
             type = None
         key = (name, type)
-        self.engines[key] = TemplateEngine(ext, function)
+        self.engines[key] = TemplateEngine(ext, function, compiler, loader)
 
     def textDefault(self, node):
         """ 
@@ -296,7 +678,81 @@ class PageTemplate(BaseRenderer):
         return self.outputType(node)
 
     def loadTemplates(self, document):
-        """ Load and compile page templates """
+        """ Load page templates """
+        start = time.time()
+        self.specializeTemplates = \
+            document.config['general']['specialize-templates']
+        self.openTemplateCache(document.config['general']['template-cache'])
+        try:
+            self.importTemplates(document)
+        finally:
+            if isinstance(self._templateCache, shelve.Shelf):
+                self._templateCache.close()
+            self._templateCache = None
+        log.info('Loaded %d templates in %.2fs (%d of %d files from the template cache)' % (len(self), time.time() - start, self._templateCacheHits, self._templateFiles))
+
+    def openTemplateCache(self, enabled):
+        """
+        Open the cache of compiled templates
+
+        The cache is a shelf in the .cache directory.  The key of each
+        entry is the path of a template file and the options it was 
+        parsed with, and the value holds the size and modification time
+        of the file along with the arguments of each call to 
+        setTemplate made while parsing it, including the compiled
+        programs of the templates that have been used.
+
+        Arguments:
+        enabled -- if false, templates are always compiled
+
+        """
+        self._templateCache = None
+        self._templateCacheEntries = {}
+        self._templateCacheDirty = set()
+        self._templateCacheHits = 0
+        self._templateFiles = 0
+        self._templateRecord = None
+        self._templateCacheFile = os.path.abspath(os.path.join('.cache', 
+                                                  'templates.index'))
+        if not enabled:
+            return
+        self._templateCache = {}
+        try:
+            self._templateCache = shelve.open(self._templateCacheFile, 'r', 
+                                              protocol=2)
+        except Exception:
+            pass
+
+    def saveTemplateCache(self):
+        """ 
+        Write the entries of the template cache that are new or have
+        templates that were compiled in this run
+
+        """
+        dirty = [x for x in self._templateCacheDirty 
+                 if x in self._templateCacheEntries]
+        self._templateCacheDirty = set()
+        if not dirty:
+            return
+        try:
+            if not os.path.isdir(os.path.dirname(self._templateCacheFile)):
+                os.makedirs(os.path.dirname(self._templateCacheFile))
+            cache = shelve.open(self._templateCacheFile, 'c', protocol=2)
+            try:
+                for key in dirty:
+                    cache[key] = self._templateCacheEntries[key]
+            finally:
+                cache.close()
+        except Exception, msg:
+            log.warning('Could not write the template cache (%s)' % msg)
+
+    def templateCacheStamp(self, filename):
+        """ Return what has to match for a cache entry of a file to be used """
+        st = os.stat(filename)
+        return (st.st_mtime, st.st_size, TEMPLATE_CACHE_VERSION)
+
+    def importTemplates(self, document):
+        """ Load and compile the templates of the renderer and theme """
         themename = document.config['general']['theme']
 
         # Load templates from renderer directory and parent 
@@ -349,7 +805,32 @@ class PageTemplate(BaseRenderer):
     def render(self, document):
         """ Load templates and render the document """
         self.loadTemplates(document)
-        BaseRenderer.render(self, document)
+        try:
+            BaseRenderer.render(self, document)
+        finally:
+            clearContexts()
+        self.saveTemplateCache()
+
+    def find(self, keys, default=None):
+        """
+        Locate a renderer given a list of possibilities
+
+        Templates are compiled here the first time they are found.  
+        A template that can't be compiled is removed, as if it had 
+        never been read.
+
+        """
+        for key in keys:
+            if self.has_key(key):
+                template = self[key]
+                if type(template) is PendingTemplate:
+                    template = template.compile()
+                    if template is None:
+                        del self[key]
+                        continue
+                    self[key] = template
+                return template
+        return BaseRenderer.find(self, keys, default)
 
     def importDirectory(self, templatedir):
         """ 
@@ -423,16 +904,42 @@ class PageTemplate(BaseRenderer):
            log.warning('The following aliases were unresolved: %s' 
                        % ', '.join(self.aliases.keys())) 
 
-    def setTemplate(self, template, options):
+    def loadProgram(self, engine, program):
+        """
+        Return the render function of a compiled template
+
+        Templates that are a single element with content from the node
+        are rendered by a specialized function when that is enabled.
+
+        Arguments:
+        engine -- the TemplateEngine that compiled the template
+        program -- the compiled template
+
+        """
+        if self.specializeTemplates:
+            return elementRenderer(program) or engine.load(program)
+        return engine.load(program)
+
+    def setTemplate(self, template, options, record=None):
         """ 
-        Compile template and set it in the renderer 
+        Set a template in the renderer 
+
+        The template is compiled the first time it is used, unless it
+        was already compiled by a previous run.
 
         Required Arguments:
         template -- the content of the template to be compiled
         options -- dictionary containing the name (or names) and type 
             of the template
 
+        Keyword Arguments:
+        record -- the [template, options, program] list kept for the
+            template in the template cache
+
         """
+        if record is None and self._templateRecord is not None:
+            record = [template, options.copy(), None]
+            self._templateRecord.append(record)
 
         # Get name
         try:
@@ -469,13 +976,18 @@ class PageTemplate(BaseRenderer):
 
         templateeng = self.engines.get((engine, ttype), 
                             self.engines.get((engine, None)))
-     
-        try:
-            template = templateeng.compile(template)
-        except Exception, msg:
-#           print msg
+        if templateeng is None:
             raise ValueError, 'Could not compile template "%s"' % names[0]
 
+        if record is not None and record[2] is not None:
+            try:
+                template = self.loadProgram(templateeng, record[2])
+            except Exception, msg:
+                raise ValueError, 'Could not compile template "%s"' % names[0]
+        else:
+            template = PendingTemplate(self, names[0], templateeng, template,
+                                       record, self._templateCacheKey)
+
         for name in names:
             self[name] = template
 
@@ -483,6 +995,9 @@ class PageTemplate(BaseRenderer):
         """
         Parse templates from the file and set them in the renderer
 
+        If the template cache has an entry for the file, the templates 
+        compiled by a previous run are set instead.
+
         Required Arguments:
         filename -- file to parse templates from
 
@@ -491,6 +1006,50 @@ class PageTemplate(BaseRenderer):
             in the file
 
         """
+        self._templateFiles += 1
+        if self._templateCache is None:
+            self.readTemplates(filename, options)
+            return
+
+        key = repr((os.path.abspath(filename), sorted(options.items())))
+        stamp = self.templateCacheStamp(filename)
+        try:
+            entry = self._templateCache.get(key)
+        except Exception:
+            entry = None
+        self._templateCacheKey = key
+        try:
+            if entry is not None and entry[0] == stamp:
+                self._templateCacheHits += 1
+                self._templateCacheEntries[key] = entry
+                for record in entry[1]:
+                    self.setTemplate(record[0], record[1], record)
+                return
+
+            entry = (stamp, [])
+            self._templateRecord = entry[1]
+            if self.readTemplates(filename, options):
+                self._templateCacheEntries[key] = entry
+                self._templateCacheDirty.add(key)
+        finally:
+            self._templateRecord = None
+            self._templateCacheKey = None
+
+    def readTemplates(self, filename, options={}):
+        """
+        Read templates from the file and set them in the renderer
+
+        Required Arguments:
+        filename -- file to parse templates from
+
+        Keyword Arguments:
+        options -- dictionary containing initial parameters for templates
+            in the file
+
+        Returns: False if any of the templates could not be set
+
+        """
+        ok = True
         template = []
         options = options.copy()
         defaults = {}
@@ -507,6 +1066,7 @@ class PageTemplate(BaseRenderer):
                             self.setTemplate(''.join(template), options)
                         except ValueError, msg:
                             print 'ERROR: %s at line %s in file %s' % (msg, i, filename)
+                            ok = False
                         options = defaults.copy()
                         template = []
     
@@ -544,14 +1104,16 @@ class PageTemplate(BaseRenderer):
                 self.setTemplate(''.join(template), options)
             except ValueError, msg:
                 print 'ERROR: %s in template %s in file %s' % (msg, ''.join(template), filename)
+                ok = False
 
         elif name and not(template):
             self.setTemplate('', options)
 
+        return ok
+
     def processFileContent(self, document, s):
         # Add width, height, and depth to images
-        s = re.sub(r'&amp;(\S+)-(width|height|depth);(?:&amp;([a-z]+);)?', 
-                   self.setImageData, s) 
+        s = IMAGE_DATA.sub(self.setImageData, s) 
 
         # Convert characters >127 to entities
         if document.config['files']['escape-high-chars']:
@@ -562,6 +1124,18 @@ class PageTemplate(BaseRenderer):
             s = u''.join(s)
 
         return BaseRenderer.processFileContent(self, document, s)
+
+    def processFileChunks(self, document, chunks):
+        escape = document.config['files']['escape-high-chars']
+        for s in splitAtWhitespace(chunks):
+            s = IMAGE_DATA.sub(self.setImageData, s)
+            if escape:
+                s = list(s)
+                for i, item in enumerate(s):
+                    if ord(item) > 127:
+                        s[i] = '&#%.3d;' % ord(item)
+                s = u''.join(s)
+            yield s
              
     def setImageData(self, m):
         """
@@ -584,7 +1158,7 @@ class PageTemplate(BaseRenderer):
         filename, parameter, units = m.group(1), m.group(2), m.group(3)
 
         try:
-            img = self.imager.images.get(filename, self.vectorImager.images.get(filename, self.imager.staticimages.get(filename)))
+            img = self.imager.images.get(filename, self.vectorImager.images.get(filename, self.imager.staticfiles.get(filename)))
             if img is not None and getattr(img, parameter) is not None:
                 if units:
                     return getattr(getattr(img, parameter), units)
@@ -442,6 +442,9 @@ class TemplateInterpreter:
 						# THIS IS NOT A BUG!
 						# Use Unicode in the Context object if you are not using Ascii
                                                 self.file.write (contentType (unicode (resultVal, 'ascii')))
+					elif (contentType is structureContent and hasattr (self.file, 'writeContent')):
+						# The output renders objects itself (plasTeX's stream-output option)
+						self.file.writeContent (resultVal)
 					else:
 						# THIS IS NOT A BUG!
 						# Use Unicode in the Context object if you are not using Ascii
@@ -732,8 +735,15 @@ class XMLTemplate (Template):
 			encodingFile.write ('\n')
 		self.expandInline (context, encodingFile, interpreter)
 	
+def structureContent (x):
+	return x
+
+def strippedContent (x):
+	return re.sub(r'</?\w+[^>]*>', r'', x)
+
 class TemplateCompiler:
-        structureFlag = lambda self, x:x
+        # Module level functions, so compiled templates can be pickled
+        structureFlag = staticmethod (structureContent)
 	def __init__ (self):
 		""" Initialise a template compiler.
 		"""
@@ -746,8 +756,8 @@ class TemplateCompiler:
                 self.contentType = {}
                 self.contentType ['text'] = 0
                 self.contentType ['escape'] = 0
-                self.contentType ['structure'] = lambda x: x
-                self.contentType ['stripped'] = lambda x: re.sub(r'</?\w+[^>]*>', r'', x)
+                self.contentType ['structure'] = structureContent
+                self.contentType ['stripped'] = strippedContent
 
 		self.commandHandler  = {}
 		self.commandHandler [TAL_DEFINE] = self.compileCmdDefine
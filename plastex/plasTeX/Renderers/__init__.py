@@ -1,10 +1,12 @@
 #!/usr/bin/env python
 
-import codecs, os, shutil, string
+import codecs, os, re, shutil, string, multiprocessing, tempfile
+import plasTeX
 from plasTeX.Filenames import Filenames
 from plasTeX.DOM import Node
 from plasTeX.Logging import getLogger
-from plasTeX.Imagers import Image, PILImage
+from plasTeX.Imagers import Image, PILImage, closeImagers, cpu_count, \
+     replaceFile
 
 log = getLogger()
 status = getLogger('status')
@@ -108,99 +110,7 @@ class Renderable(object):
         else:
             childNodes = self.childNodes
 
-        # Render all child nodes
-        s = []
-        for child in childNodes:
-
-            # Short circuit text nodes
-            if child.nodeType == Node.TEXT_NODE:
-                s.append(r.textDefault(child))
-                continue
-
-            # Short circuit macros that have unicode equivalents
-            uni = child.unicode
-            if uni is not None:
-                s.append(r.textDefault(uni))
-                continue
-
-            layouts, names = [], []
-            nodeName = child.nodeName
-            modifier = None
-
-            # Does the macro have a modifier (i.e. '*')
-            if child.attributes:
-                modifier = child.attributes.get('*modifier*')
-
-            if child.filename:
-            
-                # Force footnotes to be cached
-                if hasattr(child, 'footnotes'):
-                    child.footnotes
-
-                status.info(' [ %s ', child.filename)
-
-                # Filename and modifier
-                if modifier:
-                    layouts.append('%s-layout%s' % (nodeName, modifier))
-
-                # Filename only
-                layouts.append('%s-layout' % nodeName)
-
-            # Modifier only
-            if modifier:
-                names.append('%s%s' % (nodeName, modifier))
-
-            names.append(nodeName)
-            layouts.append('default-layout')
-
-            # Locate the rendering callable, and call it with the 
-            # current object (i.e. `child`) as its argument.
-            func = r.find(names, r.default)
-            val = func(child)
-
-            # If a plain string is returned, we have no idea what 
-            # the encoding is, but we'll make a guess.
-            if type(val) is not unicode:
-                log.warning('The renderer for %s returned a non-unicode string.  Using the default input encoding.' % type(child).__name__)
-                val = unicode(val, child.config['files']['input-encoding'])
-
-            # If the content should go to a file, write it and go
-            # to the next child.
-            if child.filename:
-                filename = child.filename
-
-                # Create any directories as needed
-                directory = os.path.dirname(filename)
-                if directory and not os.path.isdir(directory):
-                    os.makedirs(directory)
-
-                # Add the layout wrapper if there is one
-                func = r.find(layouts)
-                if func is not None:
-                    val = func(StaticNode(child, val))
-
-                    # If a plain string is returned, we have no idea what 
-                    # the encoding is, but we'll make a guess.
-                    if type(val) is not unicode:
-                        log.warning('The renderer for %s returned a non-unicode string.  Using the default input encoding.' % type(child).__name__)
-                        val = unicode(val, child.config['files']['input-encoding'])
-
-                # Write the file content
-                codecs.open(filename, 'w', 
-                            child.config['files']['output-encoding'],
-                            errors=r.encodingErrors).write(val)
-
-                status.info(' ] ')
-
-                continue
-
-            # Append the resultant unicode object to the output
-            s.append(val)
-
-#       if self.filename:
-#           status.info(' ] ')
-
-        return r.outputType(u''.join(s))
+        return r.renderNodes(childNodes)
 
     def __str__(self):
         return unicode(self)
@@ -341,6 +251,20 @@ class Renderer(dict):
         # Names of generated files
         self.files = {}
 
+        # Rendering callables and layouts found for each (nodeName,
+        # modifier) pair
+        self.renderers = {}
+        self.layouts = {}
+
+        # Python ids of the nodes whose files are rendered by worker
+        # processes (see startWorkers)
+        self.delegated = set()
+
+        # Content of generated files that haven't been written yet.
+        # While rendering, files are held here so that cleanup() can
+        # post-process them and write each one once.
+        self.fileContents = None
+
         # Instantiated at render time
         self.imager = None
         self.vectorImager = None
@@ -395,6 +319,14 @@ class Renderer(dict):
                                      {'jobname':document.userdata.get('jobname', '')}, self.fileExtension)
 
         self.cacheFilenames(document)
+        stream = config['files']['stream-output']
+        if stream:
+            self.fileContents = None
+        else:
+            self.fileContents = {}
+        self.renderers = {}
+        self.layouts = {}
+        self.delegated = set()
 
         # Instantiate appropriate imager
         names = [x for x in config['images']['imager'].split() if x]
@@ -465,22 +397,31 @@ class Renderer(dict):
         if self.imageUnits and not self.vectorImager.imageUnits:
             self.vectorImager.imageUnits = self.imageUnits
 
-        # Invoke the rendering process
-        if type(self).renderMethod:
-            getattr(document, type(self).renderMethod)()
-        else:
-            unicode(document)
+        try:
+            # Invoke the rendering process
+            files = []
+            if type(self).renderMethod:
+                getattr(document, type(self).renderMethod)()
+            elif stream:
+                self.streamContent(document, StreamOutput())
+            else:
+                workers = self.startWorkers(document)
+                unicode(document)
+                files = self.finishWorkers(workers)
+
+            # Finish rendering images
+            status.info('Rendering images.  This may take a long time...')
+            closeImagers([self.imager, self.vectorImager])
+            status.info('Imagers done.')
 
-        # Finish rendering images
-        status.info('Rendering images.  This may take a long time...')
-        self.imager.close()
-        status.info('Imager done.')
-        self.vectorImager.close()
-        status.info('vectorImager done.')
+            # Run any cleanup activities
+            status.info('Postprocessing...')
+            files = self.files.values() + files
+            self.cleanup(document, files, postProcess=postProcess)
 
-        # Run any cleanup activities
-        status.info('Postprocessing...')
-        self.cleanup(document, self.files.values(), postProcess=postProcess)
+        finally:
+            # Don't lose the rendered files if anything above failed
+            self.writeFileContents(document)
 
         # Write out auxilliary information
         pauxname = os.path.join(document.userdata.get('working-dir','.'), 
@@ -492,9 +433,199 @@ class Renderer(dict):
         del Node.renderer
         unmix(Node, type(self).renderableClass)
 
+    def startWorkers(self, document):
+        """
+        Start the processes that render the files of a document in parallel
+
+        When the split-workers option asks for more than one process,
+        the files that are split off the top-level files (chapters,
+        for example) are divided among worker processes, which get a
+        copy of the parsed document when they are forked.  This 
+        process still renders the top-level files, and leaves the 
+        delegated ones out.
+
+        Every node is given its generated id beforehand, so that the
+        links between files rendered by different processes agree.
+
+        Required Arguments:
+        document -- the document being rendered
+
+        Returns:
+        list of (process, connection, units) tuples, which should be
+        passed to finishWorkers once the document has been rendered
+
+        """
+        workers = document.config['files']['split-workers'] or cpu_count()
+        if workers < 2 or not hasattr(os, 'fork'):
+            return []
+
+        units = []
+        top = [x for x in document.childNodes if x.level == Node.DOCUMENT_LEVEL]
+        for node in fileNodes(top):
+            units.extend(fileNodes(node.childNodes))
+        if len(units) < 2:
+            return []
+
+        # Divide the units among the workers by their number of nodes,
+        # largest first
+        sizes = dict.fromkeys([id(x) for x in units], 0)
+        generateIds(document, sizes)
+        loads = [(0, i, []) for i in range(min(workers, len(units)))]
+        order = sorted(range(len(units)), key=lambda i: -sizes[id(units[i])])
+        for index in order:
+            size, i, assigned = min(loads)
+            assigned.append(index)
+            loads[i] = (size + sizes[id(units[index])], i, assigned)
+
+        # Each unit generates the ids of the nodes created while it is
+        # rendered from a range of its own
+        start = int(plasTeX.idgen.next()[1:])
+        units = [(i, x, start + (i + 1) * UNIT_IDS) for i, x in enumerate(units)]
+
+        result = []
+        for size, i, assigned in loads:
+            assigned = [units[x] for x in sorted(assigned)]
+            receiver, sender = multiprocessing.Pipe(False)
+            child = multiprocessing.Process(target=renderUnits, 
+                                            args=(self, assigned, sender))
+            child.start()
+            sender.close()
+            result.append((child, receiver, assigned))
+            self.delegated.update([id(x[1]) for x in assigned])
+
+        log.info('Rendering %d files in %d processes', len(units), len(result))
+        return result
+
+    def finishWorkers(self, workers):
+        """
+        Collect the files rendered by the processes of startWorkers
+
+        The images requested by the workers are added to this process's
+        imagers in document order, so each image is still generated 
+        once, and the temporary image filenames in the files are 
+        replaced by the final ones.  The units of a worker that failed
+        are rendered here instead.
+
+        Required Arguments:
+        workers -- the list returned by startWorkers
+
+        Returns:
+        list of the files that only the workers know about
+
+        """
+        if not workers:
+            return []
+
+        results = []
+        for child, receiver, units in workers:
+            try:
+                result = receiver.recv()
+            except EOFError:
+                result = None
+            receiver.close()
+            child.join()
+            if result is None:
+                log.warning('A worker process failed, rendering its files again')
+                self.delegated.difference_update([id(x[1]) for x in units])
+                for index, node, start in units:
+                    self.renderNodes([node])
+                continue
+            results.extend(result)
+
+        imagers = [self.imager, self.vectorImager]
+        filenames = {}
+        contents = {}
+        for index, files, requests in sorted(results):
+            for imager, imagerRequests in zip(imagers, requests):
+                for temp, final in imager.addImages(imagerRequests).items():
+                    filenames[os.path.splitext(temp)[0]] = \
+                        os.path.splitext(final)[0]
+            contents.update(files)
+
+        def replace(m):
+            return filenames.get(m.group(), m.group())
+
+        for filename, s in contents.items():
+            if filenames:
+                s = TEMP_IMAGE.sub(replace, s)
+            self.fileContents[filename] = s
+
+        known = set(self.files.values())
+        return [x for x in sorted(contents) if x not in known]
+
+    def writeFileContents(self, document):
+        """ Write the files that are still held in memory as they are """
+        contents, self.fileContents = self.fileContents or {}, None
+        encoding = document.config['files']['output-encoding']
+        for f, s in contents.items():
+            codecs.open(f, 'w', encoding, errors=self.encodingErrors).write(s)
+
     def processFileContent(self, document, s):
         return s
 
+    def processFileChunks(self, document, chunks):
+        """
+        Post-process the content of a file a piece at a time
+
+        This is the counterpart of processFileContent for files that
+        are too large to be held in memory at once.  It is only used
+        when the class that defines processFileContent defines it
+        too, so a subclass that only overrides processFileContent
+        gets the whole content as before.  It may raise WholeFileNeeded
+        to ask for that anyway.
+
+        Required Arguments:
+        document -- the document being rendered
+        chunks -- iterator of unicode strings with the content of 
+            the file
+
+        Returns:
+        iterator of unicode strings with the new content of the file
+
+        """
+        return chunks
+
+    def processFile(self, document, filename):
+        """
+        Post-process a file on disk with processFileChunks
+
+        The new content is written to a temporary file next to the
+        file, which replaces it at the end, so the file is never held
+        in memory at once.
+
+        Required Arguments:
+        document -- the document being rendered
+        filename -- the name of the file
+
+        Returns:
+        False if the file has to be processed all at once instead (it
+        is left as it was)
+
+        """
+        encoding = document.config['files']['output-encoding']
+        directory, name = os.path.split(filename)
+        temp = os.path.join(directory, '.' + name)
+        source = codecs.open(filename, 'r', encoding, errors=self.encodingErrors)
+        try:
+            output = codecs.open(temp, 'w', encoding, errors=self.encodingErrors)
+            try:
+                chunks = iter(lambda: source.read(CHUNK_SIZE), u'')
+                for s in self.processFileChunks(document, chunks):
+                    output.write(s)
+            finally:
+                output.close()
+        except WholeFileNeeded:
+            os.remove(temp)
+            return False
+        except:
+            if os.path.exists(temp):
+                os.remove(temp)
+            raise
+        finally:
+            source.close()
+        replaceFile(temp, filename)
+        return True
+
     def cleanup(self, document, files, postProcess=None):
         """ 
         Cleanup method called at the end of rendering 
@@ -505,6 +636,12 @@ class Renderer(dict):
         Note: While I greatly dislike post-processing, sometimes it's 
               just easier...
 
+        The files rendered by `render' are kept in memory until this
+        method is called, so it writes each of them exactly once
+        (unless the stream-output option wrote them as they were
+        rendered).
+        Subclasses that override it must call it.
+
         Required Arguments:
         document -- the document being rendered
         files -- the list of filenames that were generated
@@ -516,25 +653,304 @@ class Renderer(dict):
             It must return a unicode object.
 
         """
-        if self.processFileContent is Renderer.processFileContent:
-            return 
+        contents, self.fileContents = self.fileContents or {}, None
+        process = type(self).processFileContent != Renderer.processFileContent
+
+        # Files on disk (streamed ones, for example) are processed a
+        # piece at a time if processFileChunks does everything that
+        # processFileContent does
+        chunked = process and not callable(postProcess) and \
+            definingClass(type(self), 'processFileChunks') is \
+            definingClass(type(self), 'processFileContent')
 
         encoding = document.config['files']['output-encoding']
 
         for f in files:
-            try:
-                s = codecs.open(str(f), 'r', encoding, 
-                                errors=self.encodingErrors).read()
-            except IOError, msg:
-                log.error(msg)
+            # Files rendered by this renderer are still in memory;
+            # anything else has to be read back in
+            s = contents.pop(f, None)
+            if s is None:
+                if not process:
+                    continue
+                try:
+                    if chunked and self.processFile(document, str(f)):
+                        continue
+                    s = codecs.open(str(f), 'r', encoding, 
+                                    errors=self.encodingErrors).read()
+                except IOError, msg:
+                    log.error(msg)
+                    continue
+
+            if process:
+                s = self.processFileContent(document, s)
+
+                if callable(postProcess):
+                    s = postProcess(document, s)
+
+            codecs.open(f, 'w', encoding, 
+                        errors=self.encodingErrors).write(u''.join(s))
+
+    def renderNodes(self, nodes):
+        """
+        Render a list of nodes
+
+        The nodes that generate files are written to their files (or
+        kept in `fileContents'), and the rest are concatenated.
+
+        Required Arguments:
+        nodes -- list of the nodes to render
+
+        Returns:
+        the rendered nodes that don't have files of their own
+
+        """
+        s = []
+        for child in nodes:
+
+            # Short circuit text nodes
+            if child.nodeType == Node.TEXT_NODE:
+                s.append(self.textDefault(child))
+                continue
+
+            # Short circuit macros that have unicode equivalents
+            uni = child.unicode
+            if uni is not None:
+                s.append(self.textDefault(uni))
+                continue
+
+            nodeName = child.nodeName
+            modifier = None
+
+            # Does the macro have a modifier (i.e. '*')
+            if child.attributes:
+                modifier = child.attributes.get('*modifier*')
+
+            filename = child.filename
+            if filename:
+
+                # Leave the files rendered by worker processes alone
+                if id(child) in self.delegated:
+                    continue
+            
+                # Force footnotes to be cached
+                if hasattr(child, 'footnotes'):
+                    child.footnotes
+
+                status.info(' [ %s ', filename)
+
+            # Locate the rendering callable, and call it with the 
+            # current object (i.e. `child`) as its argument.
+            func = self.findRenderer(nodeName, modifier)
+            val = func(child)
+
+            # If a plain string is returned, we have no idea what 
+            # the encoding is, but we'll make a guess.
+            if type(val) is not unicode:
+                log.warning('The renderer for %s returned a non-unicode string.  Using the default input encoding.' % type(child).__name__)
+                val = unicode(val, child.config['files']['input-encoding'])
+
+            # If the content should go to a file, write it and go
+            # to the next child.
+            if filename:
+
+                # Create any directories as needed
+                directory = os.path.dirname(filename)
+                if directory and not os.path.isdir(directory):
+                    os.makedirs(directory)
+
+                # Add the layout wrapper if there is one
+                func = self.findLayout(nodeName, modifier)
+                if func is not None:
+                    val = func(StaticNode(child, val))
+
+                    # If a plain string is returned, we have no idea what 
+                    # the encoding is, but we'll make a guess.
+                    if type(val) is not unicode:
+                        log.warning('The renderer for %s returned a non-unicode string.  Using the default input encoding.' % type(child).__name__)
+                        val = unicode(val, child.config['files']['input-encoding'])
+
+                # Keep the file content until it has been post-processed,
+                # or write it now if nothing is going to do that
+                if self.fileContents is not None:
+                    self.fileContents[filename] = val
+                else:
+                    codecs.open(filename, 'w', 
+                                child.config['files']['output-encoding'],
+                                errors=self.encodingErrors).write(val)
+
+                status.info(' ] ')
+
                 continue
 
-            s = self.processFileContent(document, s)
+            # Append the resultant unicode object to the output
+            s.append(val)
+
+        return self.outputType(u''.join(s))
+
+    def streamContent(self, node, output):
+        """
+        Render the content of a node into a stream
+
+        This is what unicode(node) does for nodes that don't have 
+        renderers of their own, for the stream-output option.
+
+        Required Arguments:
+        node -- the node to render
+        output -- the StreamOutput to write to
+
+        """
+        uni = node.unicode
+        if uni is not None: 
+            output.write(self.textDefault(uni))
+            return
+
+        if not node.hasChildNodes():
+            return
+
+        # At the very top level, only render the DOCUMENT_LEVEL node
+        if node.nodeType == Node.DOCUMENT_NODE:
+            childNodes = [x for x in node.childNodes 
+                            if x.level == Node.DOCUMENT_LEVEL]
+        else:
+            childNodes = node.childNodes
+
+        self.streamNodes(childNodes, output)
+
+    def streamNodes(self, nodes, output):
+        """
+        Render a list of nodes into a stream
+
+        This is renderNodes for the stream-output option.  Nothing is
+        returned: the nodes are written to `output' as they are 
+        rendered, and the nodes that generate files are written to 
+        their files.  The children of nodes that use the default
+        renderer are rendered from a stack of iterators rather than 
+        by recursion.
+
+        Required Arguments:
+        nodes -- list of the nodes to render
+        output -- the StreamOutput to write to
+
+        """
+        write = output.write
+        stack = [iter(nodes)]
+        while stack:
+            for child in stack[-1]:
+
+                # Short circuit text nodes
+                if child.nodeType == Node.TEXT_NODE:
+                    write(self.textDefault(child))
+                    continue
+
+                # Short circuit macros that have unicode equivalents
+                uni = child.unicode
+                if uni is not None:
+                    write(self.textDefault(uni))
+                    continue
+
+                nodeName = child.nodeName
+                modifier = None
+
+                # Does the macro have a modifier (i.e. '*')
+                if child.attributes:
+                    modifier = child.attributes.get('*modifier*')
+
+                filename = child.filename
+                if filename:
+                    self.streamFile(child, filename, nodeName, modifier)
+                    continue
+
+                func = self.findRenderer(nodeName, modifier)
+                if func is self.default and rendersChildren(child):
+                    if child.hasChildNodes():
+                        stack.append(iter(child.childNodes))
+                        break
+                    continue
+
+                self.streamRendered(func, child, output)
+
+            else:
+                stack.pop()
+
+    def streamRendered(self, func, node, output):
+        """
+        Render a node into a stream with a rendering callable
+
+        Callables that can write into a stream have a `stream' 
+        attribute, which is called with the node and the stream.
+        Other callables are called as usual and their result is written.
+
+        Required Arguments:
+        func -- the rendering callable
+        node -- the node to render
+        output -- the StreamOutput to write to
+
+        """
+        if func is self.default and rendersChildren(node):
+            self.streamContent(node, output)
+            return
 
-            if callable(postProcess):
-                s = postProcess(document, s)
+        stream = getattr(func, 'stream', None)
+        if stream is not None:
+            stream(node, output)
+            return
 
-            codecs.open(f, 'w', encoding).write(u''.join(s))
+        val = func(node)
+
+        # If a plain string is returned, we have no idea what 
+        # the encoding is, but we'll make a guess.
+        if type(val) is not unicode:
+            log.warning('The renderer for %s returned a non-unicode string.  Using the default input encoding.' % type(node).__name__)
+            val = unicode(val, node.config['files']['input-encoding'])
+
+        output.write(val)
+
+    def streamFile(self, node, filename, nodeName, modifier):
+        """
+        Render a node that generates a file straight into the file
+
+        When there is a layout, the content of the node is rendered
+        first (into a temporary file), as it is by renderNodes, and 
+        then the layout is rendered into the file with it.
+
+        Required Arguments:
+        node -- the node to render
+        filename -- the name of the file
+        nodeName -- the name of the node
+        modifier -- the node's modifier (e.g. '*'), if it has one
+
+        """
+        # Force footnotes to be cached
+        if hasattr(node, 'footnotes'):
+            node.footnotes
+
+        status.info(' [ %s ', filename)
+
+        # Create any directories as needed
+        directory = os.path.dirname(filename)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        func = self.findRenderer(nodeName, modifier)
+        layout = self.findLayout(nodeName, modifier)
+        output = codecs.open(filename, 'w', 
+                             node.config['files']['output-encoding'],
+                             errors=self.encodingErrors)
+        try:
+            if layout is None:
+                self.streamRendered(func, node, StreamOutput(output))
+            else:
+                spool = Spool()
+                try:
+                    self.streamRendered(func, node, StreamOutput(spool))
+                    self.streamRendered(layout, StaticNode(node, spool), 
+                                        StreamOutput(output))
+                finally:
+                    spool.close()
+        finally:
+            output.close()
+
+        status.info(' ] ')
 
     def find(self, keys, default=None):
         """
@@ -562,6 +978,230 @@ class Renderer(dict):
             self[key] = default
         return default
 
+    def findRenderer(self, nodeName, modifier=None):
+        """
+        Locate the renderer for a node
+
+        The renderer is looked up the first time it is needed for
+        each node name and modifier, and remembered after that.
+
+        Required Arguments:
+        nodeName -- name of the node
+
+        Keyword Arguments:
+        modifier -- the node's modifier (e.g. '*'), if it has one
+
+        Returns:
+        the requested renderer, or the default renderer
+
+        """
+        key = (nodeName, modifier)
+        try:
+            return self.renderers[key]
+        except KeyError:
+            pass
+        names = []
+        if modifier:
+            names.append('%s%s' % (nodeName, modifier))
+        names.append(nodeName)
+        func = self.renderers[key] = self.find(names, self.default)
+        return func
+
+    def findLayout(self, nodeName, modifier=None):
+        """
+        Locate the layout wrapped around a node that has its own file
+
+        Layouts are remembered the same way as renderers in findRenderer.
+
+        Returns:
+        the requested layout, or None if there isn't one
+
+        """
+        key = (nodeName, modifier)
+        try:
+            return self.layouts[key]
+        except KeyError:
+            pass
+        layouts = []
+        if modifier:
+            layouts.append('%s-layout%s' % (nodeName, modifier))
+        layouts.append('%s-layout' % nodeName)
+        layouts.append('default-layout')
+        func = self.layouts[key] = self.find(layouts)
+        return func
+
+
+
+# Number of ids reserved for the nodes created while rendering each
+# unit in a worker process
+UNIT_IDS = 1000000
+
+# Temporary filenames of the images requested by worker processes,
+# without their file extensions (see renderUnits)
+TEMP_IMAGE = re.compile(r'plasTeX-image-\d+-\d+-\d+')
+
+def fileNodes(nodes):
+    """ 
+    Return the nodes in `nodes' and their descendants that have 
+    filenames, without looking inside the nodes that have one 
+
+    """
+    result = []
+    for node in nodes:
+        if node.filename:
+            result.append(node)
+        else:
+            result.extend(fileNodes(node.childNodes))
+    return result
+
+def generateIds(node, sizes):
+    """
+    Generate the ids of a node and its descendants in document order
+
+    Required Arguments:
+    node -- the node to start at
+    sizes -- dictionary keyed by the Python ids of nodes; the number
+        of nodes in their subtrees is filled in
+
+    Returns:
+    the number of nodes in the subtree of `node'
+
+    """
+    if isinstance(node, plasTeX.Macro):
+        node.id
+    count = 1
+    attributes = getattr(node, 'attributes', None)
+    if attributes:
+        for value in attributes.values():
+            if isinstance(value, Node) and value.parentNode is node:
+                count += generateIds(value, sizes)
+    for child in node.childNodes:
+        count += generateIds(child, sizes)
+    if id(node) in sizes:
+        sizes[id(node)] = count
+    return count
+
+def renderUnits(renderer, units, connection):
+    """
+    Render some of the files of a document in a worker process, and
+    send them back through a pipe along with the images they need
+
+    New images get temporary filenames, because only the process
+    that owns the document knows the final ones (see
+    Renderer.finishWorkers).  None is sent if rendering fails.
+
+    Required Arguments:
+    renderer -- the renderer that started the worker
+    units -- list of (index, node, first generated id) tuples of the 
+        nodes to render
+    connection -- pipe to send the result through
+
+    """
+    try:
+        imagers = [renderer.imager, renderer.vectorImager]
+        renderer.delegated = set()
+        result = []
+        for index, node, start in units:
+            plasTeX.idgen = plasTeX.idgenerator(start)
+            for i, imager in enumerate(imagers):
+                imager.recordImages('plasTeX-image-%d-%d-' % (i, index))
+            renderer.fileContents = {}
+            renderer.renderNodes([node])
+            result.append((index, renderer.fileContents, 
+                           [x.requests for x in imagers]))
+    except Exception:
+        log.exception('Could not render files in a worker process')
+        result = None
+    connection.send(result)
+    connection.close()
+
+# Number of characters read at a time from files that are 
+# post-processed a piece at a time, or copied from a Spool
+CHUNK_SIZE = 65536
+
+class WholeFileNeeded(Exception):
+    """ Raised by processFileChunks when it can't process a file in pieces """
+
+def definingClass(cls, name):
+    """ Return the class in the MRO of `cls' that defines `name' """
+    for base in cls.__mro__:
+        if name in vars(base):
+            return base
+
+def rendersChildren(node):
+    """ 
+    Return whether unicode(node) just renders the node's children, 
+    as Renderable.__unicode__ does
+
+    """
+    return getattr(type(node).__unicode__, 'im_func', None) is \
+        vars(Renderable)['__unicode__']
+
+
+class StreamOutput(object):
+    """
+    Stream that nodes are rendered into for the stream-output option
+
+    Renderers write unicode strings to it.  Templates that insert 
+    the content of an object call writeContent, so that the content
+    of nodes is rendered straight into the stream instead of being
+    converted to a string first.
+
+    """
+    def __init__(self, file=None):
+        """
+        Initialize the stream
+
+        Keyword Arguments:
+        file -- file object to write to (the output is discarded 
+            if this is None)
+
+        """
+        if file is None:
+            self.write = lambda s: None
+        else:
+            self.write = file.write
+
+    def writeContent(self, value):
+        """ Write the content of `value', as unicode(value) would be """
+        cls = type(value)
+        if cls is StaticNode:
+            content = object.__getattribute__(value, '_node_data')[1]
+            if type(content) is Spool:
+                content.copy(self)
+            else:
+                self.write(content)
+        elif issubclass(cls, Node) and rendersChildren(value):
+            Node.renderer.streamContent(value, self)
+        else:
+            self.write(unicode(value))
+
+
+class Spool(object):
+    """
+    Temporary file that holds the rendered content of a node
+
+    When a node is streamed into a file with a layout, its content
+    is kept here until the layout inserts it (see Renderer.streamFile).
+
+    """
+    def __init__(self):
+        self.file = tempfile.TemporaryFile()
+        self.write = codecs.getwriter('utf-8')(self.file).write
+
+    def copy(self, output):
+        """ Write the content to the StreamOutput `output' """
+        self.file.seek(0)
+        reader = codecs.getreader('utf-8')(self.file)
+        for s in iter(lambda: reader.read(CHUNK_SIZE), u''):
+            output.write(s)
+
+    def close(self):
+        self.file.close()
+
+    def __unicode__(self):
+        self.file.seek(0)
+        return self.file.read().decode('utf-8')
 
 
 class StaticNode(object):
@@ -588,7 +1228,8 @@ class StaticNode(object):
         Arguments:
         obj -- the object that contains navigation and table of 
             contents information
-        content -- the rendered object in a unicode string
+        content -- the rendered object in a unicode string (or a 
+            Spool, when the document is streamed)
 
         """
         self._node_data = (obj, content)
@@ -597,7 +1238,7 @@ class StaticNode(object):
             return object.__getattribute__(self, name)
         return getattr(self._node_data[0], name)
     def __unicode__(self):
-        return self._node_data[1]
+        return unicode(self._node_data[1])
     def __str__(self):
         return unicode(self)
 
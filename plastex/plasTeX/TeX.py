@@ -23,6 +23,7 @@ from plasTeX.Base.TeX.Primitives import MathShift
 from plasTeX import ParameterCommand, Macro
 from plasTeX import glue, muglue, mudimen, dimen, number
 from plasTeX.Logging import getLogger, disableLogging
+from plasTeX.Kpsewhich import FileFinder
 
 # Only export the TeX class
 __all__ = ['TeX']
@@ -71,6 +72,9 @@ class TeX(object):
         # Auxiliary files loaded
         self.auxFiles = []
 
+        # Locates files for kpsewhich()
+        self.fileFinder = None
+
         # TeX arguments types and their casting functions
         self.argtypes = {
             'url': (self.castNone, {'#':12,'~':12}),
@@ -1325,36 +1329,22 @@ class TeX(object):
 
         """
         # When, for example, ``\Input{name}`` is encountered, we should look in
-        # the directory containing the file being processed. So the following
-        # code adds the directory to the start of $TEXINPUTS.
-        TEXINPUTS = None
+        # the directory containing the file being processed. So the 
+        # directory is searched before $TEXINPUTS.
+        srcDir = None
         try:
             srcDir = os.path.dirname(self.filename)
         except AttributeError:
             # I think this happens only for the command line file.
             pass
-        else:
-            TEXINPUTS = os.environ.get("TEXINPUTS",'')
-            os.environ["TEXINPUTS"] = "%s%s%s%s" % (srcDir, os.path.pathsep, TEXINPUTS, os.path.pathsep)
-
-        try:
-            program = self.ownerDocument.config['general']['kpsewhich']
 
-            kwargs = {'stdout':subprocess.PIPE}
-            if sys.platform.lower().startswith('win'):
-                kwargs['shell'] = True
-
-            output = subprocess.Popen([program, name], **kwargs).communicate()[0].strip()
-            if output:
-                return output
-
-        except:
-            pass
+        program = self.ownerDocument.config['general']['kpsewhich']
+        if self.fileFinder is None or self.fileFinder.program != program:
+            self.fileFinder = FileFinder(program)
 
-        finally:
-            # Undo any mods to $TEXINPUTS.
-            if TEXINPUTS:
-                os.environ["TEXINPUTS"] = TEXINPUTS
+        path = self.fileFinder.find(name, srcDir)
+        if path:
+            return path
 
         raise OSError, 'Could not find any file named: %s' % name
 
@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
-import string
+import re, string
+from collections import deque
 from DOM import Node, Text
 from StringIO import StringIO as UnicodeStringIO
 try: from cStringIO import StringIO
@@ -34,6 +35,47 @@ DEFAULT_CATEGORIES = [
 VERBATIM_CATEGORIES = [''] * 16
 VERBATIM_CATEGORIES[11] = string.letters
 
+# Number of characters to read from the source at a time
+CHUNK_SIZE = 65536
+
+_runPatterns = {}
+
+def runPatterns(codes):
+    """
+    Return regular expressions for runs of characters in a category table
+
+    Required Arguments:
+    codes -- dictionary mapping characters to category codes, as made
+        by Context.codeTable
+
+    Returns:
+    three-element tuple.  The first element is the match method of a 
+    regular expression for a run of letter and other characters (never
+    including a newline), the second the match method of one for a run
+    of letters, and the third a dictionary mapping each letter to 
+    the Letter class.
+
+    """
+    entry = _runPatterns.get(id(codes))
+    if entry is None or entry[0] is not codes:
+        letters = []
+        specials = [u'\n']
+        for char, code in codes.items():
+            if code == Token.CC_LETTER:
+                letters.append(char)
+            elif code != Token.CC_OTHER:
+                specials.append(char)
+        classes = dict.fromkeys(letters, Letter)
+        run = re.compile(u'[^%s]+' % u''.join([re.escape(x) for x in specials]))
+        if letters:
+            word = re.compile(u'[%s]+' % u''.join([re.escape(x) for x in letters]))
+        else:
+            word = re.compile(u'(?!)')
+        # Keep a reference to the table so that its id stays unique
+        entry = _runPatterns[id(codes)] = (codes, run.match, word.match, classes)
+    return entry[1:]
+
+
 class Token(Text):
     """ Base class for all TeX tokens """
 
@@ -202,8 +244,8 @@ class Tokenizer(object):
         """
         self.context = context
         self.state = Tokenizer.STATE_N
-        self._charBuffer = []
-        self._tokBuffer = []
+        self._charBuffer = deque()
+        self._tokBuffer = deque()
         if isinstance(source, unicode):
             source = UnicodeStringIO(source)
             self.filename = '<string>'
@@ -216,23 +258,60 @@ class Tokenizer(object):
             self.filename = '<tokens>'
         else:
             self.filename = source.name
-        self.seek = source.seek
         self.read = source.read
-#       self.readline = source.readline
-        self.tell = source.tell
         self.lineNumber = 1
 
-# There seems to be a problem with readline in Python 2.4 !!!
+        # The source is read CHUNK_SIZE characters at a time into
+        # _text, and _pos is the index of the next unread character
+        self._text = ''
+        self._pos = 0
+
+    def fill(self):
+        """
+        Read the next chunk of the source
+
+        Returns:
+        False if the source is exhausted, True otherwise
+
+        """
+        chunk = self.read(CHUNK_SIZE)
+        if not chunk:
+            return False
+        self._text = self._text[self._pos:] + chunk
+        self._pos = 0
+        return True
+
+    def readchar(self):
+        """
+        Read the next raw character, from the buffer or the source
+
+        Returns:
+        the character, or an empty string at the end of the source
+
+        """
+        if self._charBuffer:
+            return self._charBuffer.popleft()
+        while self._pos >= len(self._text):
+            if not self.fill():
+                return ''
+        char = self._text[self._pos]
+        self._pos += 1
+        return char
+
     def readline(self):
-        read = self.read
+        """ Skip the rest of the current line """
         buffer = self._charBuffer
+        while buffer:
+            if ord(buffer.popleft()) == 10:
+                return
         while 1:
-            if buffer:
-                char = buffer.pop(0)
-            else:
-                char = read(1)
-            if not char or ord(char) == 10:
-                break
+            end = self._text.find('\n', self._pos)
+            if end >= 0:
+                self._pos = end + 1
+                return
+            self._pos = len(self._text)
+            if not self.fill():
+                return
 
     def iterchars(self):
         """ 
@@ -249,53 +328,56 @@ class Tokenizer(object):
         """
         # Create locals before going into the generator loop
         buffer = self._charBuffer
+        popleft = buffer.popleft
         classes = self.tokenClasses
-        read = self.read
-        seek = self.seek
-        whichCode = self.context.whichCode
+        fill = self.fill
+        readchar = self.readchar
+        context = self.context
+        CC_OTHER = Token.CC_OTHER
         CC_SUPER = Token.CC_SUPER
         CC_IGNORED = Token.CC_IGNORED
         CC_INVALID = Token.CC_INVALID
 
         while 1:
             if buffer:
-                token = buffer.pop(0)
+                token = popleft()
             else:
-                token = read(1)
-
-            if not token:
-                break
-
-            if len(token) > 1:
-                if not hasattr(self, 'already_warned'):
-                    log.warning('Multi-character token: %s', token)
-                    log.warning('This probably means you have non-ASCII')
-                    log.warning(' characters in the input file (like Mac')
-                    log.warning('smart quotes and apostrophes).')
-                    self.already_warned = True
-                token = token[-1]
+                # The position is kept on the instance rather than in
+                # a local since readline() and other iterators over
+                # this tokenizer move it too.  Indexing the chunk 
+                # always gives a single character, even for non-ASCII
+                # input.
+                pos = self._pos
+                try:
+                    token = self._text[pos]
+                except IndexError:
+                    if fill():
+                        continue
+                    break
+                self._pos = pos + 1
 
             # ord(token) == 10 is the same as saying token == '\n'
             # but it is much faster.
             if ord(token) == 10:
                 self.lineNumber += 1
 
-            code = whichCode(token)
+            # Inlined context.whichCode(token)
+            code = context.codes.get(token, CC_OTHER)
 
             if code == CC_SUPER:
 
                 # Handle characters like ^^M, ^^@, etc.
-                char = read(1)
+                char = readchar()
 
                 if char == token:
-                    char = read(1)
+                    char = readchar()
                     num = ord(char)
                     if num >= 64: token = chr(num-64)
                     else: token = chr(num+64)
-                    code = whichCode(token)
+                    code = context.codes.get(token, CC_OTHER)
 
-                else:
-                    seek(-1,1)
+                elif char:
+                    buffer.appendleft(char)
 
             # Just go to the next character if you see one of these...
             if code == CC_IGNORED or code == CC_INVALID:
@@ -311,7 +393,7 @@ class Tokenizer(object):
         char -- the character to push back
 
         """
-        self._charBuffer.insert(0, char)
+        self._charBuffer.appendleft(char)
 
     def pushToken(self, token):
         """
@@ -322,7 +404,7 @@ class Tokenizer(object):
 
         """
         if token is not None:
-            self._tokBuffer.insert(0, token)
+            self._tokBuffer.appendleft(token)
 
     def pushTokens(self, tokens):
         """
@@ -333,10 +415,9 @@ class Tokenizer(object):
 
         """
         if tokens:
-            tokens = list(tokens)
-            tokens.reverse()
-            for t in tokens:
-                self.pushToken(t)
+            # extendleft() reverses, so reverse them first
+            self._tokBuffer.extendleft([t for t in tokens
+                                        if t is not None][::-1])
 
     def __iter__(self):
         """ 
@@ -351,6 +432,8 @@ class Tokenizer(object):
         Space = Space
         EscapeSequence = EscapeSequence
         buffer = self._tokBuffer
+        charBuffer = self._charBuffer
+        classes = self.tokenClasses
         charIter = self.iterchars()
         next = charIter.next
         context = self.context
@@ -368,12 +451,49 @@ class Tokenizer(object):
         CC_COMMENT = Token.CC_COMMENT
         CC_ACTIVE = Token.CC_ACTIVE
         prev = None
+        tryRun = True
+        runCodes = None
 
         while 1:
 
             # Purge buffer first
             while buffer:
-                yield buffer.pop(0)
+                yield buffer.popleft()
+
+            # Fast path for runs of letters and other characters.  These
+            # don't change the state machine, so they can be sliced out
+            # of the source in one go.  After each token, make sure 
+            # that nobody has pushed anything back, read characters
+            # behind our back, or changed the category codes; if they
+            # have, go back to the general case.
+            # There is no point trying right after a run, since a run
+            # only stops at a character that can't be in one.
+            if tryRun and not charBuffer:
+                codes = context.codes
+                if codes is not runCodes:
+                    runCodes = codes
+                    runMatch, wordMatch, runClasses = runPatterns(codes)
+                    getClass = runClasses.get
+                text = self._text
+                pos = self._pos
+                match = runMatch(text, pos)
+                if match is not None:
+                    end = match.end()
+                    self.state = STATE_M
+                    while pos < end:
+                        char = text[pos]
+                        pos += 1
+                        self._pos = pos
+                        prev = token = getClass(char, Other)(char)
+                        yield token
+                        if buffer or charBuffer or self._pos != pos or \
+                           context.codes is not codes or self._text is not text:
+                            break
+                    else:
+                        tryRun = False
+                    continue
+
+            tryRun = True
 
             # Get the next character
             token = next()
@@ -422,26 +542,48 @@ class Tokenizer(object):
                 # Get name of command sequence
                 self.state = STATE_M
 
-                for token in charIter:
- 
-                    if token.catcode == CC_LETTER:
-                        word = [token]
-                        for t in charIter:
-                            if t.catcode == CC_LETTER:
-                                word.append(t) 
-                            else:
-                                pushChar(t)
-                                break
-                        token = EscapeSequence(''.join(word))
-
-                    elif token.catcode == CC_EOL:
-                        #pushChar(token)
-                        #token = EscapeSequence()
-                        token = Space(' ')
+                # Fast path for names made of letters
+                match = None
+                if not charBuffer:
+                    match = runPatterns(context.codes)[1](self._text, self._pos)
+
+                if match is not None:
+                    self._pos = match.end()
+                    word = [match.group()]
+                    # The name may continue past the end of the chunk
+                    # or with a letter written as ^^
+                    for t in charIter:
+                        if t.catcode == CC_LETTER:
+                            word.append(t)
+                        else:
+                            pushChar(t)
+                            break
+                    token = EscapeSequence(''.join(word))
+                    if token[-1] in string.letters:
+                        # Absorb following whitespace
                         self.state = STATE_S
 
-                    else:
-                        token = EscapeSequence(token)
+                else:
+                    for token in charIter:
+ 
+                        if token.catcode == CC_LETTER:
+                            word = [token]
+                            for t in charIter:
+                                if t.catcode == CC_LETTER:
+                                    word.append(t) 
+                                else:
+                                    pushChar(t)
+                                    break
+                            token = EscapeSequence(''.join(word))
+
+                        elif token.catcode == CC_EOL:
+                            #pushChar(token)
+                            #token = EscapeSequence()
+                            token = Space(' ')
+                            self.state = STATE_S
+
+                        else:
+                            token = EscapeSequence(token)
 #
 # Because we can implement macros both in LaTeX and Python, we don't 
 # always want the whitespace to be eaten.  For example, implementing
@@ -449,17 +591,17 @@ class Tokenizer(object):
 # another macro class that would eat whitspace incorrectly.  So we
 # have to do this kind of thing in the parse() method of Macro.
 #
-                    if token.catcode != CC_EOL:
+                        if token.catcode != CC_EOL:
 # HACK: I couldn't get the parse() thing to work so I'm just not
 #       going to parse whitespace after EscapeSequences that end in
 #       non-letter characters as a half-assed solution.
-                        if token[-1] in string.letters:
-                            # Absorb following whitespace
-                            self.state = STATE_S
+                            if token[-1] in string.letters:
+                                # Absorb following whitespace
+                                self.state = STATE_S
 
-                    break
+                        break
 
-                else: token = EscapeSequence()
+                    else: token = EscapeSequence()
 
                 # Check for any \let aliases
                 token = context.lets.get(token, token)
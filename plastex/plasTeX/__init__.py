@@ -15,13 +15,13 @@ deflog = Logging.getLogger('parse.definitions')
 # Utility functions
 #
 
-def idgen():
-    """ Generate a unique ID """
-    i = 1
+def idgenerator(start=1):
+    """ Generate unique IDs, numbered from `start` """
+    i = start
     while 1:
         yield 'a%.10d' % i
         i += 1
-idgen = idgen()
+idgen = idgenerator()
 
 def subclasses(o):
     """ Return all subclasses of the given class """
@@ -1006,12 +1006,176 @@ def expandDef(definition, params):
         previous = t
     return output
 
+def compileDef(definition):
+    """
+    Compile a macro definition into a substitution plan
+
+    The plan is what expandDef() does, worked out once: a list of
+    (literal, index, ifx) triples followed by a final literal.  Each
+    literal is a list of tokens to copy, index is the parameter number
+    to substitute after it, and ifx says whether the parameter follows
+    an \ifx and needs to be wrapped in a group.
+
+    Required Arguments:
+    definition -- list of tokens
+
+    Returns:
+    two-element tuple containing the list of triples and the final
+    literal, or None if the definition uses a parameter that isn't
+    a number (expandDef() will complain about those when it is used)
+
+    """
+    parts = []
+    literal = []
+    if not definition:
+        return parts, literal
+    definition = iter(definition)
+    previous = ''
+    for t in definition:
+        if t.catcode == Token.CC_PARAMETER:
+            for t in definition:
+                # Double '#'
+                if t.catcode == Token.CC_PARAMETER:
+                    literal.append(t)
+                else:
+                    try:
+                        index = int(t)
+                    except ValueError:
+                        return None
+                    parts.append((literal, index, previous == 'ifx'))
+                    literal = []
+                break
+        else:
+            literal.append(t)
+        previous = t
+    return parts, literal
+
+def expandCompiledDef(plan, params):
+    """
+    Expand a definition compiled by compileDef()
+
+    Required Arguments:
+    plan -- the substitution plan
+    params -- list of parameter values, with a dummy first element
+
+    Returns:
+    list of tokens
+
+    """
+    parts, last = plan
+    output = []
+    extend = output.extend
+    for literal, index, ifx in parts:
+        extend(literal)
+        param = params[index]
+        if param is not None:
+            if ifx:
+                output.append(BeginGroup(' '))
+                extend(param)
+                output.append(EndGroup(' '))
+            else:
+                extend(param)
+    extend(last)
+    return output
+
+# Steps of a compiled \def argument template
+ARG_UNDELIMITED, ARG_DELIMITED, ARG_MATCH, ARG_BRACE, ARG_INVALID = range(5)
+
+def compileArgs(args):
+    """
+    Compile the argument template of a \def into a list of steps
+
+    Each step is a (kind, token) pair: ARG_UNDELIMITED reads a regular
+    argument, ARG_DELIMITED reads everything up to `token', ARG_MATCH
+    expects `token' next in the input, ARG_BRACE is the #{ case, and 
+    ARG_INVALID ends a template that Definition.invoke can't parse.
+
+    Required Arguments:
+    args -- list of tokens
+
+    Returns:
+    list of steps
+
+    """
+    steps = []
+    argIter = iter(args)
+    inparam = False
+    for a in argIter:
+
+        # Beginning a new parameter
+        if a.catcode == Token.CC_PARAMETER:
+            
+            # Adjacent parameters, just get the next token
+            if inparam:
+                steps.append((ARG_UNDELIMITED, None))
+
+            # Get the parameter number
+            for a in argIter:
+                # Numbered parameter
+                if a in string.digits:
+                    inparam = True
+
+                elif a.catcode == Token.CC_PARAMETER:
+                    continue
+                
+                # Handle #{ case here
+                elif a.catcode == Token.CC_BGROUP:
+                    steps.append((ARG_BRACE, None))
+                    inparam = False
+
+                else:
+                    steps.append((ARG_INVALID, None))
+                    return steps
+                break
+
+        # In a parameter, so get everything up to a token that matches `a`
+        elif inparam:
+            steps.append((ARG_DELIMITED, a))
+            inparam = False
+
+        # Not in a parameter, just make sure the token matches
+        else:
+            steps.append((ARG_MATCH, a))
+
+    if inparam:
+        steps.append((ARG_UNDELIMITED, None))
+
+    return steps
+
+def expandMacro(macro, params):
+    """
+    Expand the definition of a user-defined macro
+
+    The definition is compiled the first time the macro's class is
+    invoked and the plan is kept on the class along with the definition
+    it was compiled from.
+
+    Required Arguments:
+    macro -- NewCommand or Definition instance
+    params -- list of parameter values, with a dummy first element
+
+    Returns:
+    list of tokens
+
+    """
+    cls = type(macro)
+    cached = cls._expansion
+    if cached is None or cached[0] is not macro.definition:
+        cached = cls._expansion = (macro.definition, 
+                                   compileDef(macro.definition))
+    if cached[1] is None:
+        return expandDef(macro.definition, params)
+    return expandCompiledDef(cached[1], params)
+
 class NewCommand(Macro):
     """ Superclass for all \newcommand/\newenvironment type commands """
     nargs = 0
     opt = None
     definition = None
 
+    # (definition, plan) pair cached by expandMacro()
+    _expansion = None
+
     def invoke(self, tex):
         if self.macroMode == Macro.MODE_END:
             res = self.ownerDocument.createElement('end'+self.tagName).invoke(tex)
@@ -1040,68 +1204,47 @@ class NewCommand(Macro):
         if self.macroMode == Macro.MODE_BEGIN:
             output.append(BeginGroup(' '))
             
-        return output + expandDef(self.definition, params)
+        return output + expandMacro(self, params)
 
 class Definition(Macro):
     """ Superclass for all \\def-type commands """
     args = None
     definition = None
 
+    # (definition, plan) pair cached by expandMacro()
+    _expansion = None
+
+    # (args, steps) pair cached by invoke()
+    _arguments = None
+
     def invoke(self, tex):
         if not self.args: return self.definition
 
+        cls = type(self)
+        cached = cls._arguments
+        if cached is None or cached[0] is not self.args:
+            cached = cls._arguments = (self.args, compileArgs(self.args))
+
         name = macroName(self)
-        argIter = iter(self.args)
-        inparam = False
         params = [None]
-        for a in argIter:
+        for kind, a in cached[1]:
 
-            # Beginning a new parameter
-            if a.catcode == Token.CC_PARAMETER:
-                
-                # Adjacent parameters, just get the next token
-                if inparam:
-                    params.append(tex.readArgument(parentNode=self,
-                                                   name='#%s' % len(params)))
-
-                # Get the parameter number
-                for a in argIter:
-                    # Numbered parameter
-                    if a in string.digits:
-                        inparam = True
-
-                    elif a.catcode == Token.CC_PARAMETER:
-                        continue
-                    
-                    # Handle #{ case here
-                    elif a.catcode == Token.CC_BGROUP:
-                        param = []
-                        for t in tex.itertokens():
-                            if t.catcode == Token.CC_BGROUP:
-                                tex.pushToken(t)
-                            else:
-                                param.append(t)
-                        inparam = False
-                        params.append(param)
+            if kind == ARG_UNDELIMITED:
+                params.append(tex.readArgument(parentNode=self,
+                                               name='#%s' % len(params)))
 
-                    else:
-                        raise ValueError, \
-                              'Invalid arg string: %s' % ''.join(self.args)
-                    break
-
-            # In a parameter, so get everything up to a token that matches `a`
-            elif inparam:
+            # Get everything up to a token that matches `a`
+            elif kind == ARG_DELIMITED:
                 param = []
                 for t in tex.itertokens():
                     if t == a:
                         break
                     else:
                         param.append(t)
-                inparam = False
                 params.append(param)
 
-            # Not in a parameter, just make sure the token matches
-            else:
+            # Just make sure the token matches
+            elif kind == ARG_MATCH:
                 for t in tex.itertokens():
                     if t == a:
                         break
@@ -1109,13 +1252,22 @@ class Definition(Macro):
                         log.info('Arguments of "%s" don\'t match definition. Got "%s" but was expecting "%s" (%s).' % (name, t, a, ''.join(self.args)))
                         break
 
-        if inparam:
-            params.append(tex.readArgument(parentNode=self, 
-                                           name='#%s' % len(params)))
+            elif kind == ARG_BRACE:
+                param = []
+                for t in tex.itertokens():
+                    if t.catcode == Token.CC_BGROUP:
+                        tex.pushToken(t)
+                    else:
+                        param.append(t)
+                params.append(param)
+
+            else:
+                raise ValueError, \
+                      'Invalid arg string: %s' % ''.join(self.args)
 
         deflog.debug2('expanding %s %s', self.definition, params)
 
-        return expandDef(self.definition, params)
+        return expandMacro(self, params)
 
 
 class number(int):
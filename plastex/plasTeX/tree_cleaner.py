@@ -8,9 +8,15 @@ Same license as the rest of plasTeX.
 """
 
 import codecs
+import hashlib
+import multiprocessing
 import os
+import Queue
 import re
+import select
 import subprocess
+import threading
+import time
 
 from lxml import etree
 
@@ -35,14 +41,30 @@ def clean_label(s):
 
 
 class TreeCleaner(object):
+
+    # nodes that test_math translates
+    math_names = ['math', 'displaymath', 'ensuremath',
+                  'eqnarray', 'eqnarray*']
+
     def __init__(self, tex, document):
         self.tex = tex
         self.document = document
         self.document.contains_mml = False
 
+        config = document.config['mathml']
+        self.cache = MathMLCache(config['cache'], config['cache-size'])
+
+        # translations done ahead of time by prefetch_mathml
+        self.prefetched = {}
+
         with Tralics() as self.tralics:
+            if self.cache.directory:
+                self.cache.salt = self.tralics.signature()
+            self.prefetch_mathml()
             self.clean()
 
+        self.cache.close()
+
     def clean(self):
         """Walk the node tree fixing problems.
 
@@ -218,8 +240,7 @@ class TreeCleaner(object):
 
         node: Node
         """
-        if node.nodeName not in ['math', 'displaymath', 'ensuremath',
-                                 'eqnarray', 'eqnarray*']:
+        if node.nodeName not in self.math_names:
             return
 
         # translate complicated math into MathML
@@ -268,29 +289,19 @@ class TreeCleaner(object):
         """
         self.document.contains_mml = True
 
-        # use tralics to generate MathML
-        latex = node.source
-
         # if plastex is being clever and giving me just part
         # of an expression, don't translate it yet
         if node.parentNode.nodeName in ['math', 'displaymath']:
             return node
 
-        # the following is a hack to work around a problem with
-        # \ensuremath, which generates spurious \mathit commands.
-        # I couldn't find the source of the problem, so I'm cleaning
-        # it up here.  Sadly, this will cause a problem if the \mathit
-        # was needed.
-        latex = re.sub(r'\mathit', r'', latex)
-
-        # this is another hack to replace a right quote with an
-        # apostrophe
-        latex = re.sub(unichr(8217), "'", latex)
-        #print 'LATEX', latex
-
-        mathml = self.tralics.translate(latex)
+        latex = self.math_source(node)
+        mathml = self.translate(latex)
         #print 'MATHML', mathml
 
+        if mathml is None:
+            log.error('Unable to translate %s into MathML.', latex)
+            return node
+
         # parse the MathML
         root = etree.fromstring(mathml)
 
@@ -328,6 +339,92 @@ class TreeCleaner(object):
         #print 'XML', result.toXML()
         return result
 
+    def math_source(self, node):
+        """Gets the LaTeX source of a math expression, ready for Tralics.
+
+        node: tree of DOM.Element
+
+        Returns: string
+        """
+        # use tralics to generate MathML
+        latex = node.source
+
+        # the following is a hack to work around a problem with
+        # \ensuremath, which generates spurious \mathit commands.
+        # I couldn't find the source of the problem, so I'm cleaning
+        # it up here.  Sadly, this will cause a problem if the \mathit
+        # was needed.
+        latex = re.sub(r'\mathit', r'', latex)
+
+        # this is another hack to replace a right quote with an
+        # apostrophe
+        latex = re.sub(unichr(8217), "'", latex)
+        #print 'LATEX', latex
+        return latex
+
+    def translate(self, latex):
+        """Translates a LaTeX math expression into MathML.
+
+        Uses the cache or the results of prefetch_mathml if it can,
+        and the Tralics session otherwise.
+
+        latex: string
+
+        Returns: string XML, or None if the translation failed
+        """
+        mathml = self.cache.get(latex)
+        if mathml is not None:
+            return mathml
+
+        if latex in self.prefetched:
+            mathml = self.prefetched.pop(latex)
+        else:
+            mathml = self.tralics.translate(latex)
+
+        if mathml is not None:
+            self.cache.set(latex, mathml)
+        return mathml
+
+    def prefetch_mathml(self):
+        """Translates all of the math in the document in parallel.
+
+        Collects the source of every expression make_mathml will be
+        asked to translate and hands the ones that are not cached to
+        a TralicsPool.  The results are kept in self.prefetched, where
+        translate finds them when pass_one gets to each expression, so
+        the converted trees still go in in document order.
+        """
+        workers = self.document.config['mathml']['workers']
+        if workers <= 0:
+            workers = multiprocessing.cpu_count()
+        if workers < 2:
+            return
+
+        sources = []
+        seen = set()
+
+        def collect(node):
+            if node.nodeName not in self.math_names:
+                return
+            if node.parentNode.nodeName in ['math', 'displaymath']:
+                return
+            if self.is_simple_math(node):
+                return
+            latex = self.math_source(node)
+            if latex in seen or latex in self.cache:
+                return
+            seen.add(latex)
+            sources.append(latex)
+
+        self.walk(self.document, collect)
+
+        # one formula is not worth starting a second Tralics for
+        if len(sources) < 2:
+            return
+
+        pool = TralicsPool(min(workers, len(sources)))
+        self.prefetched = pool.translate(sources)
+
     def convert_elements(self, root):
         """Converts a tree of etree.Elements to a tree of DOM.Nodes.
 
@@ -571,87 +668,396 @@ class TreeCleaner(object):
 
 
 class Tralics(object):
-    """Wrapper around a Tralics subprocess."""
+    """Wrapper around a long-lived Tralics subprocess.
+
+    The subprocess is started on the first call to translate and stays
+    up until close is called, so its startup cost is paid once per run
+    rather than once per formula.  Each formula is followed by a
+    sentinel formula; everything Tralics prints up to the sentinel
+    belongs to the formula.  If the sentinel never shows up (Tralics
+    crashed, or an unbalanced brace swallowed it), the subprocess is
+    killed and a new one is started for the next formula.
+    """
 
-    def __init__(self, executable='/usr/local/bin/tralics'):
+    sentinel = 'plastexsentinel'
+
+    flags = ['-interactivemath', '-noconfig', '-entnames=no']
+
+    def __init__(self, executable='/usr/local/bin/tralics', timeout=10):
         """Create a subprocess to communicate with Tralics.
 
         executable: string full path to tralics executable
+        timeout: seconds to wait for Tralics before giving up on a formula
         """
         self.process = None
         self.executable = executable
+        self.timeout = timeout
         if not os.path.exists(executable):
             raise ValueError('Unable to locate the executable ' +
                              self.executable)
 
+        # statistics reported by close
+        self.count = 0
+        self.failures = 0
+        self.restarts = 0
+        self.elapsed = 0.0
+
     def __enter__(self):
         """Creates the subprocess (for use with the with statement)."""
         return self
 
     def __exit__(self, kind, value, traceback):
         """Terminates the subprocess (for use with the with statement)."""
-        if self.process == None:
-            return
+        self.close()
 
-        #print 'Terminating tralics...',
-        self.process.terminate()
-        # output = self.process.stdout.readline()
-        # print 'close', output
-        # self.process.stdin.write('y')
-        self.process.wait()
-        #print 'Done.'
+    def close(self, report=True):
+        """Stops the subprocess and reports what it did.
+
+        report: boolean, whether to log the statistics
+        """
+        if self.process is not None:
+            self.stop_tralics()
+
+        if report and (self.count or self.failures):
+            log.info('Tralics translated %d formulas in %.2f seconds '
+                     '(%d failed, %d restarts).', self.count, self.elapsed,
+                     self.failures, self.restarts)
+
+    def signature(self):
+        """Identifies this Tralics for the purpose of caching its output.
+
+        Returns: string containing the Tralics version and flags
+        """
+        process = subprocess.Popen([self.executable, '-version'],
+                                   stdin=open(os.devnull),
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT)
+        output = process.communicate()[0]
+        match = re.search(r'tralics\s+(\S+),', output)
+        if match:
+            version = match.group(1)
+        else:
+            version = 'unknown'
+        return ' '.join(['tralics', version] + self.flags)
 
     def start_tralics(self):
         """Starts the tralics subprocess."""
-        cmd = [self.executable, 
-               '-interactivemath',
-               '-noconfig',
-               '-entnames=no']
+        cmd = [self.executable] + self.flags
+
+        # the prompts go to stderr; if we piped it, nobody would read
+        # it and Tralics would eventually block on a full pipe
+        self.devnull = open(os.devnull, 'w')
         self.process = subprocess.Popen(cmd, 
                                         shell=False, 
                                         stdin=subprocess.PIPE,
                                         stdout=subprocess.PIPE,
-                                        stderr=subprocess.PIPE,
+                                        stderr=self.devnull,
+                                        close_fds=True,
                                         )
         for i in range(4):
-            output = self.process.stdout.readline()
+            output = self.readline()
             # print 'enter', output
 
-        err = self.process.stdout.readline()
+        err = self.readline()
         # print 'enter', err
 
     def stop_tralics(self):
         """Stops the tralics subprocess."""
-        self.process.terminate()
+        try:
+            self.process.terminate()
+        except OSError:
+            # already dead
+            pass
         self.process.wait()
         self.process = None
+        self.devnull.close()
+
+    def readline(self):
+        """Reads a line of output from Tralics.
+
+        Returns: string, or None if Tralics died or timed out
+        """
+        ready, _, _ = select.select([self.process.stdout], [], [],
+                                    self.timeout)
+        if not ready:
+            return None
+
+        output = self.process.stdout.readline()
+        if not output:
+            return None
+        return output
 
     def translate(self, latex):
         """Translates a LaTeX math expression into MathML.
 
         latex: string
 
-        Returns: string XML
+        Returns: string XML, or None if the translation failed
         """
         latex = latex.strip()
         latex = latex.encode('utf-8', 'strict')
 
-        self.start_tralics()
-        self.process.stdin.write(latex + '\n')
-           
-        while True:
-            #print 'Waiting for tralics...',
-            output = self.process.stdout.readline()
+        start = time.time()
+        try:
+            return self.send(latex)
+        finally:
+            self.elapsed += time.time() - start
 
-            if output.startswith('<formula'):
+    def send(self, latex):
+        """Sends a formula to Tralics and collects the result.
+
+        latex: string encoded in UTF-8
+
+        Returns: string XML, or None if the translation failed
+        """
+        if self.process is None:
+            self.start_tralics()
+
+        try:
+            self.process.stdin.write(latex + '\n')
+            self.process.stdin.write('$\\mathrm{%s}$\n' % self.sentinel)
+            self.process.stdin.flush()
+        except IOError:
+            output = None
+        else:
+            output = ''
+
+        formula = None
+        while output is not None:
+            output = self.readline()
+            if output is None:
                 break
-            if output.startswith('Error'):
-                print 'tralics:', output,
-                output = self.process.stdout.readline()
+
+            if output.startswith('<formula'):
+                if self.sentinel in output:
+                    break
+                if formula is None:
+                    formula = output.strip()
+            elif output.startswith('Error'):
                 print 'tralics:', output,
+                output = self.readline()
+                if output is not None:
+                    print 'tralics:', output,
+
+        if output is None:
+            # Tralics crashed or lost track of the input; start over
+            log.warning('Tralics failed on %s; restarting it.', latex)
+            self.stop_tralics()
+            self.restarts += 1
+
+        if formula is None:
+            self.failures += 1
+        else:
+            self.count += 1
+        return formula
+
+
+class TralicsPool(object):
+    """A group of Tralics sessions that translate formulas in parallel.
+
+    Each session is driven by its own thread; the threads spend their
+    time waiting on Tralics, so the GIL is not a bottleneck.
+    """
+
+    def __init__(self, size, executable='/usr/local/bin/tralics'):
+        """Creates the sessions.
+
+        size: int number of Tralics processes
+        executable: string full path to tralics executable
+        """
+        self.sessions = [Tralics(executable) for i in range(size)]
+
+    def translate(self, sources):
+        """Translates a list of LaTeX math expressions into MathML.
 
-        self.stop_tralics()
-        return output.strip()
+        sources: list of strings
+
+        Returns: map from each source to string XML, or None if the
+                 translation failed
+        """
+        start = time.time()
+
+        # start the processes here rather than in the threads, since
+        # forking from several threads at once is asking for trouble
+        for tralics in self.sessions:
+            tralics.start_tralics()
+
+        queue = Queue.Queue()
+        for latex in sources:
+            queue.put(latex)
+
+        results = {}
+
+        def work(tralics):
+            while True:
+                try:
+                    latex = queue.get_nowait()
+                except Queue.Empty:
+                    return
+                results[latex] = tralics.translate(latex)
+
+        threads = [threading.Thread(target=work, args=(tralics,))
+                   for tralics in self.sessions]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for tralics in self.sessions:
+            tralics.close(report=False)
+
+        log.info('%d Tralics processes translated %d formulas in %.2f '
+                 'seconds (%d failed, %d restarts).', len(self.sessions),
+                 sum(tralics.count for tralics in self.sessions),
+                 time.time() - start,
+                 sum(tralics.failures for tralics in self.sessions),
+                 sum(tralics.restarts for tralics in self.sessions))
+        return results
+
+
+class MathMLCache(object):
+    """Content-addressed cache of LaTeX to MathML translations.
+
+    Translations are always remembered for the rest of the run.  If a
+    directory is given, they are also stored there, one file per
+    formula named by a hash of the formula and the salt, so they
+    survive across runs and can be shared between books.
+    """
+
+    def __init__(self, directory=None, max_size=10240):
+        """Creates the cache.
+
+        directory: string directory to keep the cache in, or None
+        max_size: int maximum size of the directory in kilobytes
+        """
+        self.directory = directory
+        self.max_size = max_size * 1024
+        self.salt = ''
+        self.memo = {}
+        self.hits = 0
+        self.misses = 0
+
+        if self.directory and not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    def normalize(self, latex):
+        """Removes whitespace differences TeX would not notice.
+
+        latex: string
+
+        Returns: string
+        """
+        lines = [re.sub(r'[ \t]+', ' ', line).strip()
+                 for line in latex.strip().splitlines()]
+        return '\n'.join(lines)
+
+    def key(self, latex):
+        """Computes the cache key for a formula.
+
+        latex: string
+
+        Returns: string hex digest
+        """
+        source = self.salt + '\n' + self.normalize(latex)
+        return hashlib.sha1(source.encode('utf-8')).hexdigest()
+
+    def path(self, key):
+        """Returns the path of the file that holds the given key."""
+        return os.path.join(self.directory, key + '.xml')
+
+    def __contains__(self, latex):
+        """Checks whether a formula is cached, without counting a hit."""
+        key = self.key(latex)
+        if key in self.memo:
+            return True
+        return bool(self.directory) and os.path.exists(self.path(key))
+
+    def get(self, latex):
+        """Looks up the translation of a formula.
+
+        latex: string
+
+        Returns: string XML, or None if the formula is not cached
+        """
+        key = self.key(latex)
+        mathml = self.memo.get(key)
+
+        if mathml is None and self.directory:
+            path = self.path(key)
+            try:
+                mathml = open(path, 'rb').read()
+                # update the mtime, which is what eviction goes by
+                os.utime(path, None)
+            except (IOError, OSError):
+                mathml = None
+            if mathml is not None:
+                self.memo[key] = mathml
+
+        if mathml is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return mathml
+
+    def set(self, latex, mathml):
+        """Stores the translation of a formula.
+
+        latex: string
+        mathml: string XML
+        """
+        key = self.key(latex)
+        self.memo[key] = mathml
+
+        if not self.directory:
+            return
+
+        # write to a temporary file and rename it into place, so a
+        # concurrent reader never sees a partial file
+        path = self.path(key)
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        try:
+            fp = open(tmp, 'wb')
+            fp.write(mathml)
+            fp.close()
+            os.rename(tmp, path)
+        except (IOError, OSError), msg:
+            log.warning('Could not write to the MathML cache: %s', msg)
+
+    def evict(self):
+        """Removes the least recently used files until the cache
+        directory is no bigger than max_size.
+        """
+        entries = []
+        total = 0
+        for name in os.listdir(self.directory):
+            if not name.endswith('.xml'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    def close(self):
+        """Trims the cache directory and reports hits and misses."""
+        if self.directory:
+            self.evict()
+
+        if self.hits or self.misses:
+            log.info('MathML cache: %d hits, %d misses.',
+                     self.hits, self.misses)
 
 
 def main():
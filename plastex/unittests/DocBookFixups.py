@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+
+import random, unittest
+from unittest import TestCase
+from plasTeX.Renderers.DocBook import fixupMarkup, fixupMarkupSequentially, \
+     MarkupFixer, Fallback, stripChunks
+
+PIECES = [u' ', u'\n', u'\t', u'word', u'x.', u'<para>', u'</para>',
+          u'<partintro>', u'</partintro>', u'<anchor id="a"/>',
+          u'<anchor\nxml:id="b"/>', u'<xref linkend="c"/>', u'<xref',
+          u'xml:id', u'<chapter>', u'</chapter>', u'<chapterinfo>',
+          u'<indexterm>', u'</indexterm>', u'<indexterm class="x">',
+          u' <indexterm', u'indexterm> ', u'<programlisting>',
+          u'</programlisting>', u'<programlisting>\n',
+          u'\n</programlisting>', u'<bookinfo>', u'</bookinfo>',
+          u'put_mathml_stuff_here', u'<sect1>', u'>', u'<', u'_', u'\r',
+          u'\xa0', u'<br/>']
+
+class DocBookFixups(TestCase):
+
+    def check(self, s):
+        result = fixupMarkup(s)
+        expected = fixupMarkupSequentially(s)
+        assert result == expected, '%r: %r != %r' % (s, result, expected)
+        return result
+
+    def testEmptyParagraphs(self):
+        result = self.check(u'a <para> <anchor id="x"/> </para>\n b')
+        assert result == u'ab', result
+        result = self.check(u'<para><para><para></para></para></para>')
+        assert result == u'', result
+        result = self.check(u'<para>'*4 + u'</para>'*4)
+        assert result == u'<para></para>', result
+        result = self.check(u'<para> <partintro> </partintro> </para>')
+        assert result == u'<para></para>', result
+
+    def testProgramListings(self):
+        result = self.check(u'x \n<programlisting>\ncode\n</programlisting>\n y')
+        assert result == u'x<programlisting>code</programlisting>y', result
+        result = self.check(u'\n</programlisting>\n</programlisting>\t')
+        assert result == u'</programlisting></programlisting>\t', result
+
+    def testReferences(self):
+        result = self.check(u'see Section <xref linkend="a"/>')
+        assert result == u'see <xref linkend="a"/>', result
+        result = self.check(u'x\n<xref linkend="a"/>')
+        assert result == u'x\n<xref linkend="a"/>', result
+        result = self.check(u'a <para></para> <xref/>')
+        assert result == u'<xref/>', result
+
+    def testFirstChapter(self):
+        result = self.check(u'<chapter>a</chapter><chapter>b</chapter>')
+        assert result == u'<preface>a</preface><chapter>b</chapter>', result
+
+    def testEmptyTags(self):
+        self.check(u'a<br>b<hr class="x" / >c')
+
+    def testRandomMarkup(self):
+        rand = random.Random(1)
+        for i in range(5000):
+            self.check(u''.join([rand.choice(PIECES)
+                                 for j in range(rand.randint(0, 14))]))
+
+    def testChunks(self):
+        rand = random.Random(2)
+        for i in range(5000):
+            s = u''.join([rand.choice(PIECES)
+                          for j in range(rand.randint(0, 30))])
+            cuts = sorted([rand.randint(0, len(s)) 
+                           for j in range(rand.randint(0, 6))])
+            chunks = [s[a:b] for a, b in zip([0] + cuts, cuts + [len(s)])]
+            try:
+                expected = MarkupFixer().close(s.strip())
+            except Fallback:
+                expected = Fallback
+            fixer = MarkupFixer()
+            try:
+                result = [fixer.feed(x) for x in stripChunks(chunks)]
+                result = u''.join(result) + fixer.close()
+            except Fallback:
+                result = Fallback
+            assert result == expected, '%r: %r != %r' % (chunks, result, expected)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,6 +2,7 @@
 
 import sys, unittest, re, os, tempfile, shutil, glob, difflib, subprocess
 from unittest import TestCase
+import plasTeX
 
 def which(name, path=None, exts=('',)):
     """
@@ -34,10 +35,63 @@ class Process(object):
             kwargs['stderr'] = subprocess.STDOUT
         self.process = subprocess.Popen(args, **kwargs)
         self.log = self.process.stdout.read()
-        self.returncode = self.process.returncode
+        self.returncode = self.process.wait()
         self.process.stdout.close()
         self.process.stdin.close()
 
+def plastex(*args, **kwargs):
+    """
+    Run the plastex script of the plasTeX being tested
+
+    Args:
+    args -- the command line arguments
+    kwargs -- keyword arguments for Process, such as cwd
+
+    Returns:
+    The output of plastex.  OSError is raised if it fails.
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(plasTeX.__file__)))
+    env = os.environ.copy()
+    env['PYTHONPATH'] = os.pathsep.join([root, '.', env.get('PYTHONPATH', '')])
+    script = os.path.join(root, 'plasTeX', 'plastex')
+    kwargs['env'] = env
+    p = Process(sys.executable, script, *args, **kwargs)
+    if p.returncode:
+        raise OSError, 'plastex failed with code %s: %s' % (p.returncode, p.log)
+    return p.log
+
+class RenderTest(TestCase):
+    """ Base class for tests that render documents in a temporary directory """
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def readFiles(self, directory, extensions=None):
+        """
+        Return the lines of the files in a directory and its 
+        subdirectories, keyed by their paths relative to it
+
+        """
+        output = {}
+        for dirpath, dirnames, filenames in os.walk(directory):
+            for filename in filenames:
+                if extensions and os.path.splitext(filename)[1] not in extensions:
+                    continue
+                path = os.path.join(dirpath, filename)
+                output[path[len(directory) + 1:]] = open(path).readlines()
+        return output
+
+    def assertSameFiles(self, expected, output):
+        """ Compare the files returned by two calls of readFiles """
+        assert sorted(expected) == sorted(output), '%s != %s' % (sorted(expected), sorted(output))
+        for name in sorted(expected):
+            diff = ''.join(difflib.unified_diff(expected[name], output[name],
+                                                name, name))
+            assert not diff, 'Differences were found: %s' % diff
+
 class Benched(TestCase):
     """ Compile LaTeX file and compare to benchmark file """
 
@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+
+import os, shutil, tempfile, unittest
+from unittest import TestCase
+from plasTeX.Config import config
+from plasTeX.Imagers import Image, PILImage, linkImage, copyImage
+
+class ImageStore(TestCase):
+    """ Reuse filenames that are hard linked to stored images """
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.store = os.path.join(self.root, 'store.png')
+        self.other = os.path.join(self.root, 'other.png')
+        self.output = os.path.join(self.root, 'img-0001.png')
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def save(self, path, size, color):
+        """ Write an image with a box on a white background """
+        im = PILImage.new('RGB', (size[0] + 20, size[1] + 20), (255, 255, 255))
+        im.paste(color, (10, 10, size[0] + 10, size[1] + 10))
+        im.save(path)
+
+    def testCopy(self):
+        open(self.store, 'wb').write('stored image')
+        open(self.other, 'wb').write('another image')
+        linkImage(self.store, self.output)
+        copyImage(self.other, self.output)
+        assert open(self.store, 'rb').read() == 'stored image'
+        assert open(self.output, 'rb').read() == 'another image'
+
+    def testCrop(self):
+        if PILImage is None:
+            self.skipTest('PIL is not available')
+        self.save(self.store, (100, 10), (0, 0, 0))
+        stored = open(self.store, 'rb').read()
+        linkImage(self.store, self.output)
+        image = Image(self.output, config['images'])
+        image.crop()
+        assert open(self.store, 'rb').read() == stored
+        assert PILImage.open(self.output).size != PILImage.open(self.store).size
+        assert not [x for x in os.listdir(self.root) if x.startswith('.')]
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+import os, shutil, tempfile, unittest
+from unittest import TestCase
+from plasTeX.Kpsewhich import FileFinder, expandBraces
+
+class Finder(FileFinder):
+    """ File finder with a fixed default path that never runs kpsewhich """
+
+    def __init__(self, defaultPath, databases=''):
+        FileFinder.__init__(self, 'kpsewhich')
+        self.paths = {'tex':defaultPath, 'ls-R':databases}
+        self.asked = []
+
+    def showPath(self, format):
+        return self.paths[format]
+
+    def kpsewhich(self, name, texinputs):
+        self.asked.append(name)
+        return None
+
+class FileFinding(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.texinputs = os.environ.get('TEXINPUTS')
+        os.environ.pop('TEXINPUTS', None)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+        if self.texinputs is not None:
+            os.environ['TEXINPUTS'] = self.texinputs
+
+    def makeFile(self, *parts):
+        filename = os.path.join(self.root, *parts)
+        if not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        open(filename, 'w').close()
+        return filename
+
+    def testBraces(self):
+        expected = ['/t/tex/latex//', '/t/tex/generic//', '/t/tex///']
+        result = expandBraces('/t/tex/{latex,generic,}//')
+        assert result == expected, '%s != %s' % (result, expected)
+        result = expandBraces('/a/{b,c{d,e}}')
+        expected = ['/a/b', '/a/cd', '/a/ce']
+        assert result == expected, '%s != %s' % (result, expected)
+
+    def testSourceDirectoryFirst(self):
+        self.makeFile('inputs', 'chap.tex')
+        src = os.path.dirname(self.makeFile('src', 'chap.tex'))
+        os.environ['TEXINPUTS'] = os.path.join(self.root, 'inputs')
+        finder = Finder(None)
+        result = finder.find('chap', src)
+        assert result == src + '/chap.tex', result
+        result = finder.find('chap')
+        expected = os.path.join(self.root, 'inputs', 'chap.tex')
+        assert result == expected, result
+        assert not finder.asked, finder.asked
+
+    def testTexExtension(self):
+        self.makeFile('chap')
+        self.makeFile('chap.tex')
+        self.makeFile('style.sty.tex')
+        self.makeFile('style.sty')
+        finder = Finder(self.root)
+        result = finder.find('chap')
+        assert result == os.path.join(self.root, 'chap.tex'), result
+        result = finder.find('style.sty')
+        assert result == os.path.join(self.root, 'style.sty'), result
+
+    def testDatabase(self):
+        texmf = os.path.join(self.root, 'texmf')
+        one = self.makeFile('texmf', 'tex', 'latex', 'one', 'one.sty')
+        self.makeFile('texmf', 'tex', 'latex', 'a', 'two.sty')
+        self.makeFile('texmf', 'tex', 'latex', 'b', 'two.sty')
+        open(os.path.join(texmf, 'ls-R'), 'w').write(
+            '% ls-R -- filename database\n\n'
+            './tex/latex/one:\none.sty\n\n'
+            './tex/latex/a:\ntwo.sty\n\n'
+            './tex/latex/b:\ntwo.sty\n')
+        finder = Finder('.:!!%s/tex/{latex,generic,}//' % texmf, texmf)
+        result = finder.find('one.sty')
+        assert result == one, result
+        assert not finder.asked, finder.asked
+
+        # Ambiguous matches are left to kpsewhich
+        result = finder.find('two.sty')
+        assert result is None, result
+        assert finder.asked == ['two.sty'], finder.asked
+
+    def testMemo(self):
+        finder = Finder(self.root)
+        result = finder.find('later.sty')
+        assert result is None, result
+        self.makeFile('later.sty')
+        result = finder.find('later.sty')
+        assert result is None, result
+        assert finder.hits == 1, finder.hits
+
+    def testOtherFormats(self):
+        self.makeFile('refs.bib')
+        finder = Finder(self.root)
+        result = finder.find('refs.bib')
+        assert finder.asked == ['refs.bib'], finder.asked
+
+if __name__ == '__main__':
+    unittest.main()
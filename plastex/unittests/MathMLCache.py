@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+
+import os, shutil, tempfile, time, unittest
+from unittest import TestCase
+from plasTeX.TeX import TeX
+from plasTeX.tree_cleaner import MathMLCache, TralicsPool, TreeCleaner
+
+TRALICS = '/usr/local/bin/tralics'
+
+class Cache(TestCase):
+    """ Remember LaTeX to MathML translations in memory and on disk """
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def testWhitespace(self):
+        cache = MathMLCache()
+        key = cache.key('$x + y$')
+        for latex in ['  $x   +\ty$ ', '$x + y$\n', '$x \t+ y$']:
+            assert cache.key(latex) == key, '%r has a different key' % latex
+        assert cache.key('$x+y$') != key, 'spaces between tokens were removed'
+        assert cache.key('$x +\ny$') != key, 'line breaks were removed'
+        assert cache.key('$x +  \n  y$') == cache.key('$x +\ny$')
+
+    def testSalt(self):
+        cache = MathMLCache()
+        key = cache.key('$x$')
+        cache.salt = 'tralics 2.14.5 -interactivemath'
+        assert cache.key('$x$') != key, 'the salt is not part of the key'
+        other = MathMLCache()
+        other.salt = cache.salt
+        assert other.key('$x$') == cache.key('$x$')
+
+    def testHitsAndMisses(self):
+        cache = MathMLCache()
+        assert cache.get('$x$') is None
+        assert '$x$' not in cache
+        cache.set('$x$', '<formula/>')
+        assert '$x$' in cache
+        assert cache.get(' $x$ ') == '<formula/>'
+        assert cache.get('$y$') is None
+        assert (cache.hits, cache.misses) == (1, 2), (cache.hits, cache.misses)
+
+    def testDirectory(self):
+        cache = MathMLCache(self.root)
+        cache.set('$x$', '<formula/>')
+        assert os.listdir(self.root) == [cache.key('$x$') + '.xml'], os.listdir(self.root)
+        other = MathMLCache(self.root)
+        assert '$x$' in other
+        assert other.get('$x$') == '<formula/>'
+        assert (other.hits, other.misses) == (1, 0), (other.hits, other.misses)
+        other.salt = 'another tralics'
+        assert other.get('$x$') is None
+
+    def testEvict(self):
+        cache = MathMLCache(self.root, max_size=2)
+        now = time.time()
+        names = []
+        for i in range(3):
+            latex = '$x_%d$' % i
+            cache.set(latex, 'x' * 1000)
+            path = cache.path(cache.key(latex))
+            os.utime(path, (now - 100 + i, now - 100 + i))
+            names.append(os.path.basename(path))
+        cache.evict()
+        assert sorted(os.listdir(self.root)) == sorted(names[1:]), \
+               'expected the oldest file to be removed'
+
+        # Reading a formula makes it the most recently used one
+        assert MathMLCache(self.root).get('$x_1$') is not None
+        cache.set('$x_3$', 'x' * 1000)
+        cache.evict()
+        remaining = sorted(os.listdir(self.root))
+        assert names[1] in remaining, 'a file that was just read was removed'
+        assert names[2] not in remaining, remaining
+
+class Prefetch(TestCase):
+    """ Translate the math of a document with several Tralics processes """
+
+    def setUp(self):
+        if not os.path.exists(TRALICS):
+            self.skipTest('Tralics is not installed')
+        # Tralics writes its log to the current directory
+        self.cwd = os.getcwd()
+        self.root = tempfile.mkdtemp()
+        os.chdir(self.root)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def testPool(self):
+        sources = ['$x^2$', r'$\frac{a}{b}$', '$a+b$']
+        results = TralicsPool(2, TRALICS).translate(sources)
+        assert sorted(results) == sorted(sources), sorted(results)
+        for latex in sources:
+            assert results[latex].startswith('<formula'), results[latex]
+
+    def testPrefetch(self):
+        tex = TeX()
+        tex.input(r'''\documentclass{article}\begin{document}
+$x$ $\frac{a}{b}$ $\sqrt{y}$ $\frac{a}{b}$ $\sqrt{z}$
+\end{document}''')
+        document = tex.parse()
+        workers = document.config['mathml']['workers']
+        document.config['mathml']['workers'] = 2
+        try:
+            # Set up the cleaner the way its constructor does,
+            # without cleaning the document
+            cleaner = TreeCleaner.__new__(TreeCleaner)
+            cleaner.document = document
+            cleaner.cache = MathMLCache()
+            cleaner.cache.set(r'$\sqrt {y}$', '<formula/>')
+            cleaner.prefetched = {}
+            cleaner.prefetch_mathml()
+        finally:
+            document.config['mathml']['workers'] = workers
+        expected = [r'$\frac{a}{b}$', r'$\sqrt {z}$']
+        assert sorted(cleaner.prefetched) == sorted(expected), sorted(cleaner.prefetched)
+        for latex in expected:
+            assert cleaner.prefetched[latex].startswith('<formula'), cleaner.prefetched[latex]
+
+if __name__ == '__main__':
+    unittest.main()
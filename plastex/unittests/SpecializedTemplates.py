@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+
+import os, sys, shutil, subprocess, unittest
+from StringIO import StringIO
+from plasTeX.Renderers import StreamOutput
+from plasTeX.Renderers.PageTemplate import elementRenderer, htmltemplate, simpleTAL
+from FunctionalTests import RenderTest, plastex
+
+BOOK = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                    '..', '..', 'test_suite', 'small')
+
+class Document(object):
+    config = {}
+    context = None
+
+class Node(object):
+    """ Node whose content is a template, counting how often it is used """
+    ownerDocument = Document()
+    renderer = parentNode = None
+    name = u'name'
+
+    def __init__(self):
+        self.calls = 0
+
+    def inner(self):
+        self.calls += 1
+        return simpleTAL.compileHTMLTemplate('<i tal:content="self/name"></i>')
+
+class SpecializedTemplates(RenderTest):
+    """ Render a book with and without the specialized templates """
+
+    def render(self, name, *options):
+        """ Render the book in its own directory and return the output """
+        workdir = os.path.join(self.root, name)
+        shutil.copytree(BOOK, workdir)
+        source = open(os.path.join(workdir, 'book.pre.tex'), 'w')
+        subprocess.check_call([sys.executable,
+                               os.path.join(BOOK, '..', 'preprocess.py'),
+                               'book.tex'], cwd=workdir, stdout=source)
+        source.close()
+        args = ['--renderer=DocBook', '--theme=book', '--filename=book.xml',
+                '--dir=book'] + list(options) + ['book.pre.tex']
+        plastex(cwd=workdir, *args)
+        return self.readFiles(os.path.join(workdir, 'book'))
+
+    def testSmallBook(self):
+        if not os.path.isdir(BOOK):
+            return
+        fast = self.render('fast', '--specialize-templates')
+        slow = self.render('slow', '--no-specialize-templates')
+        self.assertSameFiles(slow, fast)
+
+    def testTemplateContent(self):
+        source = '<b tal:content="structure self/inner"></b>'
+        function = elementRenderer(simpleTAL.compileHTMLTemplate(source))
+        assert function is not None
+        node = Node()
+        expected = htmltemplate(source)(node)
+        assert node.calls == 1, node.calls
+        node = Node()
+        output = function(node)
+        assert output == expected, '%r != %r' % (output, expected)
+        assert node.calls == 1, node.calls
+        node, output = Node(), StringIO()
+        function.stream(node, StreamOutput(output))
+        assert output.getvalue() == expected, '%r != %r' % (output.getvalue(), expected)
+        assert node.calls == 1, node.calls
+
+if __name__ == '__main__':
+    unittest.main()
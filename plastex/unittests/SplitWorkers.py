@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+
+import os, re, unittest
+from FunctionalTests import RenderTest, plastex
+
+SOURCE = r'''\documentclass{book}
+\usepackage{graphicx}
+\usepackage{makeidx}
+\makeindex
+\begin{document}
+\tableofcontents
+\chapter{One}\label{one}
+See chapter \ref{two} and section \ref{sec}.
+\section{Alpha} Text\footnote{A note}.
+\begin{figure}\includegraphics{pic}\caption{A picture}\label{fig}\end{figure}
+\chapter{Two}\label{two}
+Back to chapter \ref{one} and figure \ref{fig}.
+\section{Beta}\label{sec}
+\begin{figure}\includegraphics{pic2}\end{figure}
+\chapter{Three}
+\section{Gamma}\index{gamma}
+\begin{picture}(10,10)\end{picture}
+\subsection{Delta}\index{delta}
+\printindex
+\end{document}
+'''
+
+class SplitWorkers(RenderTest):
+    """ Render split files in one process and in several """
+
+    def setUp(self):
+        RenderTest.setUp(self)
+        open(os.path.join(self.root, 'doc.tex'), 'w').write(SOURCE)
+
+    def render(self, workers):
+        """ Render the document and return the HTML files """
+        outdir = 'out%s' % workers
+        log = plastex('--renderer=XHTML', '--imager=none', '--dir=%s' % outdir,
+                      '--split-workers=%s' % workers, 'doc.tex', cwd=self.root)
+        return self.readFiles(os.path.join(self.root, outdir), ['.html']), log
+
+    def testSameFiles(self):
+        one, log = self.render(1)
+        several, log = self.render(2)
+        assert re.search(r'Rendering \d+ files in 2 processes', log), log
+        assert len(one) > 3, sorted(one)
+        self.assertSameFiles(one, several)
+
+    def testImages(self):
+        several, log = self.render(2)
+        images = set()
+        for lines in several.values():
+            s = ''.join(lines)
+            assert 'plasTeX-image' not in s, s
+            images.update(re.findall(r'images/img-\d+\.png', s))
+        assert len(images) == 3, images
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+
+import os, shutil, tempfile, unittest
+from unittest import TestCase
+from plasTeX.TeX import TeX
+from plasTeX.Imagers import Imager, Image, PILImage, DimensionPlaceholder
+
+class StaticImages(TestCase):
+    """ Convert static images after rendering, or generate them with LaTeX """
+
+    def setUp(self):
+        if PILImage is None:
+            self.skipTest('PIL is not available')
+        self.cwd = os.getcwd()
+        self.root = tempfile.mkdtemp()
+        os.chdir(self.root)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def imager(self, types=['.png']):
+        tex = TeX()
+        tex.input(r'\documentclass{article}\begin{document}x\end{document}')
+        imager = Imager(tex.parse(), types)
+        imager.imageAttrs = '&${filename}-${attr};'
+        imager.config['images']['workers'] = 1
+        return imager
+
+    def save(self, path, size):
+        PILImage.new('RGB', size, (255, 0, 0)).save(path)
+
+    def testConvert(self):
+        self.save('figure.bmp', (30, 20))
+        imager = self.imager()
+        img = imager.staticImage('figure.bmp', r'\fbox{figure}')
+        assert img.filename.endswith('.png'), img.filename
+        assert isinstance(img.width, DimensionPlaceholder), img.width
+        imager.convertStaticImages()
+        assert (img.width, img.height) == (30, 20), (img.width, img.height)
+        assert PILImage.open(img.filename).size == (30, 20)
+        assert imager.staticfiles[img.filename] is img
+        assert not imager.images
+
+    def truncated(self):
+        """ Return an imager with a BMP whose header can be read, but not its data """
+        self.save('figure.bmp', (30, 20))
+        data = open('figure.bmp', 'rb').read()
+        open('figure.bmp', 'wb').write(data[:100])
+        imager = self.imager()
+        return imager, imager.staticImage('figure.bmp', r'\fbox{figure}')
+
+    def testFallback(self):
+        imager, img = self.truncated()
+        imager.convertStaticImages()
+        generated = imager.images[img.filename]
+        assert imager.staticfiles[img.filename] is generated
+        assert generated.filename == img.filename, generated.filename
+        assert isinstance(generated.width, DimensionPlaceholder)
+        assert r'\fbox{figure}' in imager.source.getvalue()
+
+    def testCachedFallback(self):
+        # On a rebuild the image LaTeX generated last time is cached
+        imager, img = self.truncated()
+        cached = Image(img.filename, imager.config['images'])
+        cached.width, cached.height = 30, 20
+        imager._cache[imager.cacheKey(r'\fbox{figure}', '')] = cached
+        imager.convertStaticImages()
+        assert not imager.images, imager.images.keys()
+        assert imager.staticfiles[img.filename] is cached
+
+    def scaled(self, name):
+        """ Return the image for a JPEG scaled by half """
+        imager = self.imager(['.png', '.jpg'])
+        scale = imager.config['images']['scale-factor']
+        imager.config['images']['scale-factor'] = 0.5
+        try:
+            return imager, imager.staticImage(name, r'\fbox{photo}')
+        finally:
+            imager.config['images']['scale-factor'] = scale
+
+    def testConvertNow(self):
+        # A scaled JPEG keeps its type, so LaTeX couldn't generate it 
+        # under the same name
+        self.save('photo.jpg', (40, 20))
+        imager, img = self.scaled('photo.jpg')
+        assert img.filename.endswith('.jpg'), img.filename
+        assert (img.width, img.height) == (20, 10), (img.width, img.height)
+        assert len(os.listdir(os.path.join('.cache', 'static'))) == 1
+
+    def testConvertNowFallback(self):
+        self.save('photo.jpg', (40, 20))
+        data = open('photo.jpg', 'rb').read()
+        open('photo.jpg', 'wb').write(data[:200])
+        imager, img = self.scaled('photo.jpg')
+        assert img.filename.endswith('.png'), img.filename
+        assert imager.images[img.filename] is img
+        assert not imager.staticJobs
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+
+import os, unittest
+from plasTeX.TeX import TeX
+from plasTeX.Renderers.DocBook import Renderer as DocBook
+from FunctionalTests import RenderTest, plastex
+
+SOURCE = r'''\documentclass{book}
+\usepackage{makeidx}
+\makeindex
+\begin{document}
+\tableofcontents
+\chapter{One}\label{one}
+See chapter \ref{two}. Caf\'e \& ``quotes''.
+\section{Alpha} Text\footnote{A note}.
+\begin{itemize}\item First \item Second {\em nested {\bf deeper}}\end{itemize}
+\begin{verbatim}
+code <here>
+\end{verbatim}
+\chapter{Two}\label{two}
+Back to section \ref{one}.
+\section{Beta}\index{beta}
+\begin{tabular}{ll} a & b \\ c & d \end{tabular}
+\printindex
+\end{document}
+'''
+
+class StreamOutput(RenderTest):
+    """ Render documents in memory and streamed to their files """
+
+    def setUp(self):
+        RenderTest.setUp(self)
+        open(os.path.join(self.root, 'doc.tex'), 'w').write(SOURCE)
+
+    def render(self, outdir, *options):
+        """ Render the document and return the output files """
+        args = ['--imager=none', '--vector-imager=none',
+                '--dir=%s' % outdir] + list(options) + ['doc.tex']
+        plastex(cwd=self.root, *args)
+        return self.readFiles(os.path.join(self.root, outdir), ['.html', '.xml'])
+
+    def compare(self, *options):
+        memory = self.render('memory', *options)
+        stream = self.render('stream', '--stream-output', *options)
+        assert memory, memory
+        self.assertSameFiles(memory, stream)
+        return stream
+
+    def testXHTML(self):
+        output = self.compare('--renderer=XHTML')
+        assert len(output) > 3, sorted(output)
+
+    def testDocBook(self):
+        output = self.compare('--renderer=DocBook', '--filename=doc.xml')
+        assert sorted(output) == ['doc.xml'], sorted(output)
+
+    def testEscapeHighChars(self):
+        output = self.compare('--renderer=DocBook', '--filename=doc.xml',
+                              '--escape-high-chars')
+        assert '&#233;' in ''.join(output['doc.xml'])
+
+    def processFile(self, s):
+        """ Post-process a DocBook file on disk and return its new content """
+        tex = TeX()
+        tex.input(r'\documentclass{article}\begin{document}x\end{document}')
+        document = tex.parse()
+        renderer = DocBook()
+        filename = os.path.join(self.root, 'doc.xml')
+        open(filename, 'w').write(s)
+        if not renderer.processFile(document, filename):
+            assert open(filename).read() == s
+            return None
+        assert sorted(os.listdir(self.root)) == ['doc.tex', 'doc.xml']
+        return renderer.processFileContent(document, s.decode('utf-8')), \
+               open(filename).read().decode('utf-8')
+
+    def testProcessFile(self):
+        s = ' <chapter><para> </para>See Section <xref/></chapter>\n' * 5000
+        expected, result = self.processFile(s)
+        assert expected == result
+
+    def testProcessWholeFile(self):
+        assert self.processFile('<para>a<br>b</para>') is None
+
+if __name__ == '__main__':
+    unittest.main()
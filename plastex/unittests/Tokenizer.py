@@ -60,6 +60,13 @@ class Tokenizing(TestCase):
         expected = [Other('\x01'), Space(' ')]
         assert tokens == expected, '%s != %s' % (tokens, expected)
 
+    def testNonASCII(self):
+        # Every character is kept, one token each
+        source = u'caf\xe9 \u2018q\u2019 \U0001d11e'
+        tokens = [x for x in TeX().input(source).itertokens()]
+        assert u''.join(tokens) == source, '%r != %r' % (u''.join(tokens), source)
+        assert [x for x in tokens if len(x) != 1] == []
+
     def testParagraph(self):
         tokens = [x for x in TeX().input('1\n   2\n   \n   3\n').itertokens()]
         expected = [Other('1'), Space(' '), 
@@ -0,0 +1,77 @@
+"""Measures how fast the Imager crops equation images.
+
+Usage: python crop.py directory [padding]
+
+Runs Image._stripBaseline, which is what Imager.convert does to each
+image dvipng generates, on every PNG file in the directory (for example
+the img*.png files left in the temporary directory by a build with
+--save-image-file).  It runs once with numpy and once without, reports
+the CPU time of each, and checks that both produce the same pixels
+and depths.
+"""
+
+import os
+import sys
+import time
+
+from plasTeX import Imagers
+from plasTeX.Imagers import Image, PILImage
+
+
+class Config(dict):
+    """Stands in for the images section of the configuration."""
+
+    def __getitem__(self, key):
+        return self.get(key, 0)
+
+
+def strip_all(images, padding):
+    """Strips the baseline of each image.
+
+    images: list of (filename, PIL image) pairs
+    padding: baseline padding in pixels
+
+    Returns: tuple of list of results and the time in seconds
+    """
+    results = []
+    start = time.clock()
+    for filename, im in images:
+        img = Image(filename, Config())
+        try:
+            cropped, depth = img._stripBaseline(im, padding)
+            results.append((cropped.size, cropped.tobytes(), depth))
+        except Exception, msg:
+            results.append(str(msg))
+    return results, time.clock() - start
+
+
+def main(name, directory, padding=0, *argv):
+    padding = int(padding)
+    names = sorted(f for f in os.listdir(directory) if f.endswith('.png'))
+    images = []
+    for filename in names:
+        im = PILImage.open(os.path.join(directory, filename))
+        im.load()
+        images.append((filename, im))
+
+    numpy = Imagers.numpy
+    if numpy is None:
+        print 'numpy is not installed'
+        return
+
+    fast, fast_time = strip_all(images, padding)
+    Imagers.numpy = None
+    slow, slow_time = strip_all(images, padding)
+    Imagers.numpy = numpy
+
+    print '%d images' % len(images)
+    print 'getpixel %6.3f s' % slow_time
+    print 'numpy    %6.3f s (%.1fx)' % (fast_time, slow_time / fast_time)
+
+    for filename, a, b in zip(names, fast, slow):
+        if a != b:
+            print 'different results for', filename
+
+
+if __name__ == '__main__':
+    main(*sys.argv)
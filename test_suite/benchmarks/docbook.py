@@ -0,0 +1,95 @@
+"""Measures how fast the DocBook renderer fixes up its output.
+
+Usage: python docbook.py file [copies]
+
+Runs the DocBook renderer's post-processing of the markup (everything
+DocBook.processFileContent does after the image sizes are filled in)
+on a rendered DocBook file, for example thinkpython/book/book.xml after
+running make in test_suite/thinkpython.  The file is repeated copies
+times (1 by default).  It runs once with the single-pass fixupMarkup
+and once with the original series of regular expressions, reports the
+time and the peak memory of each, and checks that both produce the
+same output.
+
+The peak memory is the growth of the peak resident set size while
+the fixups run, so it is only meaningful on Linux.
+"""
+
+import codecs
+import os
+import resource
+import sys
+import time
+
+from plasTeX.Renderers.DocBook import fixupMarkup, fixupMarkupSequentially
+
+
+def peak_rss():
+    """Returns the peak resident set size of this process in KB."""
+    try:
+        for line in open('/proc/self/status'):
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1])
+    except IOError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def reset_peak_rss():
+    """Resets the peak resident set size, where Linux allows it."""
+    try:
+        open('/proc/self/clear_refs', 'w').write('5')
+    except IOError:
+        pass
+
+
+def measure(fixup, s):
+    """Runs fixup on s in a child process.
+
+    fixup: function that takes and returns a unicode string
+    s: unicode string
+
+    Returns: tuple of output, time in seconds and peak memory in KB
+    """
+    read, write = os.pipe()
+    pid = os.fork()
+    if not pid:
+        os.close(read)
+        reset_peak_rss()
+        before = peak_rss()
+        start = time.time()
+        result = fixup(s)
+        elapsed = time.time() - start
+        memory = peak_rss() - before
+        out = os.fdopen(write, 'w')
+        out.write('%r %r\n' % (elapsed, memory))
+        out.write(result.encode('utf-8'))
+        out.close()
+        os._exit(0)
+
+    os.close(write)
+    data = os.fdopen(read).read()
+    os.waitpid(pid, 0)
+    header, result = data.split('\n', 1)
+    elapsed, memory = header.split()
+    return result.decode('utf-8'), float(elapsed), int(memory)
+
+
+def main(name, filename, copies=1, *argv):
+    s = codecs.open(filename, 'r', 'utf-8').read() * int(copies)
+    s = s.strip()
+
+    fast, fast_time, fast_memory = measure(fixupMarkup, s)
+    slow, slow_time, slow_memory = measure(fixupMarkupSequentially, s)
+
+    print '%d characters' % len(s)
+    print 'expressions %6.3f s %8d KB' % (slow_time, slow_memory)
+    print 'one pass    %6.3f s %8d KB (%.1fx)' % (fast_time, fast_memory,
+                                                 slow_time / fast_time)
+
+    if fast != slow:
+        print 'different results'
+
+
+if __name__ == '__main__':
+    main(*sys.argv)
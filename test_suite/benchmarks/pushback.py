@@ -0,0 +1,38 @@
+"""Measures how fast the TeX engine expands a macro with a long expansion.
+
+Usage: python pushback.py [ntokens]
+
+Defines a macro whose body is ntokens tokens long (100000 by default),
+invokes it, and times reading the whole expansion back out of the
+engine.  Every expansion is pushed back into the token buffer before it
+is re-read, so this is dominated by the cost of the push-back.
+"""
+
+import sys
+import time
+
+from plasTeX.TeX import TeX
+
+
+def main(name, ntokens=100000, *argv):
+    ntokens = int(ntokens)
+
+    # letters and spaces alternate, and a space token survives only
+    # after a letter, so the body has ntokens tokens
+    body = 'x ' * (ntokens / 2)
+
+    tex = TeX()
+    tex.input('\\def\\big{%s}\\big' % body)
+
+    start = time.clock()
+    count = 0
+    for token in tex:
+        count += 1
+    elapsed = time.clock() - start
+
+    print 'expanded %d tokens in %.3f s (%.0f tokens/s)' % (
+        count, elapsed, count / elapsed)
+
+
+if __name__ == '__main__':
+    main(*sys.argv)
@@ -0,0 +1,86 @@
+"""Measures the memory used to render a document with --stream-output.
+
+Usage: python stream.py [plastex options] file
+
+Runs plastex on file twice, once as given and once with --stream-output
+added, for example in test_suite/thinkpython after running make:
+
+    python ../benchmarks/stream.py --renderer=DocBook --theme=book \
+        --filename=book.xml --dir=book book.pre.tex
+
+For each run it reports the time spent in Renderer.render and the
+growth of the peak memory while it ran, which covers rendering the
+document, generating the images and post-processing the files, but
+not parsing.
+
+The peak memory is the growth of the peak resident set size, so it
+is only meaningful on Linux.
+"""
+
+import gc
+import os
+import sys
+import time
+
+from docbook import peak_rss, reset_peak_rss
+
+PLASTEX = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       '..', '..', 'plastex', 'plasTeX', 'plastex')
+
+
+def measure(argv):
+    """Runs plastex in a child process.
+
+    argv: list of plastex arguments
+
+    Returns: tuple of time in seconds and peak memory in KB
+    """
+    read, write = os.pipe()
+    pid = os.fork()
+    if not pid:
+        os.close(read)
+        from plasTeX.Renderers import Renderer
+        render = Renderer.render
+        result = {}
+
+        def measured(self, document, *args, **kwargs):
+            gc.collect()
+            reset_peak_rss()
+            before = peak_rss()
+            start = time.time()
+            render(self, document, *args, **kwargs)
+            result['time'] = time.time() - start
+            result['memory'] = peak_rss() - before
+
+        Renderer.render = measured
+        sys.argv = ['plastex'] + argv
+        null = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(null, 1)
+        os.dup2(null, 2)
+        try:
+            execfile(PLASTEX, {'__name__': '__main__'})
+        except SystemExit:
+            pass
+        out = os.fdopen(write, 'w')
+        out.write('%r %r\n' % (result['time'], result['memory']))
+        out.close()
+        os._exit(0)
+
+    os.close(write)
+    data = os.fdopen(read).read()
+    os.waitpid(pid, 0)
+    elapsed, memory = data.split()
+    return float(elapsed), int(memory)
+
+
+def main(name, *argv):
+    argv = list(argv)
+    memory_time, memory = measure(argv)
+    stream_time, stream = measure(['--stream-output'] + argv)
+
+    print 'in memory %6.3f s %8d KB' % (memory_time, memory)
+    print 'streamed  %6.3f s %8d KB' % (stream_time, stream)
+
+
+if __name__ == '__main__':
+    main(*sys.argv)
@@ -0,0 +1,79 @@
+"""Measures how fast the plasTeX Tokenizer reads a LaTeX source file.
+
+Usage: python tokenizer.py [filename]
+
+The default is the Think Python source.  The file is opened the way
+plastex opens it (a codecs stream).  The script reports the best of
+several runs, in CPU time, for reading the raw characters, for
+tokenizing, and for tokenizing through TeX.itertokens.
+"""
+
+import codecs
+import os
+import sys
+import time
+
+from plasTeX.TeX import TeX
+from plasTeX.Tokenizer import Tokenizer
+
+
+DEFAULT_SOURCE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              '..', 'thinkpython', 'book.tex')
+
+
+def time_it(func, filename, runs=5):
+    """Runs func on a fresh TeX instance reading filename.
+
+    func: function that takes a TeX instance and returns a count
+    filename: string
+
+    Returns: tuple of count and the best time in seconds
+    """
+    best = None
+    for i in range(runs):
+        tex = TeX()
+        tex.input(codecs.open(filename, 'r', 'utf-8', 'replace'))
+        start = time.clock()
+        count = func(tex)
+        elapsed = time.clock() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return count, best
+
+
+def count_chars(tex):
+    n = 0
+    for char in tex.inputs[-1][0].iterchars():
+        n += 1
+    return n
+
+
+def count_tokens(tex):
+    n = 0
+    for token in tex.inputs[-1][0]:
+        n += 1
+    return n
+
+
+def count_tex_tokens(tex):
+    n = 0
+    for token in tex.itertokens():
+        n += 1
+    return n
+
+
+def main(name, filename=DEFAULT_SOURCE, *argv):
+    size = len(codecs.open(filename, 'r', 'utf-8', 'replace').read())
+
+    tests = [('Tokenizer.iterchars', count_chars),
+             ('Tokenizer.__iter__', count_tokens),
+             ('TeX.itertokens', count_tex_tokens)]
+
+    for label, func in tests:
+        count, seconds = time_it(func, filename)
+        print '%-20s %8d items %6.3f s %10.0f chars/s' % (
+            label, count, seconds, size / seconds)
+
+
+if __name__ == '__main__':
+    main(*sys.argv)